@@ -194,6 +194,15 @@ function startup(data, reasonCode) {
     // Make version 2 of the manifest
     let manifest = options.manifest;
 
+    // Modules that cfx packed into bundle files, by manifest path
+    let bundles = null;
+    if (options.bundles) {
+      bundles = Object.keys(options.bundles).reduce(function(result, path) {
+        result[path] = rootURI + options.bundles[path];
+        return result;
+      }, {});
+    }
+
     // Import `cuddlefish.js` module using a Sandbox and bootstrap loader.
     let cuddlefishPath = 'loader/cuddlefish.js';
     let cuddlefishURI = 'resource://gre/modules/commonjs/sdk/' + cuddlefishPath;
@@ -217,6 +226,8 @@ function startup(data, reasonCode) {
       paths: paths,
       // modules manifest.
       manifest: manifest,
+      // modules to read from bundles rather than from their own files.
+      bundles: bundles,
 
       // Add-on ID used by different APIs as a unique identifier.
       id: id,
@@ -267,11 +267,25 @@ const evaluate = iced(function evaluate(sandbox, uri, options) {
     source: null
   }, options);
 
-  return source ? Cu.evalInSandbox(source, sandbox, version, uri, line)
-                : loadSubScript(uri, sandbox, encoding);
+  // an empty `source` is still a source: a module may be empty
+  return source != null ? Cu.evalInSandbox(source, sandbox, version, uri, line)
+                        : loadSubScript(uri, sandbox, encoding);
 });
 Loader.evaluate = evaluate;
 
+// Returns the source of the given `module` if it was packed into one of the
+// bundles of the `loader` (see `options.bundles` of `Loader`), or `null`.
+// Each bundle is read once, the first time one of its modules is loaded.
+function readBundledSource(loader, module) {
+  let { bundles } = loader;
+  if (!bundles || !(module.id in bundles.index))
+    return null;
+  let uri = bundles.index[module.id];
+  if (!(uri in bundles.sources))
+    bundles.sources[uri] = JSON.parse(readURI(uri));
+  return bundles.sources[uri][module.id];
+}
+
 // Populates `exports` of the given CommonJS `module` object, in the context
 // of the given `loader` by evaluating code associated with it.
 const load = iced(function load(loader, module) {
@@ -320,7 +334,8 @@ const load = iced(function load(loader, module) {
   sandboxes[module.uri] = sandbox;
 
   try {
-    evaluate(sandbox, module.uri);
+    let source = readBundledSource(loader, module);
+    evaluate(sandbox, module.uri, source === null ? {} : { source: source });
   }
   catch (error) {
     let { message, fileName, lineNumber } = error;
@@ -738,6 +753,9 @@ Loader.unload = unload;
 //   module object (that has `uri` property) and `baseURI` of the loader.
 //   If `resolve` does not returns `uri` string exception will be thrown by
 //   an associated `require` call.
+// - `bundles`: Optional map of module ids to the URIs of the bundles they
+//   were packed into: JSON files which map module ids to their source.
+//   Such modules are evaluated from their bundle instead of their `uri`.
 function Loader(options) {
   let {
     modules, globals, resolve, paths, rootURI, manifest, requireMap, isNative,
@@ -840,6 +858,10 @@ function Loader(options) {
     sharedGlobalBlacklist: { enumerable: false, value: sharedGlobalBlacklist },
     // Map of module sandboxes indexed by module URIs.
     sandboxes: { enumerable: false, value: {} },
+    // Bundle URIs indexed by module ids, and the parsed bundles by URI.
+    bundles: { enumerable: false,
+               value: options.bundles ? { index: options.bundles,
+                                          sources: {} } : null },
     resolve: { enumerable: false, value: resolve },
     // ID of the addon, if provided.
     id: { enumerable: false, value: options.id },
@@ -5,11 +5,12 @@
 import sys
 import os
 import optparse
+import re
 import time
 
 from copy import copy
 import simplejson as json
-from cuddlefish import packaging
+from cuddlefish import packaging, profiler
 from cuddlefish._version import get_versions
 
 MOZRUNNER_BIN_NOT_FOUND = 'Mozrunner could not locate your binary'
@@ -142,6 +143,21 @@ parser_groups = (
                                     default=False,
                                     cmds=['run', 'test', 'testex', 'testpkgs',
                                           'testaddons', 'testall'])),
+        (("", "--results-json",), dict(dest="results_json",
+                                       help=("write the result and timing of "
+                                             "each test to this file as JSON "
+                                             "(implies --parseable)"),
+                                       metavar="FILE",
+                                       default=None,
+                                       cmds=['test'])),
+        (("", "--results-junit",), dict(dest="results_junit",
+                                        help=("write the result and timing of "
+                                              "each test to this file as "
+                                              "JUnit XML (implies "
+                                              "--parseable)"),
+                                        metavar="FILE",
+                                        default=None,
+                                        cmds=['test'])),
         ]
      ),
 
@@ -180,6 +196,14 @@ parser_groups = (
                                     default=False,
                                     cmds=['run', 'test', 'testex', 'testpkgs',
                                           'testall', 'xpi'])),
+        (("", "--bundle-modules",), dict(dest="bundle_modules",
+                                    help=("pack the modules into a few "
+                                          "bundle files, which the loader "
+                                          "reads at once (needs "
+                                          "--force-use-bundled-sdk)"),
+                                    action="store_true",
+                                    default=False,
+                                    cmds=['xpi'])),
         (("", "--no-run",), dict(dest="no_run",
                                      help=("Instead of launching the "
                                            "application, just show the command "
@@ -236,6 +260,20 @@ parser_groups = (
                                       help="Where to put the finished .xpi",
                                       default=None,
                                       cmds=['xpi'])),
+        (("", "--size-report",), dict(dest="size_report",
+                                      help=("print the size of the .xpi, "
+                                            "broken down by package, "
+                                            "section and file"),
+                                      action="store_true",
+                                      default=False,
+                                      cmds=['xpi'])),
+        (("", "--size-budget",), dict(dest="size_budget",
+                                      help=("fail if the .xpi, or a package "
+                                            "in it, is larger than the "
+                                            "limits in this JSON file"),
+                                      metavar="FILE",
+                                      default=None,
+                                      cmds=['xpi'])),
         (("", "--manifest-overload",), dict(dest="manifest_overload",
                                       help="JSON file to overload package.json properties",
                                       default=None,
@@ -252,6 +290,80 @@ parser_groups = (
                                       default="default",
                                       cmds=['test', 'run', 'testpkgs',
                                             'testall', 'testaddons', 'testex'])),
+        (("", "--install-xpi",), dict(dest="install_xpi",
+                                      help=("install the add-on in the "
+                                            "profile as an XPI, rather than "
+                                            "as a directory of links to "
+                                            "its files"),
+                                      action="store_true",
+                                      default=False,
+                                      cmds=['test', 'run', 'testex',
+                                            'testpkgs', 'testaddons',
+                                            'testall'])),
+        (("", "--no-cache",), dict(dest="no_cache",
+                                   help=("don't use or update the build "
+                                         "caches in .cfx-cache directories"),
+                                   action="store_true",
+                                   default=False,
+                                   cmds=['test', 'run', 'xpi', 'testex',
+                                         'testpkgs', 'testaddons',
+                                         'testall'])),
+        (("", "--no-scan-cache",), dict(dest="no_scan_cache",
+                                        help=("rescan every module instead "
+                                              "of reusing cached scan results"),
+                                        action="store_true",
+                                        default=False,
+                                        cmds=['test', 'run', 'xpi', 'testex',
+                                              'testpkgs', 'testaddons',
+                                              'testall'])),
+        (("", "--changed-since",), dict(dest="changed_since",
+                                        help=("only run the tests which "
+                                              "depend on files changed since "
+                                              "this git revision or time "
+                                              "(seconds since the epoch, or "
+                                              "YYYY-MM-DD[THH:MM[:SS]])"),
+                                        metavar="REV|TIME",
+                                        default=None,
+                                        cmds=['test'])),
+        (("", "--parallel",), dict(dest="parallel",
+                                   help=("number of examples, test addons "
+                                         "or packages to test at the same "
+                                         "time, each in its own cfx process "
+                                         "(default 1)"),
+                                   type="int",
+                                   metavar="N",
+                                   default=1,
+                                   cmds=['testex', 'testpkgs', 'testaddons',
+                                         'testall'])),
+        (("", "--shards",), dict(dest="shards",
+                                 help=("split the test modules between this "
+                                       "many instances of the application, "
+                                       "run at the same time, balanced by "
+                                       "how long they took the last time"),
+                                 type="int",
+                                 metavar="N",
+                                 default=1,
+                                 cmds=['test'])),
+        (("-j", "--jobs",), dict(dest="jobs",
+                                 help=("number of worker threads used to "
+                                       "read, hash and scan modules while "
+                                       "building the manifest, and to "
+                                       "compress the XPI (default 1)"),
+                                 type="int",
+                                 metavar=None,
+                                 default=1,
+                                 cmds=['test', 'run', 'xpi', 'testex',
+                                       'testpkgs', 'testaddons',
+                                       'testall'])),
+        (("", "--scan-processes",), dict(dest="scan_processes",
+                                         help=("with --jobs, scan modules in "
+                                               "worker processes instead of "
+                                               "threads"),
+                                         action="store_true",
+                                         default=False,
+                                         cmds=['test', 'run', 'xpi', 'testex',
+                                               'testpkgs', 'testaddons',
+                                               'testall'])),
         ]
      ),
 
@@ -301,10 +413,55 @@ parser_groups = (
                                          default=0,
                                          cmds=['test', 'testex', 'testpkgs',
                                                'testall'])),
+        (("", "--profile-build",), dict(dest="profile_build",
+                                        help=("write a trace of the build "
+                                              "phases to this file, in the "
+                                              "Chrome trace-event format"),
+                                        metavar="FILE",
+                                        default=None,
+                                        cmds=['test', 'run', 'xpi'])),
+        (("", "--build-stats",), dict(dest="build_stats",
+                                      help=("print manifest and cache "
+                                            "statistics after building"),
+                                      action="store_true",
+                                      default=False,
+                                      cmds=['test', 'run', 'xpi'])),
         ]
      ),
     )
 
+def get_tests_filter(testnames, old_filter=""):
+    """
+    Returns a --filter value which selects the test modules TESTNAMES (like
+    "test-foo"), keeping the test name part of OLD_FILTER, if any.
+
+      >>> print get_tests_filter(["test-a", "test-b.c"], "ignored:testFoo")
+      (^|/)(test\-a|test\-b\.c)\.js$:testFoo
+    """
+    names = "|".join([re.escape(testname) for testname in testnames])
+    new_filter = "(^|/)(%s)\\.js$" % names
+    if ":" in old_filter:
+        new_filter += old_filter[old_filter.index(":"):]
+    return new_filter
+
+def filter_test_names(pkgname, testnames, test_filter):
+    """
+    Returns those of TESTNAMES, the test modules of the package PKGNAME,
+    that the file part of the --filter TEST_FILTER selects. Like the test
+    harness, this matches it against where each module is in the XPI.
+
+      >>> filter_test_names("pkg", ["test-a", "test-b"], "tests/test-a:foo")
+      ['test-a']
+      >>> filter_test_names("pkg", ["test-a", "test-b"], r"b\.js$")
+      ['test-b']
+      >>> filter_test_names("pkg", ["test-a", "test-b"], "")
+      ['test-a', 'test-b']
+    """
+    file_re = test_filter.split(":")[0]
+    return [testname for testname in testnames
+            if re.search(file_re, "resources/%s/tests/%s.js" % (pkgname,
+                                                                testname))]
+
 def find_parent_package(cur_dir):
     tail = True
     while tail:
@@ -386,30 +543,14 @@ def test_all(env_root, defaults):
             fail = True
 
     if not fail or not defaults.get("stopOnError"):
-        print >>sys.stderr, "Testing all examples..."
+        print >>sys.stderr, ("Testing all examples, unit-test addons and "
+                             "packages...")
         sys.stderr.flush()
-
-        try:
-            test_all_examples(env_root, defaults)
-        except SystemExit, e:
-            fail = (e.code != 0) or fail
-
-    if not fail or not defaults.get("stopOnError"):
-        print >>sys.stderr, "Testing all unit-test addons..."
-        sys.stderr.flush()
-
-        try:
-            test_all_testaddons(env_root, defaults)
-        except SystemExit, e:
-            fail = (e.code != 0) or fail
-
-    if not fail or not defaults.get("stopOnError"):
-        print >>sys.stderr, "Testing all packages..."
-        sys.stderr.flush()
-        try:
-            test_all_packages(env_root, defaults)
-        except SystemExit, e:
-            fail = (e.code != 0) or fail
+        targets = (get_example_targets(env_root, defaults) +
+                   get_testaddon_targets(env_root, defaults) +
+                   get_package_targets(env_root, defaults))
+        if not run_test_targets(env_root, defaults, targets):
+            fail = True
 
     print >>sys.stderr, "Total time for all tests: %f seconds" % (time.time() - starttime)
 
@@ -432,62 +573,67 @@ def test_cfx(env_root, verbose):
     sys.stdout.flush(); sys.stderr.flush()
     return retval
 
-def test_all_testaddons(env_root, defaults):
+def run_test_targets(env_root, defaults, targets):
+    """
+    Runs the orchestrator.Target objects TARGETS, each in its own cfx
+    process, --parallel at a time. Returns True if they all passed.
+    """
+    from cuddlefish.orchestrator import run_targets
+    from cuddlefish.cache import DurationsCache, get_cache_dir
+    durations = None
+    if not defaults.get("no_cache"):
+        durations = DurationsCache(os.path.join(get_cache_dir(env_root),
+                                                "test-targets.json"))
+    return run_targets(targets, env_root, defaults,
+                       parallel=defaults.get("parallel", 1),
+                       durations=durations,
+                       stop_on_error=defaults.get("stopOnError"))
+
+def get_testaddon_targets(env_root, defaults):
+    from cuddlefish.orchestrator import Target
     addons_dir = os.path.join(env_root, "test", "addons")
     addons = [dirname for dirname in os.listdir(addons_dir)
                 if os.path.isdir(os.path.join(addons_dir, dirname))]
     addons.sort()
-    fail = False
+    targets = []
     for dirname in addons:
         # apply the filter
         if (not defaults['filter'].split(":")[0] in dirname):
             continue
+        targets.append(Target("test/addons/" + dirname,
+                              ["testrun", "--pkgdir",
+                               os.path.join(addons_dir, dirname)]))
+    return targets
 
-        print >>sys.stderr, "Testing %s..." % dirname
-        sys.stderr.flush()
-        try:
-            run(arguments=["testrun",
-                           "--pkgdir",
-                           os.path.join(addons_dir, dirname)],
-                defaults=defaults,
-                env_root=env_root)
-        except SystemExit, e:
-            fail = (e.code != 0) or fail
-        if fail and defaults.get("stopOnError"):
-            break
-
-    if fail:
+def test_all_testaddons(env_root, defaults):
+    targets = get_testaddon_targets(env_root, defaults)
+    if not run_test_targets(env_root, defaults, targets):
         print >>sys.stderr, "Some test addons tests were unsuccessful."
         sys.exit(-1)
 
-def test_all_examples(env_root, defaults):
+def get_example_targets(env_root, defaults):
+    from cuddlefish.orchestrator import Target
     examples_dir = os.path.join(env_root, "examples")
     examples = [dirname for dirname in os.listdir(examples_dir)
                 if os.path.isdir(os.path.join(examples_dir, dirname))]
     examples.sort()
-    fail = False
+    targets = []
     for dirname in examples:
         if (not defaults['filter'].split(":")[0] in dirname):
             continue
+        targets.append(Target("examples/" + dirname,
+                              ["test", "--pkgdir",
+                               os.path.join(examples_dir, dirname)]))
+    return targets
 
-        print >>sys.stderr, "Testing %s..." % dirname
-        sys.stderr.flush()
-        try:
-            run(arguments=["test",
-                           "--pkgdir",
-                           os.path.join(examples_dir, dirname)],
-                defaults=defaults,
-                env_root=env_root)
-        except SystemExit, e:
-            fail = (e.code != 0) or fail
-        if fail and defaults.get("stopOnError"):
-            break
-
-    if fail:
+def test_all_examples(env_root, defaults):
+    targets = get_example_targets(env_root, defaults)
+    if not run_test_targets(env_root, defaults, targets):
         print >>sys.stderr, "Some examples tests were unsuccessful."
         sys.exit(-1)
 
-def test_all_packages(env_root, defaults):
+def get_package_targets(env_root, defaults):
+    from cuddlefish.orchestrator import Target
     packages_dir = os.path.join(env_root, "packages")
     if os.path.isdir(packages_dir):
       packages = [dirname for dirname in os.listdir(packages_dir)
@@ -498,21 +644,19 @@ def test_all_packages(env_root, defaults):
     packages.sort()
     print >>sys.stderr, "Testing all available packages: %s." % (", ".join(packages))
     sys.stderr.flush()
-    fail = False
+    targets = []
     for dirname in packages:
-        print >>sys.stderr, "Testing %s..." % dirname
-        sys.stderr.flush()
-        try:
-            run(arguments=["test",
-                           "--pkgdir",
-                           os.path.join(packages_dir, dirname)],
-                defaults=defaults,
-                env_root=env_root)
-        except SystemExit, e:
-            fail = (e.code != 0) or fail
-        if fail and defaults.get('stopOnError'):
-            break
-    if fail:
+        # env_root is an absolute path, which join() keeps as it is
+        pkgdir = os.path.join(packages_dir, dirname)
+        name = "packages/" + dirname
+        if pkgdir == env_root:
+            name = "addon-sdk"
+        targets.append(Target(name, ["test", "--pkgdir", pkgdir]))
+    return targets
+
+def test_all_packages(env_root, defaults):
+    targets = get_package_targets(env_root, defaults)
+    if not run_test_targets(env_root, defaults, targets):
         print >>sys.stderr, "Some package tests were unsuccessful."
         sys.exit(-1)
 
@@ -643,7 +787,19 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
         print >>sys.stderr, "Try using '--help' for assistance."
         sys.exit(1)
 
+    if options.profile_build:
+        profiler.start()
+    run_span = profiler.begin("cfx " + command)
+
     target_cfg_json = None
+    discovery_cache = None
+    if not options.no_cache:
+        # what packages live where is shared by every add-on built with
+        # this SDK
+        from cuddlefish.cache import DiscoveryCache, get_cache_dir
+        discovery_cache = DiscoveryCache(os.path.join(get_cache_dir(env_root),
+                                                      "packages.json"))
+
     if not target_cfg:
         if not options.pkgdir:
             options.pkgdir = find_parent_package(os.getcwd())
@@ -659,7 +815,8 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
             sys.exit(1)
 
         target_cfg_json = os.path.join(options.pkgdir, 'package.json')
-        target_cfg = packaging.get_config_in_dir(options.pkgdir)
+        target_cfg = packaging.get_config_in_dir(options.pkgdir,
+                                                 discovery_cache)
 
     if options.manifest_overload:
         for k, v in packaging.load_json_file(options.manifest_overload).items():
@@ -681,6 +838,17 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
         inherited_options.extend(['iterations', 'filter', 'profileMemory',
                                   'stopOnError'])
         enforce_timeouts = True
+        if options.shards < 1:
+            print >>sys.stderr, "--shards must be at least 1."
+            sys.exit(1)
+        if options.shards > 1 and options.profiledir:
+            print >>sys.stderr, ("--shards can't be used with --profiledir: "
+                                 "each shard needs its own profile.")
+            sys.exit(1)
+        # the results are read from the parseable output
+        if (options.results_json or options.results_junit or
+            options.shards > 1):
+            options.parseable = True
     elif command == "run":
         use_main = True
     elif command == "testrun":
@@ -697,7 +865,12 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
             sys.exit(1)
 
     if not pkg_cfg:
-        pkg_cfg = packaging.build_config(env_root, target_cfg, options.packagepath)
+        pkg_cfg = profiler.call("packaging.build_config",
+                                packaging.build_config,
+                                env_root, target_cfg, options.packagepath,
+                                cache=discovery_cache)
+    if discovery_cache:
+        discovery_cache.save()
 
     target = target_cfg.name
 
@@ -737,10 +910,14 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
         targets.extend(extra_packages)
         target_cfg.extra_dependencies = extra_packages
 
-    deps = packaging.get_deps_for_targets(pkg_cfg, targets)
+    package_graph = packaging.PackageGraph(pkg_cfg)
+    deps = profiler.call("get_deps_for_targets", package_graph.get_deps,
+                         targets)
 
     from cuddlefish.manifest import build_manifest, ModuleNotFoundError, \
                                     BadChromeMarkerError
+    from cuddlefish.cache import ScanCache, GraphCache, LocaleCache, \
+                                XPIEntryCache, XPIOutputCache, get_cache_dir
     # Figure out what loader files should be scanned. This is normally
     # computed inside packaging.generate_build_for_target(), by the first
     # dependent package that defines a "loader" property in its package.json.
@@ -760,16 +937,75 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
     loader_modules = [("addon-sdk", "lib", "sdk/loader/cuddlefish", cuddlefish_js_path)]
     scan_tests = command == "test"
 
+    scan_cache = None
+    graph_cache = None
+    locale_cache = None
+    if not options.no_cache:
+        if not options.no_scan_cache:
+            # scan results are shared by every add-on built with this SDK
+            scan_cache = ScanCache(os.path.join(get_cache_dir(env_root),
+                                                "scan.json"))
+        graph_cache = GraphCache(os.path.join(
+            get_cache_dir(target_cfg.root_dir), "graph.json"))
+        locale_cache = LocaleCache(os.path.join(
+            get_cache_dir(target_cfg.root_dir), "locales.json"))
+
+    span = profiler.begin("build_manifest")
     try:
         manifest = build_manifest(target_cfg, pkg_cfg, deps, scan_tests,
                                   None, loader_modules,
-                                  abort_on_missing=options.abort_on_missing)
+                                  abort_on_missing=options.abort_on_missing,
+                                  scan_cache=scan_cache, jobs=options.jobs,
+                                  scan_processes=options.scan_processes,
+                                  graph_cache=graph_cache,
+                                  package_graph=package_graph)
     except ModuleNotFoundError, e:
         print str(e)
         sys.exit(1)
     except BadChromeMarkerError, e:
         # An error had already been displayed on stderr in manifest code
         sys.exit(1)
+    profiler.end(span)
+    if options.build_stats:
+        stats = manifest.get_stats()
+        if discovery_cache:
+            stats.append(("package discovery cache hits",
+                          discovery_cache.hits))
+            stats.append(("package discovery cache misses",
+                          discovery_cache.misses))
+        for (what, value) in stats:
+            print >>sys.stderr, "%s: %s" % (what, value)
+    selected_tests = None # the names of the test modules, if narrowed down
+    if command == "test" and options.changed_since:
+        from cuddlefish.changes import find_changed_files, ChangesError
+        roots = [target_cfg.root_dir]
+        for pkgname in manifest.get_used_packages():
+            root_dir = pkg_cfg.packages[pkgname].root_dir
+            if root_dir not in roots:
+                roots.append(root_dir)
+        try:
+            changed = find_changed_files(options.changed_since, roots)
+        except ChangesError, e:
+            print >>sys.stderr, "--changed-since: %s" % e
+            sys.exit(1)
+        testnames = manifest.get_affected_tests(changed)
+        if testnames is None:
+            print >>sys.stderr, ("Files other than modules changed since %s: "
+                                 "running all tests." % options.changed_since)
+        else:
+            if options.filter:
+                # only keep the tests that the filter would have run anyway
+                testnames = filter_test_names(target_cfg.name, testnames,
+                                              options.filter)
+            if not testnames:
+                print >>sys.stderr, ("No tests depend on files changed since "
+                                     "%s." % options.changed_since)
+                sys.exit(0)
+            print >>sys.stderr, ("Running the %d test module(s) depending on "
+                                 "files changed since %s." %
+                                 (len(testnames), options.changed_since))
+            options.filter = get_tests_filter(testnames, options.filter)
+            selected_tests = testnames
     used_deps = manifest.get_used_packages()
     if command == "test":
         # The test runner doesn't appear to link against any actual packages,
@@ -781,11 +1017,20 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
         if xp not in used_deps:
             used_deps.append(xp)
 
-    build = packaging.generate_build_for_target(
+    build = profiler.call("generate_build_for_target",
+        packaging.generate_build_for_target,
         pkg_cfg, target, used_deps,
         include_dep_tests=options.dep_tests,
-        is_running_tests=(command == "test")
+        is_running_tests=(command == "test"),
+        locale_cache=locale_cache,
+        jobs=options.jobs
         )
+    if locale_cache:
+        locale_cache.save()
+        if options.build_stats:
+            print >>sys.stderr, "locale cache hits: %d" % locale_cache.hits
+            print >>sys.stderr, ("locale cache misses: %d" %
+                                 locale_cache.misses)
 
     harness_options = {
         'jetpackID': jid,
@@ -820,7 +1065,8 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
     for option in inherited_options:
         harness_options[option] = getattr(options, option)
 
-    harness_options['metadata'] = packaging.get_metadata(pkg_cfg, used_deps)
+    harness_options['metadata'] = packaging.get_metadata(pkg_cfg, used_deps,
+                                                         package_graph)
 
     harness_options['sdkVersion'] = sdk_version
 
@@ -854,14 +1100,26 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
         # Pass a flag in order to force using sdk modules shipped in the xpi
         harness_options['force-use-bundled-sdk'] = True
 
+    if options.bundle_modules:
+        # Only the loader shipped in the xpi knows how to read bundles
+        if not options.force_use_bundled_sdk:
+            print >>sys.stderr, ("--bundle-modules can only be used with "
+                                 "--force-use-bundled-sdk.")
+            sys.exit(1)
+        if options.no_strip_xpi:
+            print >>sys.stderr, ("--bundle-modules and --no-strip-xpi "
+                                 "can't be used at the same time.")
+            sys.exit(1)
+
     from cuddlefish.rdf import gen_manifest, RDFUpdate
 
-    manifest_rdf = gen_manifest(template_root_dir=app_extension_dir,
-                                target_cfg=target_cfg,
-                                jid=jid,
-                                update_url=options.update_url,
-                                bootstrap=True,
-                                enable_mobile=options.enable_mobile)
+    manifest_rdf = profiler.call("gen_manifest", gen_manifest,
+                                 template_root_dir=app_extension_dir,
+                                 target_cfg=target_cfg,
+                                 jid=jid,
+                                 update_url=options.update_url,
+                                 bootstrap=True,
+                                 enable_mobile=options.enable_mobile)
 
     if command == "xpi" and options.update_link:
         if not options.update_link.startswith("https"):
@@ -884,7 +1142,7 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
         used_files = None # disables the filter, includes all files
 
     if command == 'xpi':
-        from cuddlefish.xpi import build_xpi
+        from cuddlefish.xpi import build_xpi, RELEASE_COMPRESSION
         # Generate extra options
         extra_harness_options = {}
         for kv in options.extra_harness_option_args:
@@ -896,15 +1154,66 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
         else:
           xpi_path = XPI_FILENAME % target_cfg.name
 
+        entry_cache = None
+        output_cache = None
+        if not options.no_cache:
+            entry_cache = XPIEntryCache(os.path.join(
+                get_cache_dir(target_cfg.root_dir), "xpi.json"))
+            output_cache = XPIOutputCache(os.path.join(
+                get_cache_dir(target_cfg.root_dir), "xpis"))
+
+        bundles = {}
+        if options.bundle_modules:
+            from cuddlefish.bundler import bundle_modules
+            (harness_options['bundles'], bundles,
+             bundled_files) = profiler.call("bundle_modules", bundle_modules,
+                                            manifest, options.bundle_sdk)
+            used_files -= bundled_files
+
+        # build_xpi() consumes it, and the size report needs it
+        packages = harness_options['packages'].copy()
+
         print >>stdout, "Exporting extension to %s." % xpi_path
-        build_xpi(template_root_dir=app_extension_dir,
-                  manifest=manifest_rdf,
-                  xpi_path=xpi_path,
-                  harness_options=harness_options,
-                  limit_to=used_files,
-                  extra_harness_options=extra_harness_options,
-                  bundle_sdk=True,
-                  pkgdir=options.pkgdir)
+        profiler.call("build_xpi", build_xpi,
+                      template_root_dir=app_extension_dir,
+                      manifest=manifest_rdf,
+                      xpi_path=xpi_path,
+                      harness_options=harness_options,
+                      limit_to=used_files,
+                      extra_harness_options=extra_harness_options,
+                      bundle_sdk=True,
+                      pkgdir=options.pkgdir,
+                      entry_cache=entry_cache,
+                      jobs=options.jobs,
+                      compression=RELEASE_COMPRESSION,
+                      output_cache=output_cache,
+                      extra_data=bundles)
+        if output_cache and options.build_stats:
+            print >>sys.stderr, ("xpi output cache hits: %d" %
+                                 output_cache.hits)
+            print >>sys.stderr, ("xpi output cache misses: %d" %
+                                 output_cache.misses)
+        if entry_cache and options.build_stats:
+            print >>sys.stderr, ("xpi entries reused: %d" %
+                                 entry_cache.reused)
+            print >>sys.stderr, ("xpi entries compressed: %d" %
+                                 entry_cache.compressed)
+        if options.size_report or options.size_budget:
+            from cuddlefish.sizereport import SizeReport, load_budget, \
+                                              BadBudgetError
+            report = SizeReport(xpi_path, manifest, packages)
+            if options.size_report:
+                print >>stdout, report.format()
+            if options.size_budget:
+                try:
+                    over = report.check_budget(load_budget(options.size_budget))
+                except BadBudgetError, e:
+                    print >>sys.stderr, str(e)
+                    sys.exit(1)
+                for message in over:
+                    print >>sys.stderr, message
+                if over:
+                    sys.exit(1)
     else:
         from cuddlefish.runner import run_app
 
@@ -927,32 +1236,106 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
 
         enable_e10s = options.enable_e10s or target_cfg.get('e10s', False)
 
+        results = None
+        durations = None
+        if command == "test":
+            from cuddlefish.results import TestResults, merge_results
+            from cuddlefish.cache import DurationsCache
+            if options.parseable:
+                results = TestResults()
+            if not options.no_cache:
+                durations = DurationsCache(os.path.join(
+                    get_cache_dir(target_cfg.root_dir), "test-durations.json"))
+
+        run_args = dict(harness_root_dir=app_extension_dir,
+                        manifest_rdf=manifest_rdf,
+                        harness_options=harness_options,
+                        app_type=options.app,
+                        binary=options.binary,
+                        profiledir=options.profiledir,
+                        verbose=options.verbose,
+                        parseable=options.parseable,
+                        enforce_timeouts=enforce_timeouts,
+                        logfile=options.logfile,
+                        addons=options.addons,
+                        args=options.cmdargs,
+                        extra_environment=extra_environment,
+                        norun=options.no_run,
+                        noquit=options.no_quit,
+                        used_files=used_files,
+                        enable_mobile=options.enable_mobile,
+                        mobile_app_name=options.mobile_app_name,
+                        env_root=env_root,
+                        is_running_tests=(command == "test"),
+                        overload_modules=options.overload_modules,
+                        bundle_sdk=options.bundle_sdk,
+                        pkgdir=options.pkgdir,
+                        enable_e10s=enable_e10s,
+                        no_connections=no_connections,
+                        jobs=options.jobs,
+                        install_xpi=options.install_xpi,
+                        results=results)
+        shards = []
+        if command == "test" and options.shards > 1:
+            from cuddlefish.shards import partition
+            testnames = sorted(set([testname for (testname, tme)
+                                    in manifest.test_entries]))
+            if selected_tests is not None:
+                testnames = [t for t in testnames if t in selected_tests]
+            if options.filter:
+                # each shard gets a filter of its own, which only keeps
+                # the test name part of this one
+                testnames = filter_test_names(target_cfg.name, testnames,
+                                              options.filter)
+            shards = partition(testnames, options.shards,
+                               durations and durations.entries or {})
+
         try:
-            retval = run_app(harness_root_dir=app_extension_dir,
-                             manifest_rdf=manifest_rdf,
-                             harness_options=harness_options,
-                             app_type=options.app,
-                             binary=options.binary,
-                             profiledir=options.profiledir,
-                             verbose=options.verbose,
-                             parseable=options.parseable,
-                             enforce_timeouts=enforce_timeouts,
-                             logfile=options.logfile,
-                             addons=options.addons,
-                             args=options.cmdargs,
-                             extra_environment=extra_environment,
-                             norun=options.no_run,
-                             noquit=options.no_quit,
-                             used_files=used_files,
-                             enable_mobile=options.enable_mobile,
-                             mobile_app_name=options.mobile_app_name,
-                             env_root=env_root,
-                             is_running_tests=(command == "test"),
-                             overload_modules=options.overload_modules,
-                             bundle_sdk=options.bundle_sdk,
-                             pkgdir=options.pkgdir,
-                             enable_e10s=enable_e10s,
-                             no_connections=no_connections)
+            if len(shards) > 1:
+                from cuddlefish.shards import run_shards
+                print >>sys.stderr, ("Running %d test modules in %d shards."
+                                     % (len(testnames), len(shards)))
+                shard_results = [TestResults() for shard in shards]
+                # the runners of the shards which are running, for a ^C
+                runners = []
+                def stop_shards():
+                    for runner in list(runners):
+                        try:
+                            runner.stop()
+                        except:
+                            pass
+                def run_shard(index, testnames):
+                    shard_options = harness_options.copy()
+                    shard_options['filter'] = get_tests_filter(testnames,
+                                                               options.filter)
+                    shard_args = run_args.copy()
+                    shard_args['harness_options'] = shard_options
+                    shard_args['results'] = shard_results[index]
+                    shard_args['runners'] = runners
+                    # run_app() adds to it
+                    shard_args['addons'] = options.addons and \
+                                           list(options.addons)
+                    if options.logfile:
+                        shard_args['logfile'] = "%s.%d" % (options.logfile,
+                                                           index + 1)
+                    return run_app(**shard_args)
+                try:
+                    retvals = run_shards(shards, run_shard, stop_shards)
+                finally:
+                    # a shard which timed out still has results to report
+                    results = merge_results(shard_results)
+                for (index, shard) in enumerate(shards):
+                    counts = shard_results[index].get_counts()
+                    print >>sys.stderr, ("Shard %d: %d test modules, %d tests "
+                                         "passed, %d failed, %d unfinished." %
+                                         (index + 1, len(shard),
+                                          counts["pass"], counts["fail"],
+                                          counts["error"]))
+                retval = 0
+                if [r for r in retvals if r != 0]:
+                    retval = -1
+            else:
+                retval = run_app(**run_args)
         except ValueError, e:
             print ""
             print "A given cfx option has an inappropriate value:"
@@ -964,4 +1347,28 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
                 retval = -1
             else:
                 raise
+        finally:
+            # even when a test hung and run_app() raised its timeout, which
+            # is when the reports matter most
+            if durations is not None and results is not None:
+                from cuddlefish.shards import get_module_durations
+                for (testname, seconds) in \
+                        get_module_durations(results).items():
+                    durations.record(testname, seconds)
+                durations.save()
+            if results is not None and results.end is not None:
+                if options.results_json:
+                    results.write_json(options.results_json)
+                    print >>sys.stderr, "Test results written to %s." % \
+                        options.results_json
+                if options.results_junit:
+                    results.write_junit(options.results_junit)
+                    print >>sys.stderr, "Test results written to %s." % \
+                        options.results_junit
+    profiler.end(run_span)
+    if options.profile_build:
+        profiler.save(options.profile_build)
+        print >>sys.stderr, profiler.summary(["build", "run"])
+        print >>sys.stderr, "Build profile written to %s." % \
+            options.profile_build
     sys.exit(retval)
@@ -0,0 +1,26 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Micro-benchmarks for the cfx build steps. Run them from an activated SDK
+(so that CUDDLEFISH_ROOT and PYTHONPATH are set), like:
+
+  python -m cuddlefish.benchmarks.scanner
+"""
+
+import time
+
+def best_of(repeat, f, *args, **kwargs):
+    """
+    Calls F REPEAT times and returns (fastest time in seconds, last result).
+    """
+    best = None
+    result = None
+    for i in range(repeat):
+        start = time.time()
+        result = f(*args, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
@@ -0,0 +1,124 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Compares an XPI that ships every module of the SDK (the lib/ directory of
+the addon-sdk package) as its own file, with one where they are packed by
+'cfx xpi --bundle-modules':
+
+  python -m cuddlefish.benchmarks.bundles [REPEAT]
+
+For each, it counts the entries and times reading the source of every
+module out of the XPI, as the loader does at startup: one entry at a time,
+or one bundle at a time. The time spent parsing the bundles is given
+apart, since simplejson is much slower at it than Firefox's JSON.parse().
+"""
+
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+import simplejson as json
+
+from cuddlefish import xpi, bundler
+from cuddlefish.manifest import ManifestEntry
+from cuddlefish.benchmarks import best_of
+
+FAKE_MANIFEST = '<RDF><!-- Extension metadata is here. --></RDF>'
+
+class SDKModules:
+    # enough of a ManifestBuilder for bundler.bundle_modules(): every .js
+    # file of lib/ as a module
+    def __init__(self, lib):
+        self.entries = []
+        for dirpath, dirnames, filenames in os.walk(lib):
+            for filename in filenames:
+                if not filename.endswith(".js"):
+                    continue
+                me = ManifestEntry()
+                me.packageName = "addon-sdk"
+                me.sectionName = "lib"
+                me.js_filename = os.path.join(dirpath, filename)
+                me.moduleName = xpi.make_zipfile_path(lib, me.js_filename)[:-3]
+                self.entries.append(me)
+    def get_module_entries(self):
+        return frozenset(self.entries)
+
+def build(xpi_path, lib, limit_to, extra_data={}):
+    env_root = os.environ["CUDDLEFISH_ROOT"]
+    harness_options = {"packages": {"addon-sdk": {"lib": lib}},
+                       "locale": {},
+                       "jetpackID": "benchmark@jetpack"}
+    xpi.build_xpi(template_root_dir=os.path.join(env_root, "app-extension"),
+                  manifest=FAKE_MANIFEST,
+                  xpi_path=xpi_path,
+                  harness_options=harness_options,
+                  limit_to=limit_to,
+                  extra_data=extra_data)
+
+def read_files(xpi_path, modules):
+    zf = zipfile.ZipFile(xpi_path, "r")
+    try:
+        return [zf.read("resources/addon-sdk/lib/%s.js" % me.moduleName)
+                for me in modules]
+    finally:
+        zf.close()
+
+def read_bundles(xpi_path, index):
+    zf = zipfile.ZipFile(xpi_path, "r")
+    try:
+        return dict([(arcname, zf.read(arcname))
+                     for arcname in set(index.values())])
+    finally:
+        zf.close()
+
+def parse_bundles(bundles, modules, index):
+    parsed = dict([(arcname, json.loads(data))
+                   for (arcname, data) in bundles.items()])
+    return [parsed[index[me.get_path()]][me.get_path()] for me in modules]
+
+def count_entries(xpi_path):
+    zf = zipfile.ZipFile(xpi_path, "r")
+    try:
+        return len(zf.infolist())
+    finally:
+        zf.close()
+
+def main(args):
+    repeat = 5
+    if args:
+        repeat = int(args[0])
+    lib = os.path.join(os.environ["CUDDLEFISH_ROOT"], "lib")
+    sdk = SDKModules(lib)
+    modules = sorted(sdk.get_module_entries(), key=lambda me: me.get_path())
+    index, bundles, bundled_files = bundler.bundle_modules(sdk, True)
+    unbundled = [me for me in modules if me.get_path() not in index]
+    modules = [me for me in modules if me.get_path() in index]
+    limit_to = set([me.js_filename for me in sdk.get_module_entries()])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        files_xpi = os.path.join(tmpdir, "files.xpi")
+        bundles_xpi = os.path.join(tmpdir, "bundles.xpi")
+        build(files_xpi, lib, limit_to)
+        build(bundles_xpi, lib, limit_to - bundled_files, bundles)
+        files_time, files = best_of(repeat, read_files, files_xpi, modules)
+        bundles_time, data = best_of(repeat, read_bundles, bundles_xpi, index)
+        parse_time, sources = best_of(repeat, parse_bundles, data, modules,
+                                      index)
+        print "reading %d modules (%d left unbundled), best of %d" % (
+            len(modules), len(unbundled), repeat)
+        print "  files:   %4d entries, %8.1f ms" % (count_entries(files_xpi),
+                                                    files_time * 1000)
+        print "  bundles: %4d entries, %8.1f ms (%.2fx)" % (
+            count_entries(bundles_xpi), bundles_time * 1000,
+            files_time / bundles_time)
+        print "  parsing the bundles:  %8.1f ms" % (parse_time * 1000)
+        if [source.encode("utf-8") for source in sources] != files:
+            print "  the sources differ!"
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,165 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Compares the single-pass jslexer scanner with the line-oriented regexp
+scanners it replaced, on every .js file below a directory (lib/sdk of the
+SDK by default):
+
+  python -m cuddlefish.benchmarks.scanner [DIRECTORY] [REPEAT]
+
+Besides the timings, it lists the modules for which both scanners disagree
+about the required modules, which is how false positives show up.
+"""
+
+import os
+import re
+import sys
+
+from cuddlefish import manifest
+from cuddlefish.benchmarks import best_of
+
+# The line-oriented scanners that jslexer replaced, as they were in
+# manifest.py, to compare against.
+
+COMMENT_PREFIXES = ["//", "/*", "*", "dump("]
+
+REQUIRE_RE = r"(?<![\'\"])require\s*\(\s*[\'\"]([^\'\"]+?)[\'\"]\s*\)"
+
+# detect the define idiom of the form:
+#   define("module name", ["dep1", "dep2", "dep3"], function() {})
+# by capturing the contents of the list in a group.
+DEF_RE = re.compile(r"(require|define)\s*\(\s*([\'\"][^\'\"]+[\'\"]\s*,)?\s*\[([^\]]+)\]")
+
+# Out of the async dependencies, do not allow quotes in them.
+DEF_RE_ALLOWED = re.compile(r"^[\'\"][^\'\"]+[\'\"]$")
+
+def scan_requirements_with_grep(fn, lines):
+    requires = {}
+    first_location = {}
+    for (lineno0, line) in enumerate(lines):
+        for clause in line.split(";"):
+            clause = clause.strip()
+            iscomment = False
+            for commentprefix in COMMENT_PREFIXES:
+                if clause.startswith(commentprefix):
+                    iscomment = True
+            if iscomment:
+                continue
+            mo = re.finditer(REQUIRE_RE, clause)
+            if mo:
+                for mod in mo:
+                    modname = mod.group(1)
+                    requires[modname] = {}
+                    if modname not in first_location:
+                        first_location[modname] = lineno0 + 1
+
+    # define() can happen across multiple lines, so join everyone up.
+    wholeshebang = "\n".join(lines)
+    for match in DEF_RE.finditer(wholeshebang):
+        # this should net us a list of string literals separated by commas
+        for strbit in match.group(3).split(","):
+            strbit = strbit.strip()
+            # There could be a trailing comma netting us just whitespace, so
+            # filter that out. Make sure that only string values with
+            # quotes around them are allowed, and no quotes are inside
+            # the quoted value.
+            if strbit and DEF_RE_ALLOWED.match(strbit):
+                modname = strbit[1:-1]
+                if modname not in ["exports"]:
+                    requires[modname] = {}
+                    # joining all the lines means we lose line numbers, so we
+                    # can't fill first_location[]
+
+    return requires, first_location
+
+CHROME_ALIASES_RE = [
+    (re.compile(r"Components\.classes"), "Cc"),
+    (re.compile(r"Components\.interfaces"), "Ci"),
+    (re.compile(r"Components\.utils"), "Cu"),
+    (re.compile(r"Components\.results"), "Cr"),
+    (re.compile(r"Components\.manager"), "Cm"),
+    ]
+OTHER_CHROME = re.compile(r"Components\.[a-zA-Z]")
+
+def find_bad_chrome_with_grep(lines):
+    old_chrome = set() # i.e. "Cc" when we see "Components.classes"
+    old_chrome_lines = [] # list of (lineno, line.strip()) tuples
+    for lineno,line in enumerate(lines):
+        line = line.strip()
+        iscomment = False
+        for commentprefix in COMMENT_PREFIXES:
+            if line.startswith(commentprefix):
+                iscomment = True
+                break
+        if iscomment:
+            continue
+        old_chrome_in_this_line = set()
+        for (regexp,alias) in CHROME_ALIASES_RE:
+            if regexp.search(line):
+                old_chrome_in_this_line.add(alias)
+        if not old_chrome_in_this_line:
+            if OTHER_CHROME.search(line):
+                old_chrome_in_this_line.add("components")
+        old_chrome.update(old_chrome_in_this_line)
+        if old_chrome_in_this_line:
+            old_chrome_lines.append( (lineno+1, line) )
+    if not old_chrome:
+        return None
+    return old_chrome, old_chrome_lines
+
+def read_modules(top):
+    modules = []
+    for dirpath, dirnames, filenames in os.walk(top):
+        for filename in sorted(filenames):
+            if filename.endswith(".js"):
+                fn = os.path.join(dirpath, filename)
+                modules.append( (fn, open(fn, "r").readlines()) )
+    return modules
+
+def scan_with_grep(modules):
+    results = {}
+    for (fn, lines) in modules:
+        requires, locations = scan_requirements_with_grep(fn, lines)
+        chrome = find_bad_chrome_with_grep(lines)
+        results[fn] = (requires, chrome)
+    return results
+
+def scan_with_lexer(modules):
+    results = {}
+    for (fn, lines) in modules:
+        requires, locations, chrome = manifest.scan_js(fn, lines)
+        results[fn] = (requires, chrome)
+    return results
+
+def main(args):
+    top = os.path.join(os.environ["CUDDLEFISH_ROOT"], "lib", "sdk")
+    repeat = 5
+    if args:
+        top = args[0]
+    if len(args) > 1:
+        repeat = int(args[1])
+    modules = read_modules(top)
+    size = sum([len("".join(lines)) for (fn, lines) in modules])
+    print "scanning %d modules (%d bytes) in %s, best of %d" % (
+        len(modules), size, top, repeat)
+
+    grep_time, grep_results = best_of(repeat, scan_with_grep, modules)
+    lexer_time, lexer_results = best_of(repeat, scan_with_lexer, modules)
+    print "  line scanners: %8.1f ms" % (grep_time * 1000)
+    print "  jslexer:       %8.1f ms (%.2fx)" % (lexer_time * 1000,
+                                                 grep_time / lexer_time)
+
+    for (fn, lines) in modules:
+        old = set(grep_results[fn][0])
+        new = set(lexer_results[fn][0])
+        if old != new:
+            print "  %s:" % os.path.relpath(fn, top)
+            if old - new:
+                print "    only line scanners: %s" % ", ".join(sorted(old - new))
+            if new - old:
+                print "    only jslexer:       %s" % ", ".join(sorted(new - old))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Times build_xpi() on an XPI that bundles the whole SDK (the lib/ directory
+of the addon-sdk package), compressing with one thread and with JOBS
+threads:
+
+  python -m cuddlefish.benchmarks.xpi [JOBS] [REPEAT]
+
+and checks that both XPIs have the same entries.
+"""
+
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+
+from cuddlefish import xpi
+from cuddlefish.benchmarks import best_of
+
+FAKE_MANIFEST = '<RDF><!-- Extension metadata is here. --></RDF>'
+
+def build(xpi_path, jobs):
+    env_root = os.environ["CUDDLEFISH_ROOT"]
+    harness_options = {"packages": {"addon-sdk": {
+                           "lib": os.path.join(env_root, "lib")}},
+                       "locale": {},
+                       "jetpackID": "benchmark@jetpack"}
+    xpi.build_xpi(template_root_dir=os.path.join(env_root, "app-extension"),
+                  manifest=FAKE_MANIFEST,
+                  xpi_path=xpi_path,
+                  harness_options=harness_options,
+                  jobs=jobs)
+
+def read_entries(xpi_path):
+    # install.rdf and harness-options.json are stamped with the current time
+    zf = zipfile.ZipFile(xpi_path, "r")
+    try:
+        return [(zinfo.filename, zinfo.date_time, zinfo.CRC,
+                 xpi.read_raw(zf, zinfo)) for zinfo in zf.infolist()
+                if zinfo.filename not in ("install.rdf",
+                                          "harness-options.json")]
+    finally:
+        zf.close()
+
+def main(args):
+    jobs = 4
+    repeat = 3
+    if args:
+        jobs = int(args[0])
+    if len(args) > 1:
+        repeat = int(args[1])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        serial_xpi = os.path.join(tmpdir, "serial.xpi")
+        parallel_xpi = os.path.join(tmpdir, "parallel.xpi")
+        serial_time, ignored = best_of(repeat, build, serial_xpi, 1)
+        parallel_time, ignored = best_of(repeat, build, parallel_xpi, jobs)
+        entries = read_entries(serial_xpi)
+        size = os.stat(serial_xpi).st_size
+        print "building an XPI of %d entries (%d bytes), best of %d" % (
+            len(entries), size, repeat)
+        print "  1 thread:   %8.1f ms" % (serial_time * 1000)
+        print "  %d threads: %8.1f ms (%.2fx)" % (jobs, parallel_time * 1000,
+                                                 serial_time / parallel_time)
+        if read_entries(parallel_xpi) != entries:
+            print "  the XPIs differ!"
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Packs the modules of a manifest into a few bundle files, for 'cfx xpi
+--bundle-modules'. A bundle is a JSON object which maps the manifest path
+of each of its modules (the id the loader knows the module by, like
+"sdk/self") to its source. harness-options.json gets a "bundles" index
+that maps each bundled path to its bundle, relative to the root of the XPI.
+The loader reads a bundle the first time it needs one of its modules, and
+evaluates them all from there instead of opening their files one by one.
+
+Only the loader shipped in the XPI knows about bundles, hence
+--force-use-bundled-sdk.
+"""
+
+import simplejson as json
+
+BUNDLE_DIR = "bundles"
+
+# start a new bundle rather than grow one past this size, so that loading
+# one module doesn't mean reading and parsing a whole package
+MAX_BUNDLE_SIZE = 256*1024
+
+# bootstrap.js loads the loader from its files, before there is anything to
+# read bundles with
+UNBUNDLED_MODULES = set(["toolkit/loader", "sdk/loader/cuddlefish"])
+
+# modules loaded by URL, with Cu.import() or into frame scripts: they run in
+# the loader of toolkit/require, which knows nothing of bundles, so they and
+# everything they require stay files
+URL_LOADED_MODULES = set(["toolkit/require"])
+URL_LOADED_PREFIXES = ("framescript/",)
+
+def is_url_loaded(path):
+    return path in URL_LOADED_MODULES or path.startswith(URL_LOADED_PREFIXES)
+
+def get_unbundled_entries(manifest):
+    """
+    Returns the ManifestEntries which must stay files: the loader, the
+    modules loaded by URL along with what they require, and the modules
+    that are require()d by a name ending in .js, which is how modules like
+    sdk/content/sandbox make sure that a file they load by URL (a content
+    or chrome worker) is shipped.
+    """
+    unbundled = set()
+    pending = []
+    for me in manifest.get_module_entries():
+        if me.get_path() in UNBUNDLED_MODULES:
+            unbundled.add(me)
+        if is_url_loaded(me.get_path()):
+            pending.append(me)
+        for (reqname, them) in me.requirements.items():
+            if reqname.endswith(".js") and not isinstance(them, basestring):
+                unbundled.add(them)
+    seen = set()
+    while pending:
+        me = pending.pop()
+        if me in seen:
+            continue
+        seen.add(me)
+        unbundled.add(me)
+        for them in me.requirements.values():
+            if not isinstance(them, basestring):
+                pending.append(them)
+    return unbundled
+
+def bundle_modules(manifest, bundle_sdk_modules, max_size=MAX_BUNDLE_SIZE):
+    """
+    Groups the lib/ modules of MANIFEST that go in the XPI (see
+    ManifestBuilder.get_used_files()) by package, in bundles of up to
+    MAX_SIZE bytes of source, unless a single module is larger. Returns
+    (index, bundles, bundled_files): the "bundles" index for
+    harness-options.json, {arcname: data} for the bundle files, and the
+    set of the module files which don't need to be in the XPI any more.
+    """
+    unbundled = get_unbundled_entries(manifest)
+    by_package = {}
+    for me in manifest.get_module_entries():
+        if me.sectionName != "lib" or me in unbundled:
+            continue
+        # Only ship SDK files if we are told to do so
+        if me.packageName == "addon-sdk" and not bundle_sdk_modules:
+            continue
+        by_package.setdefault(me.packageName, []).append(me)
+
+    index = {}
+    bundles = {}
+    bundled_files = set()
+    for package in sorted(by_package):
+        groups = [[]]
+        size = 0
+        entries = sorted(by_package[package], key=lambda me: me.get_path())
+        for me in entries:
+            source = open(me.js_filename, "rb").read().decode("utf-8")
+            if groups[-1] and size + len(source) > max_size:
+                groups.append([])
+                size = 0
+            groups[-1].append((me, source))
+            size += len(source)
+        for (number, group) in enumerate(groups):
+            arcname = "%s/%s-%d.json" % (BUNDLE_DIR, package, number)
+            sources = {}
+            for (me, source) in group:
+                index[me.get_path()] = arcname
+                sources[me.get_path()] = source
+                bundled_files.add(me.js_filename)
+            bundles[arcname] = json.dumps(sources, sort_keys=True)
+    return index, bundles, bundled_files
@@ -0,0 +1,521 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import hashlib
+import tempfile
+import simplejson as json
+
+# All of cfx's on-disk caches live in a directory with this name. Global
+# caches (shared by every add-on built with this SDK) go into the SDK root,
+# per-addon caches go into the add-on's package directory. The name is
+# listed in util.IGNORED_DIRS so that it never ends up in an XPI.
+CACHE_DIRNAME = ".cfx-cache"
+
+def get_cache_dir(root):
+    return os.path.join(root, CACHE_DIRNAME)
+
+def load_json_cache(path, version):
+    """
+    Returns the entries stored in the cache file at PATH, or an empty dict
+    if the file is missing, unreadable, or was written by a different
+    VERSION of the cache format. A cache is only ever an optimization, so
+    a broken one is treated like an empty one.
+    """
+    try:
+        data = json.loads(open(path, "rb").read())
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("version") != version:
+        return {}
+    entries = data.get("entries")
+    if not isinstance(entries, dict):
+        return {}
+    return entries
+
+def save_json_cache(path, version, entries):
+    """
+    Atomically replaces the cache file at PATH. Errors are ignored: the SDK
+    may live in a read-only location, and concurrent cfx processes may race
+    to write the same cache (the last writer wins).
+    """
+    tmpname = None
+    try:
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(json.dumps({"version": version, "entries": entries}))
+        finally:
+            f.close()
+        if os.name == "nt" and os.path.exists(path):
+            # rename() does not replace existing files on windows
+            os.remove(path)
+        os.rename(tmpname, path)
+        tmpname = None
+    except (IOError, OSError):
+        pass
+    if tmpname and os.path.exists(tmpname):
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+
+def to_str(s):
+    # simplejson hands back unicode strings, while names read from .js files
+    # are utf-8 byte strings. Convert back so cached and freshly scanned
+    # names compare and hash identically.
+    if isinstance(s, unicode):
+        return s.encode("utf-8")
+    return s
+
+class ScanCache:
+    """
+    Persistent cache of manifest.scan_js() results. Entries are keyed by the
+    absolute path of the scanned module and are only used while the size,
+    mtime and SHA-256 of that file still match what was recorded. VERSION
+    must change whenever scan_js() starts finding different things.
+    """
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_json_cache(path, self.VERSION)
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, fn, js_hash):
+        fn = os.path.abspath(fn)
+        entry = self.entries.get(fn)
+        if entry is None or entry.get("sha256") != js_hash:
+            self.misses += 1
+            return None
+        info = os.stat(fn)
+        if entry.get("size") != info.st_size:
+            self.misses += 1
+            return None
+        if entry.get("mtime") != info.st_mtime:
+            # same content, merely touched: keep the entry fresh
+            entry["mtime"] = info.st_mtime
+            self.dirty = True
+        self.hits += 1
+        requires = dict([(to_str(name), {}) for name in entry["requires"]])
+        locations = dict([(to_str(name), lineno)
+                          for (name, lineno) in entry["locations"].items()])
+        chrome = entry["chrome"]
+        if chrome is not None:
+            chrome = (set([to_str(c) for c in chrome["needs"]]),
+                      [(lineno, to_str(line))
+                       for (lineno, line) in chrome["lines"]])
+        return requires, locations, chrome
+
+    def store(self, fn, js_hash, scanned):
+        fn = os.path.abspath(fn)
+        requires, locations, chrome = scanned
+        if chrome is not None:
+            needs, lines = chrome
+            chrome = {"needs": sorted(needs), "lines": lines}
+        info = os.stat(fn)
+        entry = {"sha256": js_hash,
+                 "size": info.st_size,
+                 "mtime": info.st_mtime,
+                 "requires": sorted(requires.keys()),
+                 "locations": locations,
+                 "chrome": chrome,
+                 }
+        try:
+            json.dumps(entry)
+        except UnicodeDecodeError:
+            # not utf-8: such modules are rare, just rescan them every time
+            return
+        self.entries[fn] = entry
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            save_json_cache(self.path, self.VERSION, self.entries)
+            self.dirty = False
+
+def listing_digest(names):
+    # what we compare to tell whether a directory still holds the same names
+    names = sorted([os.path.normcase(name) for name in names])
+    return hashlib.sha1("\n".join(names)).hexdigest()
+
+class GraphCache:
+    """
+    Persistent per-addon cache of the module graph that ManifestBuilder
+    derives. It records the SHA-256 of every file the build hashed, along
+    with its size and mtime, and the require() resolutions of the builder.
+    Each resolution lists the directories that were consulted to answer
+    it, and each requiring module lists the resolutions it used, with its
+    own SHA-256. The resolutions are only reused while the resolution
+    inputs (the packages, their search paths and dependencies) are the
+    same, and then one by one: a resolution is dropped when one of its
+    directories changed, and a module's resolutions are dropped when the
+    module did.
+    """
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        entries = load_json_cache(path, self.VERSION)
+        self.files = entries.get("files", {})
+        self.inputs = entries.get("inputs")
+        self.dirs = entries.get("dirs", {}) # dirname: [mtime, digest]
+        self.resolutions = entries.get("resolutions", [])
+        self.modules = entries.get("modules", {}) # js: [sha256, [index]]
+        self.dirty = False
+        self.hash_hits = 0
+        self.hash_misses = 0
+
+    def get_hash(self, fn):
+        # returns the SHA-256 of FN if it hasn't changed, or None
+        entry = self.files.get(os.path.abspath(fn))
+        if entry is not None:
+            (size, mtime, sha256) = entry
+            try:
+                info = os.stat(fn)
+            except OSError:
+                info = None
+            if info and (size, mtime) == (info.st_size, info.st_mtime):
+                self.hash_hits += 1
+                return to_str(sha256)
+        self.hash_misses += 1
+        return None
+
+    def set_hash(self, fn, sha256):
+        info = os.stat(fn)
+        self.files[os.path.abspath(fn)] = [info.st_size, info.st_mtime, sha256]
+        self.dirty = True
+
+    def get_resolutions(self, inputs):
+        """
+        Returns the (resolutions, modules, dirs) recorded by
+        set_resolutions(), or ([], {}, {}) if INPUTS (a string) changed.
+        DIRS only has the directories which haven't changed: the ones with
+        the same mtime, or else the same names in them, since saving a file
+        by renaming a new copy over it touches its directory but doesn't
+        add or remove anything.
+        """
+        if self.inputs != inputs:
+            return [], {}, {}
+        dirs = {}
+        for (dirname, (mtime, digest)) in self.dirs.items():
+            try:
+                current = os.stat(dirname).st_mtime
+            except OSError:
+                current = None
+            if current == mtime:
+                dirs[dirname] = [mtime, digest]
+                continue
+            if current is None:
+                continue
+            try:
+                names = os.listdir(dirname)
+            except OSError:
+                continue
+            if listing_digest(names) == digest:
+                dirs[dirname] = [current, digest]
+        return self.resolutions, self.modules, dirs
+
+    def set_resolutions(self, inputs, resolutions, modules, dirs):
+        # RESOLUTIONS must be a list of JSON-serializable things, made of
+        # lists rather than tuples so that they compare equal to what we
+        # load. MODULES maps a requiring module to [sha256, [indexes into
+        # RESOLUTIONS]], DIRS maps a directory to [mtime, listing_digest()].
+        if (inputs, resolutions, modules, dirs) != (self.inputs,
+                                                    self.resolutions,
+                                                    self.modules, self.dirs):
+            self.inputs = inputs
+            self.resolutions = resolutions
+            self.modules = modules
+            self.dirs = dirs
+            self.dirty = True
+
+    def save(self, used_files=None):
+        # USED_FILES limits the hashes we keep to those files, so that
+        # files which are no longer part of the add-on get forgotten
+        if used_files is not None:
+            used_files = set([os.path.abspath(fn) for fn in used_files])
+            for fn in self.files.keys():
+                if fn not in used_files:
+                    del self.files[fn]
+                    self.dirty = True
+        if self.dirty:
+            save_json_cache(self.path, self.VERSION,
+                            {"files": self.files,
+                             "inputs": self.inputs,
+                             "dirs": self.dirs,
+                             "resolutions": self.resolutions,
+                             "modules": self.modules,
+                             })
+            self.dirty = False
+
+def _stamp(path):
+    # what we compare to tell whether PATH changed: None if it is missing
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return [info.st_size, info.st_mtime]
+
+# the keys of a package config which hold directory names
+PATH_KEYS = ["root_dir", "lib", "tests", "doc", "data", "packages", "locale"]
+
+class DiscoveryCache:
+    """
+    Persistent cache of what packaging.build_config() finds on disk: the
+    package directories in each directory it scans, and the config that
+    packaging.get_config_in_dir() derives for each package. A listing is
+    reused while the mtime of its directory is unchanged. A package config
+    is reused while its package.json, its directory and its lib
+    directories (which is where get_config_in_dir() looks for things) all
+    have the same size and mtime as when it was recorded.
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        entries = load_json_cache(path, self.VERSION)
+        self.listings = entries.get("listings", {})
+        self.configs = entries.get("configs", {})
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def get_listing(self, dirname):
+        # returns the package directories found in DIRNAME, or None
+        entry = self.listings.get(os.path.abspath(dirname))
+        if entry is not None and entry["stamp"] == _stamp(dirname):
+            self.hits += 1
+            return [to_str(path) for path in entry["paths"]]
+        self.misses += 1
+        return None
+
+    def set_listing(self, dirname, paths):
+        self.listings[os.path.abspath(dirname)] = {"stamp": _stamp(dirname),
+                                                  "paths": paths}
+        self.dirty = True
+
+    def get_config(self, path):
+        """
+        Returns a fresh copy of the config dict recorded for the package in
+        PATH, or None.
+        """
+        entry = self.configs.get(os.path.abspath(path))
+        if entry is not None:
+            for (watched, stamp) in entry["stamps"]:
+                if _stamp(watched) != stamp:
+                    break
+            else:
+                self.hits += 1
+                config = json.loads(entry["config"])
+                for key in PATH_KEYS:
+                    if isinstance(config.get(key), list):
+                        config[key] = [to_str(d) for d in config[key]]
+                    elif key in config:
+                        config[key] = to_str(config[key])
+                return config
+        self.misses += 1
+        return None
+
+    def set_config(self, path, config, watched):
+        # WATCHED are the files and directories which CONFIG was derived from
+        try:
+            # stored as a string, so that get_config() returns a new copy
+            config = json.dumps(config)
+        except (TypeError, UnicodeDecodeError):
+            return
+        self.configs[os.path.abspath(path)] = {
+            "stamps": [[os.path.abspath(fn), _stamp(fn)] for fn in watched],
+            "config": config,
+            }
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            save_json_cache(self.path, self.VERSION,
+                            {"listings": self.listings,
+                             "configs": self.configs})
+            self.dirty = False
+
+class LocaleCache:
+    """
+    Persistent per-addon cache of parsed .properties files, with their
+    plural forms already normalized. Entries are keyed by the SHA-256 of the
+    file, so a locale file is only parsed again when its content changes.
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_json_cache(path, self.VERSION)
+        self.used = set()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, sha256):
+        # the dict we return is shared: callers must not modify it
+        content = self.entries.get(sha256)
+        if content is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.add(sha256)
+        return content
+
+    def store(self, sha256, content):
+        self.entries[sha256] = content
+        self.used.add(sha256)
+        self.dirty = True
+
+    def save(self):
+        # forget the files which are not part of the add-on anymore
+        for sha256 in self.entries.keys():
+            if sha256 not in self.used:
+                del self.entries[sha256]
+                self.dirty = True
+        if self.dirty:
+            save_json_cache(self.path, self.VERSION, self.entries)
+            self.dirty = False
+
+class XPIEntryCache:
+    """
+    Persistent per-addon record of the XPIs that build_xpi() made, for
+    incremental builds: for each XPI path, the SHA-256 of the file each of
+    its entries was made from, and the CRC, sizes and compression of the
+    entry, including the compression policy that applied. See
+    xpi.PreviousXPI.
+    """
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_json_cache(path, self.VERSION)
+        self.dirty = False
+        self.reused = 0 # entries copied from the previous XPI
+        self.compressed = 0 # entries compressed again
+
+    def get_entries(self, xpi_path):
+        entries = self.entries.get(os.path.abspath(xpi_path), {})
+        return dict([(to_str(arcname), [to_str(source[0])] + source[1:])
+                     for (arcname, source) in entries.items()])
+
+    def set_entries(self, xpi_path, entries):
+        self.entries[os.path.abspath(xpi_path)] = entries
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            save_json_cache(self.path, self.VERSION, self.entries)
+            self.dirty = False
+
+class DurationsCache:
+    """
+    Persistent per-addon record of how long things took to run the last time
+    they did, in seconds: the test modules of 'cfx test --shards', or the
+    targets of 'cfx testall'. It is used to schedule the longest ones first.
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_json_cache(path, self.VERSION)
+        self.dirty = False
+
+    def get(self, name, default=None):
+        return self.entries.get(name, default)
+
+    def record(self, name, seconds):
+        self.entries[name] = seconds
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            save_json_cache(self.path, self.VERSION, self.entries)
+            self.dirty = False
+
+def link_or_copy(src, dst, link=True):
+    """
+    Puts the file SRC at DST, replacing whatever is there: as a hard link
+    where the filesystem has them (and LINK is true), else as a copy. Once
+    linked, the two must never be written to in place.
+    """
+    if (hasattr(os.path, "samefile") and os.path.exists(dst)
+        and os.path.samefile(src, dst)):
+        # rename() would do nothing, and leave the temporary file behind
+        return
+    tmpname = dst + ".tmp"
+    if os.path.exists(tmpname):
+        os.remove(tmpname)
+    linked = False
+    if link:
+        try:
+            os.link(src, tmpname)
+            linked = True
+        except (AttributeError, OSError):
+            pass
+    if not linked:
+        shutil.copy(src, tmpname)
+    if os.name == "nt" and os.path.exists(dst):
+        # rename() does not replace existing files on windows
+        os.remove(dst)
+    os.rename(tmpname, dst)
+
+class XPIOutputCache:
+    """
+    Per-addon cache of whole XPIs, named by the digest of everything that
+    went into them (see xpi.XPIContents.get_digest()), so that building
+    the same XPI again only takes a copy of the one we already have. Only
+    the KEEP most recently used XPIs are kept. The XPIs go in and out as
+    copies, not links: the one a build outputs may be changed in place
+    afterwards, signed for instance.
+    """
+    def __init__(self, dirname, keep=5):
+        self.dirname = dirname
+        self.keep = keep
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, digest):
+        return os.path.join(self.dirname, digest + ".xpi")
+
+    def fetch(self, digest, xpi_path):
+        # puts the XPI with DIGEST at XPI_PATH, and returns whether we had it
+        path = self.get_path(digest)
+        if os.path.isfile(path):
+            try:
+                link_or_copy(path, xpi_path, link=False)
+                os.utime(path, None) # see prune()
+                self.hits += 1
+                return True
+            except (IOError, OSError):
+                pass
+        self.misses += 1
+        return False
+
+    def store(self, digest, xpi_path):
+        # errors are ignored, like in save_json_cache()
+        try:
+            if not os.path.isdir(self.dirname):
+                os.makedirs(self.dirname)
+            link_or_copy(xpi_path, self.get_path(digest), link=False)
+            self.prune()
+        except (IOError, OSError):
+            pass
+
+    def prune(self):
+        xpis = []
+        for name in os.listdir(self.dirname):
+            if name.endswith(".xpi"):
+                path = os.path.join(self.dirname, name)
+                xpis.append((os.path.getmtime(path), path))
+        xpis.sort(reverse=True)
+        for (mtime, path) in xpis[self.keep:]:
+            os.remove(path)
@@ -0,0 +1,96 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Finds the files that changed since a git revision or a point in time, for
+'cfx test --changed-since'.
+"""
+
+import os
+import time
+import subprocess
+from cuddlefish.util import filter_filenames, filter_dirnames
+
+class ChangesError(Exception):
+    pass
+
+TIMESTAMP_FORMATS = ["%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S",
+                     "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S"]
+
+def parse_timestamp(since):
+    """
+    Returns SINCE as seconds since the epoch if it looks like a timestamp
+    (seconds since the epoch, or a local date and time in one of the
+    TIMESTAMP_FORMATS), or None.
+
+      >>> parse_timestamp("1400000000")
+      1400000000.0
+      >>> parse_timestamp("HEAD~3") is None
+      True
+    """
+    try:
+        return float(since)
+    except ValueError:
+        pass
+    for format in TIMESTAMP_FORMATS:
+        try:
+            return time.mktime(time.strptime(since, format))
+        except ValueError:
+            pass
+    return None
+
+def git(args, cwd):
+    try:
+        p = subprocess.Popen(["git"] + args, cwd=cwd,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except EnvironmentError, e:
+        raise ChangesError("unable to run git: %s" % e)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        raise ChangesError("'git %s' failed: %s" % (" ".join(args),
+                                                    stderr.strip()))
+    return stdout
+
+def git_changed_files(rev, cwd):
+    """
+    Returns the absolute names of the files in the git checkout containing
+    CWD that differ from revision REV, including uncommitted changes and
+    new files which aren't ignored.
+    """
+    toplevel = git(["rev-parse", "--show-toplevel"], cwd).strip()
+    names = git(["diff", "--name-only", rev, "--"], cwd).splitlines()
+    names.extend(git(["ls-files", "--others", "--exclude-standard"],
+                     toplevel).splitlines())
+    return set([os.path.normpath(os.path.join(toplevel, name))
+                for name in names if name])
+
+def modified_files(timestamp, roots):
+    """
+    Returns the absolute names of the files below the ROOTS directories
+    which were modified after TIMESTAMP.
+    """
+    changed = set()
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = filter_dirnames(dirnames)
+            for filename in filter_filenames(filenames):
+                fn = os.path.join(dirpath, filename)
+                try:
+                    if os.stat(fn).st_mtime > timestamp:
+                        changed.add(os.path.normpath(os.path.abspath(fn)))
+                except OSError:
+                    pass
+    return changed
+
+def find_changed_files(since, roots):
+    """
+    Returns the absolute names of the files that changed since SINCE, which
+    is either a timestamp (see parse_timestamp()) or a git revision. ROOTS
+    are the directories to look at: for a git revision, the first one must
+    be inside the git checkout.
+    """
+    timestamp = parse_timestamp(since)
+    if timestamp is not None:
+        return modified_files(timestamp, roots)
+    return git_changed_files(since, roots[0])
@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+SHA-256 digests of files, as used in the manifest and the data maps.
+
+Files are hashed without reading them into memory all at once: small ones
+are read in chunks, large ones are mapped with mmap. Digests are remembered
+for the life of the process, keyed by the (device, inode, size, mtime) of
+the file, so a file which is hashed several times (by several builds in one
+'cfx testall', or twice in the same build) is only read once.
+"""
+
+import os
+import mmap
+import hashlib
+import threading
+from cuddlefish import profiler
+
+CHUNK_SIZE = 64*1024
+MMAP_THRESHOLD = 1024*1024 # files this big or bigger get mmap()ed
+# hash_files() uses threads when there is at least this much data to read
+PARALLEL_THRESHOLD = 4*1024*1024
+DEFAULT_JOBS = 4
+
+_digests = {} # maps (st_dev, st_ino, st_size, st_mtime) to hexdigest
+_lock = threading.Lock()
+
+class HashStats:
+    def __init__(self):
+        self.hits = 0 # digests found in memory
+        self.misses = 0 # files actually read
+        self.bytes_hashed = 0
+stats = HashStats()
+
+def _key(info):
+    return (info.st_dev, info.st_ino, info.st_size, info.st_mtime)
+
+def _lookup(info):
+    _lock.acquire()
+    try:
+        digest = _digests.get(_key(info))
+        if digest is not None:
+            stats.hits += 1
+        return digest
+    finally:
+        _lock.release()
+
+def _compute(fn, info):
+    span = profiler.begin("hash file", args={"file": fn})
+    h = hashlib.sha256()
+    f = open(fn, "rb")
+    try:
+        if info.st_size >= MMAP_THRESHOLD:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                h.update(m)
+            finally:
+                m.close()
+        else:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+    finally:
+        f.close()
+        profiler.end(span)
+    digest = h.hexdigest()
+    _lock.acquire()
+    try:
+        stats.misses += 1
+        stats.bytes_hashed += info.st_size
+        _digests[_key(info)] = digest
+    finally:
+        _lock.release()
+    return digest
+
+def hash_file(fn):
+    """
+    Returns the hex SHA-256 digest of the contents of the file FN.
+    """
+    info = os.stat(fn)
+    digest = _lookup(info)
+    if digest is None:
+        digest = _compute(fn, info)
+    return digest
+
+def hash_files(filenames, jobs=DEFAULT_JOBS):
+    """
+    Returns a list with the digest of each file in FILENAMES. The files which
+    are not known yet are hashed by JOBS threads if there is enough data to
+    make that worthwhile: hashlib lets go of the GIL while it works.
+    """
+    infos = [os.stat(fn) for fn in filenames]
+    digests = [_lookup(info) for info in infos]
+    todo = [i for i in range(len(filenames)) if digests[i] is None]
+    size = sum([infos[i].st_size for i in todo])
+    def compute(i):
+        return _compute(filenames[i], infos[i])
+    if jobs > 1 and len(todo) > 1 and size >= PARALLEL_THRESHOLD:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(jobs, len(todo)))
+        try:
+            results = pool.map(compute, todo)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [compute(i) for i in todo]
+    for (i, digest) in zip(todo, results):
+        digests[i] = digest
+    return digests
+
+def forget():
+    # for tests
+    _lock.acquire()
+    try:
+        _digests.clear()
+        stats.hits = stats.misses = stats.bytes_hashed = 0
+    finally:
+        _lock.release()
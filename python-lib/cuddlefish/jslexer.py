@@ -0,0 +1,195 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+A single-pass scanner that finds the dependencies and chrome uses of a
+JavaScript module, for the manifest builder.
+
+This is not a full tokenizer: it only stops where something interesting can
+start (a comment, a string, template or regexp literal, or one of the
+identifiers 'require', 'define' and 'Components') and lets the regexp engine
+skip everything else. It tracks enough state to never report a require()
+that appears inside a comment or a string literal.
+"""
+
+import re
+
+# The alternatives that can start at the current position. The order
+# matters: comments must win over a bare slash.
+_CODE = r"""
+    (?P<linecomment>//[^\n]*)
+  | (?P<blockcomment>/\*[\s\S]*?(?:\*/|\Z))
+  | (?P<starline>^[ \t]*\*(?!/)[^\n]*)
+  | (?P<string>'[^'\\\n]*(?:\\[\s\S][^'\\\n]*)*'(?![\w$])
+              |"[^"\\\n]*(?:\\[\s\S][^"\\\n]*)*"(?![\w$]))
+  | (?P<quote>['"])
+  | (?P<template>`)
+  | (?P<slash>/)
+  | (?P<word>(?<![\w$])(?:require|define|Components)(?![\w$]))
+"""
+CODE_RE = re.compile(_CODE, re.M | re.X)
+# inside ${...} of a template literal we also need to balance braces
+TEMPLATE_CODE_RE = re.compile(_CODE + r"""
+  | (?P<lbrace>\{)
+  | (?P<rbrace>\})
+""", re.M | re.X)
+
+# the rest of a template literal: stops at its end or at the next ${
+TEMPLATE_RE = re.compile(r"[^`\\$]*(?:(?:\\[\s\S]|\$(?!\{))[^`\\$]*)*(`|\$\{|\Z)")
+
+REGEXP_RE = re.compile(r"/(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/")
+
+# A block comment line which starts with a require() call. Modules use these
+# to make the linker package files it can't otherwise see (content scripts,
+# worker modules, ...), eg:
+#   /* Trick the linker into including these modules into XPI
+#   require('./content-worker.js');
+#   */
+HINT_RE = re.compile(r"""^[ \t]*require(?=\s*\()""", re.M)
+
+# require("foo")
+REQUIRE_CALL_RE = re.compile(
+    r"""\s*\(\s*(?:'([^'"\\\n]+)'|"([^'"\\\n]+)")\s*\)""")
+# define("name", [...]), define([...]) and require([...])
+ARRAY_CALL_RE = re.compile(r"""\s*\(\s*(?:['"][^'"]+['"]\s*,)?\s*\[([^\]]+)\]""")
+ARRAY_ITEM_RE = re.compile(r"""^['"][^'"]+['"]$""")
+# Components.classes
+COMPONENTS_RE = re.compile(r"\.([A-Za-z_$][\w$]*)")
+
+# After these keywords a slash starts a regexp literal, not a division.
+KEYWORDS_BEFORE_EXPRESSION = set(["return", "typeof", "instanceof", "in",
+                                  "of", "new", "delete", "void", "throw",
+                                  "case", "do", "else", "yield", "await"])
+IDENTIFIER_CHARS = set("abcdefghijklmnopqrstuvwxyz"
+                       "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$")
+
+def _regexp_allowed(text, pos):
+    # Decide whether the slash at POS starts a regexp literal by looking at
+    # the previous significant character. This is the usual heuristic, and
+    # when it guesses wrong we lose at most the rest of one line.
+    i = pos - 1
+    while i >= 0 and text[i] in " \t\r\n":
+        i -= 1
+    if i < 0:
+        return True
+    c = text[i]
+    if c in ")]}'\"`":
+        return False
+    if c in IDENTIFIER_CHARS:
+        j = i
+        while j >= 0 and text[j] in IDENTIFIER_CHARS:
+            j -= 1
+        return text[j+1:i+1] in KEYWORDS_BEFORE_EXPRESSION
+    return True
+
+def scan(text):
+    """
+    Scans the JavaScript source TEXT and returns a (deps, components) tuple.
+    DEPS is a list of (kind, name, lineno) tuples, in source order, where
+    kind is "require" for require("name") and "define" for names found in
+    the dependency array of define([...]) or require([...]). COMPONENTS is a
+    list of (property, lineno) tuples, one for each Components.property.
+    Line numbers are 1-based.
+
+      >>> scan('''var a = require("a"); // require("b")
+      ... /* require("c")
+      ...    Components.utils */
+      ... define(["d", 'e' + 'f'], function () { Components.classes; });''')
+      ([('require', 'a', 1), ('define', 'd', 4)], [('classes', 4)])
+
+    The one exception to skipping comments are lines of a block comment
+    (other than its first one) which start with a require() call: these
+    are reported with kind "hint", since modules use them on purpose to
+    make the linker include files it couldn't find otherwise.
+
+      >>> scan('''/* Trick the linker:
+      ... require('./worker.js');
+      ...  * require("not-me") */''')[0]
+      [('hint', './worker.js', 2)]
+
+    Lines whose first non-blank character is '*' are treated as comment
+    continuation lines, like the line-oriented scanners used to. A quote
+    which doesn't start a well-formed string literal (one which ends on the
+    same line and isn't directly followed by an identifier) is skipped, so
+    a stray quote can't hide the rest of the module.
+    """
+    deps = []
+    components = []
+    templates = [] # brace depth of each ${...} we are inside of
+    pos = 0
+    end = len(text)
+    line = 1
+    line_pos = 0
+    while pos < end:
+        if templates:
+            mo = TEMPLATE_CODE_RE.search(text, pos)
+        else:
+            mo = CODE_RE.search(text, pos)
+        if mo is None:
+            break
+        kind = mo.lastgroup
+        pos = mo.end()
+        if kind == "word":
+            word = mo.group(kind)
+            line += text.count("\n", line_pos, mo.start())
+            line_pos = mo.start()
+            if word == "Components":
+                call = COMPONENTS_RE.match(text, pos)
+                if call:
+                    components.append( (call.group(1), line) )
+                continue
+            if word == "require":
+                call = REQUIRE_CALL_RE.match(text, pos)
+                if call:
+                    deps.append( ("require", call.group(1) or call.group(2),
+                                  line) )
+                    continue
+            call = ARRAY_CALL_RE.match(text, pos)
+            if call:
+                offset = call.start(1)
+                for item in call.group(1).split(","):
+                    name = item.strip()
+                    # only plain string literals count: no expressions
+                    if name and ARRAY_ITEM_RE.match(name):
+                        name = name[1:-1]
+                        if name != "exports":
+                            start = offset + len(item) - len(item.lstrip())
+                            lineno = line + text.count("\n", line_pos, start)
+                            deps.append( ("define", name, lineno) )
+                    offset += len(item) + 1
+            # keep scanning right after the identifier: the literals in the
+            # call are then skipped like any others
+        elif kind == "blockcomment":
+            # the comment starts with "/*", so its first line never matches
+            for hint in HINT_RE.finditer(text, mo.start(), pos):
+                call = REQUIRE_CALL_RE.match(text, hint.end())
+                if call:
+                    line += text.count("\n", line_pos, hint.start())
+                    line_pos = hint.start()
+                    deps.append( ("hint", call.group(1) or call.group(2),
+                                  line) )
+        elif kind == "template":
+            pos = _skip_template(text, pos, templates)
+        elif kind == "slash":
+            if _regexp_allowed(text, mo.start()):
+                regexp = REGEXP_RE.match(text, mo.start())
+                if regexp:
+                    pos = regexp.end()
+        elif kind == "lbrace":
+            templates[-1] += 1
+        elif kind == "rbrace":
+            if templates[-1]:
+                templates[-1] -= 1
+            else:
+                # end of ${...}: back inside the template literal
+                templates.pop()
+                pos = _skip_template(text, pos, templates)
+        # comments, strings and stray quotes need no further work
+    return deps, components
+
+def _skip_template(text, pos, templates):
+    mo = TEMPLATE_RE.match(text, pos)
+    if mo.group(1) == "${":
+        templates.append(0)
+    return mo.end()
@@ -7,11 +7,15 @@ import os, sys, re, hashlib
 import simplejson as json
 SEP = os.path.sep
 from cuddlefish.util import filter_filenames, filter_dirnames
+from cuddlefish import jslexer, hashing, profiler
+from cuddlefish.cache import to_str, listing_digest
+from cuddlefish.packaging import PackageGraph
 
 # Load new layout mapping hashtable
 path = os.path.join(os.environ.get('CUDDLEFISH_ROOT'), "mapping.json")
 data = open(path, 'r').read()
 NEW_LAYOUT_MAPPING = json.loads(data)
+NEW_LAYOUT_MAPPING_HASH = hashlib.sha256(data).hexdigest()
 
 def js_zipname(packagename, modulename):
     return "%s-lib/%s.js" % (packagename, modulename)
@@ -95,12 +99,12 @@ class ManifestEntry:
                    isinstance(entry["requirements"][req], str)
         return entry
 
-    def add_js(self, js_filename):
+    def add_js(self, js_filename, js_hash=None):
         self.js_filename = js_filename
-        self.js_hash = hash_file(js_filename)
-    def add_docs(self, docs_filename):
+        self.js_hash = js_hash or hash_file(js_filename)
+    def add_docs(self, docs_filename, docs_hash=None):
         self.docs_filename = docs_filename
-        self.docs_hash = hash_file(docs_filename)
+        self.docs_hash = docs_hash or hash_file(docs_filename)
     def add_requirement(self, reqname, reqdata):
         self.requirements[reqname] = reqdata
     def add_data(self, datamap):
@@ -117,7 +121,26 @@ class ManifestEntry:
 
 
 def hash_file(fn):
-    return hashlib.sha256(open(fn,"rb").read()).hexdigest()
+    return hashing.hash_file(fn)
+
+# The worker functions of ManifestBuilder.prefetch(). They run in worker
+# threads or processes, and return None instead of raising: process_module()
+# will hit the same problem again and report it properly.
+
+def _try_hash_file(fn):
+    try:
+        return hash_file(fn)
+    except (IOError, OSError):
+        return None
+
+def _try_scan_file(fn):
+    span = profiler.begin("scan module", args={"file": fn})
+    try:
+        return scan_js(fn, open(fn, "r").readlines())
+    except (IOError, OSError):
+        return None
+    finally:
+        profiler.end(span)
 
 def get_datafiles(datadir):
     """
@@ -141,10 +164,13 @@ class DataMap:
         self.files_to_copy = []
         datamap = {}
         datadir = os.path.join(pkg.root_dir, "data")
-        for dataname in get_datafiles(datadir):
-            absname = os.path.join(datadir, dataname)
+        datanames = list(get_datafiles(datadir))
+        absnames = [os.path.join(datadir, dataname) for dataname in datanames]
+        # data/ may hold lots of big media files: hash them in parallel
+        digests = hashing.hash_files(absnames)
+        for (dataname, absname, digest) in zip(datanames, absnames, digests):
             zipname = datafile_zipname(pkg.name, dataname)
-            datamap[dataname] = hash_file(absname)
+            datamap[dataname] = digest
             self.files_to_copy.append( (zipname, absname) )
         self.data_manifest = to_json(datamap)
         self.data_manifest_hash = hashlib.sha256(self.data_manifest).hexdigest()
@@ -154,6 +180,50 @@ class DataMap:
 class BadChromeMarkerError(Exception):
     pass
 
+class FileIndex:
+    """
+    Answers 'does PATH exist?' from a listing of the directory that
+    would contain it, made the first time that directory is asked about,
+    instead of one stat() per question. The modification time of every
+    directory listed (None if it doesn't exist) is kept in self.mtimes, so
+    that a later build can tell whether files were added or removed since.
+    While self.consulted is a set, the directories asked about are added
+    to it.
+    """
+    def __init__(self):
+        self.dirs = {} # maps directory to the set of names in it
+        self.mtimes = {} # maps directory to its st_mtime, or None
+        self.consulted = None
+        self.lookups = 0 # questions answered from the listings
+        self.syscalls = 0 # listdir() and stat() calls made to list
+
+    def exists(self, path):
+        dirname, name = os.path.split(path)
+        dirname = os.path.normpath(dirname)
+        if dirname not in self.dirs:
+            self.dirs[dirname] = self.list(dirname)
+        if self.consulted is not None:
+            self.consulted.add(dirname)
+        self.lookups += 1
+        return os.path.normcase(name) in self.dirs[dirname]
+
+    def list(self, dirname):
+        self.syscalls += 2
+        try:
+            self.mtimes[dirname] = os.stat(dirname).st_mtime
+            names = os.listdir(dirname)
+        except OSError:
+            self.mtimes[dirname] = None
+            return set()
+        return set([os.path.normcase(name) for name in names])
+
+    def get_stamp(self, dirname):
+        # what cache.GraphCache records about a listed directory
+        mtime = self.mtimes[dirname]
+        if mtime is None:
+            return [None, None]
+        return [mtime, listing_digest(self.dirs[dirname])]
+
 class ModuleInfo:
     def __init__(self, package, section, name, js, docs):
         self.package = package
@@ -181,11 +251,16 @@ class ModuleInfo:
 
 class ManifestBuilder:
     def __init__(self, target_cfg, pkg_cfg, deps, extra_modules,
-                 stderr=sys.stderr, abort_on_missing=False):
+                 stderr=sys.stderr, abort_on_missing=False, scan_cache=None,
+                 jobs=1, scan_processes=False, graph_cache=None,
+                 package_graph=None):
         self.manifest = {} # maps (package,section,module) to ManifestEntry
         self.target_cfg = target_cfg # the entry point
         self.pkg_cfg = pkg_cfg # all known packages
         self.deps = deps # list of package names to search
+        if package_graph is None:
+            package_graph = PackageGraph(pkg_cfg)
+        self.package_graph = package_graph
         self.used_packagenames = set()
         self.stderr = stderr
         self.extra_modules = extra_modules
@@ -193,20 +268,54 @@ class ManifestBuilder:
         self.datamaps = {} # maps package name to DataMap instance
         self.files = [] # maps manifest index to (absfn,absfn) js/docs pair
         self.test_modules = [] # for runtime
+        self.test_entries = [] # (testname, ManifestEntry) for each test
         self.abort_on_missing = abort_on_missing # cfx eol
+        self.scan_cache = scan_cache # cache.ScanCache, or None
+        self.jobs = jobs # more than 1 enables prefetch()
+        self.scan_processes = scan_processes # prefetch() scans in processes
+        self.hashes = {} # maps filename to SHA-256, filled by prefetch()
+        self.scanned = {} # maps .js filename to scan_js() results, likewise
+        self.file_index = FileIndex() # lib/, tests/ and docs/ of each package
+        self.resolutions = {} # see resolve_req()
+        self.module_resolutions = {} # maps .js to the keys it resolved
+        self.graph_dirs = {} # unchanged directories, from the graph cache
+        self.resolution_hits = 0
+        self.resolution_misses = 0
+        self.graph_cache = graph_cache # cache.GraphCache, or None
+        if graph_cache:
+            self.load_graph()
 
     def build(self, scan_tests, test_filter_re):
         """
         process the top module, which recurses to process everything it reaches
         """
+        top_mi = None
         if "main" in self.target_cfg:
             top_mi = self.find_top(self.target_cfg)
+        runner_mi = None
+        test_mis = []
+        if scan_tests:
+            runner_mi = self._find_module_in_package("addon-sdk", "lib",
+                                                     "sdk/test/runner", [])
+            test_mis = self.find_tests(test_filter_re)
+        # include files used by the loader
+        extra_mis = []
+        for em in self.extra_modules:
+            (pkgname, section, modname, js) = em
+            extra_mis.append(ModuleInfo(self.pkg_cfg.packages[pkgname],
+                                        section, modname, js, None))
+
+        roots = [mi for mi in (top_mi, runner_mi) if mi]
+        roots.extend([tmi for (testname, tmi) in test_mis])
+        roots.extend(extra_mis)
+        self.prefetch(roots)
+
+        if top_mi:
             top_me = self.process_module(top_mi)
             self.top_path = top_me.get_path()
             self.datamaps[self.target_cfg.name] = DataMap(self.target_cfg)
         if scan_tests:
-            mi = self._find_module_in_package("addon-sdk", "lib", "sdk/test/runner", [])
-            self.process_module(mi)
+            self.process_module(runner_mi)
             # also scan all test files in all packages that we use. By making
             # a copy of self.used_packagenames first, we refrain from
             # processing tests in packages that our own tests depend upon. If
@@ -214,27 +323,15 @@ class ManifestBuilder:
             # tests in A depend upon modules from package B, we *don't* want
             # to run tests for package B.
             test_modules = []
-            dirnames = self.target_cfg["tests"]
-            if isinstance(dirnames, basestring):
-                dirnames = [dirnames]
-            dirnames = [os.path.join(self.target_cfg.root_dir, d)
-                        for d in dirnames]
-            for d in dirnames:
-                for filename in os.listdir(d):
-                    if filename.startswith("test-") and filename.endswith(".js"):
-                        testname = filename[:-3] # require(testname)
-                        if test_filter_re:
-                            if not re.search(test_filter_re, testname):
-                                continue
-                        tmi = ModuleInfo(self.target_cfg, "tests", testname,
-                                         os.path.join(d, filename), None)
-                        # scan the test's dependencies
-                        tme = self.process_module(tmi)
-                        test_modules.append( (testname, tme) )
+            for (testname, tmi) in test_mis:
+                # scan the test's dependencies
+                tme = self.process_module(tmi)
+                test_modules.append( (testname, tme) )
             # also add it as an artificial dependency of unit-test-finder, so
             # the runtime dynamic load can work.
             test_finder = self.get_manifest_entry("addon-sdk", "lib",
                                                   "sdk/deprecated/unit-test-finder")
+            self.test_entries = test_modules
             for (testname,tme) in test_modules:
                 test_finder.add_requirement(testname, tme)
                 # finally, tell the runtime about it, so they won't have to
@@ -244,13 +341,207 @@ class ManifestBuilder:
                 # Pass the absolute module path.
                 self.test_modules.append(tme.get_path())
 
-        # include files used by the loader
-        for em in self.extra_modules:
-            (pkgname, section, modname, js) = em
-            mi = ModuleInfo(self.pkg_cfg.packages[pkgname], section, modname,
-                            js, None)
+        for mi in extra_mis:
             self.process_module(mi)
 
+    def find_tests(self, test_filter_re):
+        # returns a list of (testname, ModuleInfo) tuples, one for each
+        # test-*.js file of the target package which matches test_filter_re
+        test_mis = []
+        dirnames = self.target_cfg["tests"]
+        if isinstance(dirnames, basestring):
+            dirnames = [dirnames]
+        dirnames = [os.path.join(self.target_cfg.root_dir, d)
+                    for d in dirnames]
+        for d in dirnames:
+            for filename in os.listdir(d):
+                if filename.startswith("test-") and filename.endswith(".js"):
+                    testname = filename[:-3] # require(testname)
+                    if test_filter_re:
+                        if not re.search(test_filter_re, testname):
+                            continue
+                    tmi = ModuleInfo(self.target_cfg, "tests", testname,
+                                     os.path.join(d, filename), None)
+                    test_mis.append( (testname, tmi) )
+        return test_mis
+
+    def prefetch(self, roots):
+        """
+        Hashes and scans all modules reachable from the ModuleInfo ROOTS
+        ahead of process_module(), one frontier of the module graph at a
+        time, in self.jobs worker threads (the scans go to as many processes
+        instead when self.scan_processes is set: they are CPU-bound).
+        process_module() then walks the graph in its usual depth-first order
+        using these results, so that the manifest and the warnings printed
+        are exactly those of a serial build. Problems like unreadable files
+        or bad require() names are ignored here and left for
+        process_module() to report. Does nothing unless self.jobs > 1.
+        """
+        if self.jobs <= 1:
+            return
+        from multiprocessing.pool import ThreadPool
+        scanners = None
+        if self.scan_processes:
+            # fork the scanning processes before starting any threads
+            import multiprocessing
+            scanners = multiprocessing.Pool(self.jobs)
+        threads = ThreadPool(self.jobs)
+        if scanners is None:
+            scanners = threads
+        try:
+            seen = set()
+            frontier = []
+            for mi in roots:
+                if mi.js not in seen:
+                    seen.add(mi.js)
+                    frontier.append(mi)
+            while frontier:
+                files = [mi.js for mi in frontier if mi.js not in self.hashes]
+                files.extend(set([mi.docs for mi in frontier
+                                  if mi.docs and mi.docs not in self.hashes]))
+                if self.graph_cache:
+                    unchanged = [fn for fn in files
+                                 if self.get_cached_hash(fn)]
+                    files = [fn for fn in files if fn not in unchanged]
+                for (fn, h) in zip(files, threads.map(_try_hash_file, files)):
+                    if h is not None:
+                        self.hashes[fn] = h
+                        if self.graph_cache:
+                            self.graph_cache.set_hash(fn, h)
+
+                to_scan = []
+                for mi in frontier:
+                    if mi.js in self.scanned or mi.js not in self.hashes:
+                        continue
+                    scanned = None
+                    if self.scan_cache:
+                        scanned = self.scan_cache.lookup(mi.js,
+                                                         self.hashes[mi.js])
+                    if scanned is None:
+                        to_scan.append(mi.js)
+                    else:
+                        self.scanned[mi.js] = scanned
+                results = scanners.map(_try_scan_file, to_scan)
+                for (js, scanned) in zip(to_scan, results):
+                    if scanned is not None:
+                        self.scanned[js] = scanned
+                        if self.scan_cache:
+                            self.scan_cache.store(js, self.hashes[js], scanned)
+
+                next_frontier = []
+                for mi in frontier:
+                    if mi.js not in self.scanned:
+                        continue
+                    requires = self.scanned[mi.js][0]
+                    for reqname in sorted(requires.keys()):
+                        if reqname == "chrome" or reqname.startswith("@"):
+                            continue
+                        try:
+                            them, new_reqname = self.resolve_req(mi, reqname,
+                                                                 [])
+                        except (BadModuleIdentifier, BadSection,
+                                UnreachablePrefixError):
+                            continue
+                        if them and them.js not in seen:
+                            seen.add(them.js)
+                            next_frontier.append(them)
+                frontier = next_frontier
+        finally:
+            threads.close()
+            threads.join()
+            if scanners is not threads:
+                scanners.close()
+                scanners.join()
+
+
+    def get_stats(self):
+        """
+        Returns a list of (description, value) pairs, for --build-stats
+        """
+        stats = [("modules in manifest", len(self.manifest))]
+        if self.jobs > 1:
+            stats.append(("modules prefetched", len(self.scanned)))
+        for cycle in self.package_graph.find_cycles():
+            stats.append(("package dependency cycle", ", ".join(cycle)))
+        stats.append(("resolution cache hits", self.resolution_hits))
+        stats.append(("resolution cache misses", self.resolution_misses))
+        stats.append(("file index lookups", self.file_index.lookups))
+        stats.append(("file index listing calls", self.file_index.syscalls))
+        stats.append(("stat calls saved",
+                      self.file_index.lookups - self.file_index.syscalls))
+        stats.append(("files hashed", hashing.stats.misses))
+        stats.append(("bytes hashed", hashing.stats.bytes_hashed))
+        stats.append(("hash memo hits", hashing.stats.hits))
+        if self.graph_cache:
+            stats.append(("graph cache resolutions loaded",
+                          self.resolutions_loaded))
+            stats.append(("graph cache hash hits", self.graph_cache.hash_hits))
+            stats.append(("graph cache hash misses",
+                          self.graph_cache.hash_misses))
+        if self.scan_cache:
+            stats.append(("scan cache hits", self.scan_cache.hits))
+            stats.append(("scan cache misses", self.scan_cache.misses))
+        return stats
+
+    def get_reverse_dependencies(self):
+        """
+        Returns a dict that maps each ManifestEntry to the set of entries
+        which require() it.
+        """
+        users = {}
+        for me in self.get_module_entries():
+            for them in me.requirements.values():
+                if isinstance(them, ManifestEntry):
+                    users.setdefault(them, set()).add(me)
+        return users
+
+    def get_affected_tests(self, changed_files):
+        """
+        Returns the names (like "test-foo") of the test modules that depend,
+        directly or not, on any of the files in CHANGED_FILES, a set of
+        absolute filenames. Returns None if we can't tell: when one of the
+        changed files isn't a module, but could still make a difference to
+        the tests, like a data file, or a package.json .
+        """
+        changed_files = set([os.path.normpath(fn) for fn in changed_files])
+        by_filename = {}
+        for me in self.get_module_entries():
+            fn = os.path.normpath(os.path.abspath(me.js_filename))
+            by_filename.setdefault(fn, []).append(me)
+        for fn in changed_files - set(by_filename):
+            if self.might_affect_tests(fn):
+                return None
+        affected = set()
+        pending = []
+        for fn in changed_files:
+            pending.extend(by_filename.get(fn, []))
+        users = self.get_reverse_dependencies()
+        while pending:
+            me = pending.pop()
+            if me not in affected:
+                affected.add(me)
+                pending.extend(users.get(me, []))
+        return [testname for (testname, tme) in self.test_entries
+                if tme in affected]
+
+    def might_affect_tests(self, fn):
+        # is FN, which is not a module in the manifest, a file of a used
+        # package that could still change the outcome of its tests?
+        for pkgname in self.get_used_packages():
+            pkg = self.pkg_cfg.packages[pkgname]
+            root = os.path.normpath(os.path.abspath(pkg.root_dir))
+            if not fn.startswith(root + os.sep):
+                continue
+            relname = fn[len(root + os.sep):]
+            if relname == "package.json":
+                return True
+            dirnames = (["data", "locale"] + pkg.get("lib", []) +
+                        pkg.get("tests", []))
+            for d in dirnames:
+                d = os.path.normpath(d)
+                if d != os.curdir and relname.startswith(d + os.sep):
+                    return not relname.endswith(".md")
+        return False
 
     def get_module_entries(self):
         return frozenset(self.manifest.values())
@@ -382,14 +673,13 @@ class ManifestBuilder:
         # create and claim the manifest row first
         me = self.get_manifest_entry(pkg.name, mi.section, mi.name)
 
-        me.add_js(mi.js)
+        me.add_js(mi.js, self.get_hash(mi.js))
         if mi.docs:
-            me.add_docs(mi.docs)
+            me.add_docs(mi.docs, self.get_hash(mi.docs))
 
-        js_lines = open(mi.js,"r").readlines()
-        requires, problems, locations = scan_module(mi.js,js_lines,self.stderr)
-        if problems:
-            # the relevant instructions have already been written to stderr
+        requires, locations, chrome = self.scan(mi.js, me.js_hash)
+        if chrome:
+            report_bad_chrome(mi.js, chrome, self.stderr)
             raise BadChromeMarkerError()
 
         # We update our requirements on the way out of the depth-first
@@ -440,48 +730,222 @@ class ManifestBuilder:
         return me
         #print "LEAVING", pkg.name, mi.name
 
+    def get_cached_hash(self, fn):
+        # returns the SHA-256 of FN if we already know it, or None
+        if fn not in self.hashes and self.graph_cache:
+            cached = self.graph_cache.get_hash(fn)
+            if cached:
+                self.hashes[fn] = cached
+        return self.hashes.get(fn)
+
+    def get_hash(self, fn):
+        file_hash = self.get_cached_hash(fn)
+        if file_hash is None:
+            file_hash = self.hashes[fn] = hash_file(fn)
+            if self.graph_cache:
+                self.graph_cache.set_hash(fn, file_hash)
+        return file_hash
+
+    def scan(self, js, js_hash):
+        if js in self.scanned:
+            return self.scanned[js]
+        # the scan cache lets us skip reading and scanning modules that
+        # haven't changed since a previous build
+        if self.scan_cache:
+            scanned = self.scan_cache.lookup(js, js_hash)
+            if scanned is not None:
+                return scanned
+        span = profiler.begin("scan module", args={"file": js})
+        js_lines = open(js,"r").readlines()
+        scanned = scan_js(js, js_lines)
+        profiler.end(span)
+        if self.scan_cache:
+            self.scan_cache.store(js, js_hash, scanned)
+        return scanned
+
     def find_req_for(self, from_module, reqname, looked_in, locations):
         # handle a single require(reqname) statement from from_module .
         # Return a uri that exists in self.manifest
         # Populate looked_in with places we looked.
-        def BAD(msg):
-            return BadModuleIdentifier(msg + " in require(%s) from %s" %
-                                       (reqname, from_module))
-
-        if not reqname:
-            raise BAD("no actual modulename")
+        mi, new_reqname = self.resolve_req(from_module, reqname, looked_in)
+        if new_reqname is not None:
+            # If the addon didn't explicitely told us to ignore deprecated
+            # require path, warn the developer:
+            # (target_cfg is the package.json file)
+            if not "ignore-deprecated-path" in self.target_cfg:
+                lineno = locations.get(reqname)
+                print >>self.stderr, "Warning: Use of deprecated require path:"
+                print >>self.stderr, "  In %s:%d:" % (from_module.js, lineno)
+                print >>self.stderr, "    require('%s')." % reqname
+                print >>self.stderr, "  New path should be:"
+                print >>self.stderr, "    require('%s')" % new_reqname
+        return self._handle_module(mi)
 
+    def resolve_req(self, from_module, reqname, looked_in):
+        # find the module that satisfies require(reqname) from from_module,
+        # without processing it. Returns a (ModuleInfo, new_reqname) tuple:
+        # the ModuleInfo is None if there is no such module, and new_reqname
+        # is None unless reqname is a deprecated path that we had to map to
+        # new_reqname. Populate looked_in with places we looked.
+        #
+        # Many modules require() the same names, so we remember the answers
+        # (including "not found") in self.resolutions, along with the
+        # directories consulted to find them
+        key = self.resolution_key(from_module, reqname)
+        if key in self.resolutions:
+            self.resolution_hits += 1
+            mi, new_reqname, searched, dirs = self.resolutions[key]
+        else:
+            self.resolution_misses += 1
+            searched = []
+            self.file_index.consulted = consulted = set()
+            try:
+                mi, new_reqname = self._resolve_req(from_module, reqname,
+                                                    searched)
+            finally:
+                self.file_index.consulted = None
+            self.resolutions[key] = (mi, new_reqname, searched,
+                                     sorted(consulted))
+        self.module_resolutions.setdefault(from_module.js, set()).add(key)
+        looked_in.extend(searched)
+        return mi, new_reqname
+
+    def resolution_key(self, from_module, reqname):
+        # everything that the result of resolve_req() depends on: the
+        # requiring package, the sections we search, and the module name,
+        # made absolute if it was relative
+        sections = tuple(self._lookfor_sections(from_module))
+        if reqname.startswith("./") or reqname.startswith("../"):
+            return (from_module.package.name, sections, "./",
+                    self._absolute_modname(from_module, reqname))
+        return (from_module.package.name, sections, "", reqname)
+
+    def get_resolution_inputs(self):
+        # everything besides the files themselves that resolve_req() looks
+        # at, as a string
+        packages = {}
+        for (name, pkg) in self.pkg_cfg.packages.items():
+            packages[name] = [pkg.root_dir, pkg.get("lib"), pkg.get("tests"),
+                              pkg.get("main"), pkg.get("dependencies")]
+        return json.dumps({"packages": packages,
+                           "deps": sorted(self.deps),
+                           "mapping": NEW_LAYOUT_MAPPING_HASH,
+                           }, sort_keys=True)
+
+    def load_graph(self):
+        # fill self.resolutions from the graph cache, with the resolutions
+        # of the modules which haven't changed, and only those of them
+        # whose directories haven't changed either
+        resolutions, modules, dirs = self.graph_cache.get_resolutions(
+            self.get_resolution_inputs())
+        loaded = {} # maps index in resolutions to key, or None if stale
+        def load(index):
+            if index in loaded:
+                return loaded[index]
+            (key, mi, new_reqname, looked_in, consulted) = resolutions[index]
+            loaded[index] = None
+            for dirname in consulted:
+                if dirname not in dirs:
+                    return None
+            (pkgname, sections, kind, modname) = key
+            key = (to_str(pkgname), tuple([to_str(s) for s in sections]),
+                   to_str(kind), to_str(modname))
+            if mi is not None:
+                (mi_pkgname, section, name, js, docs) = [to_str(x) for x in mi]
+                mi = ModuleInfo(self.pkg_cfg.packages[mi_pkgname], section,
+                                name, js, docs)
+            self.resolutions[key] = (mi, to_str(new_reqname),
+                                     [to_str(fn) for fn in looked_in],
+                                     [to_str(d) for d in consulted])
+            loaded[index] = key
+            return key
+        for (js, (sha256, indexes)) in modules.items():
+            js = to_str(js)
+            if not os.path.isfile(js) or self.get_hash(js) != sha256:
+                continue
+            keys = set([load(index) for index in indexes])
+            keys.discard(None)
+            self.module_resolutions[js] = keys
+        self.resolutions_loaded = len(self.resolutions)
+        self.graph_dirs = dict([(to_str(dirname), stamp)
+                                for (dirname, stamp) in dirs.items()])
+
+    def save_graph(self):
+        # only what the modules we know the hash of still refer to is kept
+        stamps = dict(self.graph_dirs)
+        for dirname in self.file_index.mtimes:
+            stamps[dirname] = self.file_index.get_stamp(dirname)
+        modules = {}
+        used = set()
+        for (js, keys) in self.module_resolutions.items():
+            if js in self.hashes:
+                modules[js] = (self.hashes[js], keys)
+                used.update(keys)
+        resolutions = []
+        indexes = {}
+        dirs = {}
+        for key in sorted(used):
+            (pkgname, sections, kind, modname) = key
+            (mi, new_reqname, looked_in, consulted) = self.resolutions[key]
+            if mi is not None:
+                mi = [mi.package.name, mi.section, mi.name, mi.js, mi.docs]
+            indexes[key] = len(resolutions)
+            resolutions.append([[pkgname, list(sections), kind, modname],
+                                mi, new_reqname, looked_in, consulted])
+            for dirname in consulted:
+                dirs[dirname] = stamps[dirname]
+        for (js, (sha256, keys)) in modules.items():
+            modules[js] = [sha256, sorted([indexes[key] for key in keys])]
+        self.graph_cache.set_resolutions(self.get_resolution_inputs(),
+                                         resolutions, modules, dirs)
+        self.graph_cache.save(self.hashes.keys())
+
+    def _lookfor_sections(self, from_module):
         # Allow things in tests/*.js to require both test code and real code.
         # But things in lib/*.js can only require real code.
         if from_module.section == "tests":
-            lookfor_sections = ["tests", "lib"]
+            return ["tests", "lib"]
         elif from_module.section == "lib":
-            lookfor_sections = ["lib"]
+            return ["lib"]
         else:
             raise BadSection(from_module.section)
-        modulename = from_module.name
+
+    def _absolute_modname(self, from_module, reqname):
+        def BAD(msg):
+            return BadModuleIdentifier(msg + " in require(%s) from %s" %
+                                       (reqname, from_module))
+        them = from_module.name.split("/")[:-1]
+        bits = reqname.split("/")
+        while bits[0] in (".", ".."):
+            if not bits:
+                raise BAD("no actual modulename")
+            if bits[0] == "..":
+                if not them:
+                    raise BAD("too many ..")
+                them.pop()
+            bits.pop(0)
+        return "/".join(them+bits)
+
+    def _resolve_req(self, from_module, reqname, looked_in):
+        def BAD(msg):
+            return BadModuleIdentifier(msg + " in require(%s) from %s" %
+                                       (reqname, from_module))
+
+        if not reqname:
+            raise BAD("no actual modulename")
+
+        lookfor_sections = self._lookfor_sections(from_module)
 
         #print " %s require(%s))" % (from_module, reqname)
 
         if reqname.startswith("./") or reqname.startswith("../"):
             # 1: they want something relative to themselves, always from
             # their own package
-            them = modulename.split("/")[:-1]
-            bits = reqname.split("/")
-            while bits[0] in (".", ".."):
-                if not bits:
-                    raise BAD("no actual modulename")
-                if bits[0] == "..":
-                    if not them:
-                        raise BAD("too many ..")
-                    them.pop()
-                bits.pop(0)
-            bits = them+bits
             lookfor_pkg = from_module.package.name
-            lookfor_mod = "/".join(bits)
-            return self._get_module_from_package(lookfor_pkg,
-                                                 lookfor_sections, lookfor_mod,
-                                                 looked_in)
+            lookfor_mod = self._absolute_modname(from_module, reqname)
+            return (self._get_module_from_package(lookfor_pkg,
+                                                  lookfor_sections, lookfor_mod,
+                                                  looked_in), None)
 
         # non-relative import. Might be a short name (requiring a search
         # through "library" packages), or a fully-qualified one.
@@ -495,13 +959,13 @@ class ManifestBuilder:
                                                lookfor_sections, lookfor_mod,
                                                looked_in)
             if mi: # caution, 0==None
-                return mi
+                return mi, None
         else:
             # 3: try finding PKG, if found, use its main.js entry point
             lookfor_pkg = reqname
             mi = self._get_entrypoint_from_package(lookfor_pkg, looked_in)
             if mi:
-                return mi
+                return mi, None
 
         # 4: search packages for MOD or MODPARENT/MODCHILD. We always search
         # their own package first, then the list of packages defined by their
@@ -511,7 +975,7 @@ class ManifestBuilder:
                                               lookfor_sections, reqname,
                                               looked_in)
         if mi:
-            return mi
+            return mi, None
 
         # Only after we look for module in the addon itself, search for a module
         # in new layout.
@@ -525,27 +989,14 @@ class ManifestBuilder:
             normalized = normalized[len("api-utils/"):]
         if normalized in NEW_LAYOUT_MAPPING:
             # get the new absolute path for this module
-            original_reqname = reqname
-            reqname = NEW_LAYOUT_MAPPING[normalized]
-            from_pkg = from_module.package.name
-
-            # If the addon didn't explicitely told us to ignore deprecated
-            # require path, warn the developer:
-            # (target_cfg is the package.json file)
-            if not "ignore-deprecated-path" in self.target_cfg:
-                lineno = locations.get(original_reqname)
-                print >>self.stderr, "Warning: Use of deprecated require path:"
-                print >>self.stderr, "  In %s:%d:" % (from_module.js, lineno)
-                print >>self.stderr, "    require('%s')." % original_reqname
-                print >>self.stderr, "  New path should be:"
-                print >>self.stderr, "    require('%s')" % reqname
-
-            return self._search_packages_for_module(from_pkg,
-                                                    lookfor_sections, reqname,
-                                                    looked_in)
+            new_reqname = NEW_LAYOUT_MAPPING[normalized]
+            mi = self._search_packages_for_module(from_pkg,
+                                                  lookfor_sections, new_reqname,
+                                                  looked_in)
+            return mi, new_reqname
         else:
             # We weren't able to find this module, really.
-            return None
+            return None, None
 
     def _handle_module(self, mi):
         if not mi:
@@ -566,14 +1017,13 @@ class ManifestBuilder:
         return new_entry
 
     def _get_module_from_package(self, pkgname, sections, modname, looked_in):
-        if pkgname not in self.pkg_cfg.packages:
+        if pkgname not in self.package_graph:
             return None
-        mi = self._find_module_in_package(pkgname, sections, modname,
-                                          looked_in)
-        return self._handle_module(mi)
+        return self._find_module_in_package(pkgname, sections, modname,
+                                            looked_in)
 
     def _get_entrypoint_from_package(self, pkgname, looked_in):
-        if pkgname not in self.pkg_cfg.packages:
+        if pkgname not in self.package_graph:
             return None
         pkg = self.pkg_cfg.packages[pkgname]
         main = pkg.get("main", None)
@@ -581,36 +1031,21 @@ class ManifestBuilder:
             return None
         for js in self.parse_main(pkg.root_dir, main):
             looked_in.append(js)
-            if os.path.exists(js):
+            if self.file_index.exists(js):
                 section = "lib"
                 name = self.uri_name_from_path(pkg, js)
                 docs = None
-                mi = ModuleInfo(pkg, section, name, js, docs)
-                return self._handle_module(mi)
+                return ModuleInfo(pkg, section, name, js, docs)
         return None
 
     def _search_packages_for_module(self, from_pkg, sections, reqname,
                                     looked_in):
-        searchpath = [] # list of package names
-        searchpath.append(from_pkg) # search self first
-        us = self.pkg_cfg.packages[from_pkg]
-        if 'dependencies' in us:
-            # only look in dependencies
-            searchpath.extend(us['dependencies'])
-        else:
-            # they didn't declare any dependencies (or they declared an empty
-            # list, but we'll treat that as not declaring one, because it's
-            # easier), so look in all deps, sorted alphabetically, so
-            # addon-kit comes first. Note that self.deps includes all
-            # packages found by traversing the ".dependencies" lists in each
-            # package.json, starting from the main addon package, plus
-            # everything added by --extra-packages
-            searchpath.extend(sorted(self.deps))
+        searchpath = self.package_graph.search_path(from_pkg, self.deps)
         for pkgname in searchpath:
             mi = self._find_module_in_package(pkgname, sections, reqname,
                                               looked_in)
             if mi:
-                return self._handle_module(mi)
+                return mi
         return None
 
     def _find_module_in_package(self, pkgname, sections, name, looked_in):
@@ -633,17 +1068,20 @@ class ManifestBuilder:
             for sdir in pkg.get(section, []):
                 js = os.path.join(pkg.root_dir, sdir, filename)
                 looked_in.append(js)
-                if os.path.exists(js):
+                if self.file_index.exists(js):
                     docs = None
                     maybe_docs = os.path.join(pkg.root_dir, "docs",
                                               basename+".md")
-                    if section == "lib" and os.path.exists(maybe_docs):
+                    if (section == "lib" and
+                        self.file_index.exists(maybe_docs)):
                         docs = maybe_docs
                     return ModuleInfo(pkg, section, name, js, docs)
         return None
 
 def build_manifest(target_cfg, pkg_cfg, deps, scan_tests,
-                   test_filter_re=None, extra_modules=[], abort_on_missing=False):
+                   test_filter_re=None, extra_modules=[], abort_on_missing=False,
+                   scan_cache=None, jobs=1, scan_processes=False,
+                   graph_cache=None, package_graph=None):
     """
     Perform recursive dependency analysis starting from entry_point,
     building up a manifest of modules that need to be included in the XPI.
@@ -667,104 +1105,79 @@ def build_manifest(target_cfg, pkg_cfg, deps, scan_tests,
 
     note: we don't build the XPI here, but our manifest is passed to the
     code which does, so it knows what to copy into the XPI.
-    """
 
-    mxt = ManifestBuilder(target_cfg, pkg_cfg, deps, extra_modules,
-                          abort_on_missing=abort_on_missing)
-    mxt.build(scan_tests, test_filter_re)
-    return mxt
+    If scan_cache (a cache.ScanCache) is given, unchanged modules are not
+    re-scanned, and newly scanned ones are added to the cache before we
+    return.
 
+    With jobs > 1, modules are read, hashed and scanned by that many worker
+    threads (or processes, for the scans, if scan_processes is set) before
+    the manifest is built. The result is the same as with jobs=1.
 
+    If graph_cache (a cache.GraphCache) is given, the hashes of unchanged
+    files and the require() resolutions of a previous build are reused, and
+    those of this build are saved for the next one.
 
-COMMENT_PREFIXES = ["//", "/*", "*", "dump("]
+    package_graph is the packaging.PackageGraph of pkg_cfg, if the caller
+    already has one.
+    """
 
-REQUIRE_RE = r"(?<![\'\"])require\s*\(\s*[\'\"]([^\'\"]+?)[\'\"]\s*\)"
+    mxt = ManifestBuilder(target_cfg, pkg_cfg, deps, extra_modules,
+                          abort_on_missing=abort_on_missing,
+                          scan_cache=scan_cache, jobs=jobs,
+                          scan_processes=scan_processes,
+                          graph_cache=graph_cache,
+                          package_graph=package_graph)
+    try:
+        mxt.build(scan_tests, test_filter_re)
+    finally:
+        if scan_cache:
+            scan_cache.save()
+        if graph_cache:
+            mxt.save_graph()
+    return mxt
 
-# detect the define idiom of the form:
-#   define("module name", ["dep1", "dep2", "dep3"], function() {})
-# by capturing the contents of the list in a group.
-DEF_RE = re.compile(r"(require|define)\s*\(\s*([\'\"][^\'\"]+[\'\"]\s*,)?\s*\[([^\]]+)\]")
 
-# Out of the async dependencies, do not allow quotes in them.
-DEF_RE_ALLOWED = re.compile(r"^[\'\"][^\'\"]+[\'\"]$")
 
-def scan_requirements_with_grep(fn, lines):
-    requires = {}
-    first_location = {}
-    for (lineno0, line) in enumerate(lines):
-        for clause in line.split(";"):
-            clause = clause.strip()
-            iscomment = False
-            for commentprefix in COMMENT_PREFIXES:
-                if clause.startswith(commentprefix):
-                    iscomment = True
-            if iscomment:
-                continue
-            mo = re.finditer(REQUIRE_RE, clause)
-            if mo:
-                for mod in mo:
-                    modname = mod.group(1)
-                    requires[modname] = {}
-                    if modname not in first_location:
-                        first_location[modname] = lineno0 + 1
-
-    # define() can happen across multiple lines, so join everyone up.
-    wholeshebang = "\n".join(lines)
-    for match in DEF_RE.finditer(wholeshebang):
-        # this should net us a list of string literals separated by commas
-        for strbit in match.group(3).split(","):
-            strbit = strbit.strip()
-            # There could be a trailing comma netting us just whitespace, so
-            # filter that out. Make sure that only string values with
-            # quotes around them are allowed, and no quotes are inside
-            # the quoted value.
-            if strbit and DEF_RE_ALLOWED.match(strbit):
-                modname = strbit[1:-1]
-                if modname not in ["exports"]:
-                    requires[modname] = {}
-                    # joining all the lines means we lose line numbers, so we
-                    # can't fill first_location[]
-
-    return requires, first_location
-
-CHROME_ALIASES = [
-    (re.compile(r"Components\.classes"), "Cc"),
-    (re.compile(r"Components\.interfaces"), "Ci"),
-    (re.compile(r"Components\.utils"), "Cu"),
-    (re.compile(r"Components\.results"), "Cr"),
-    (re.compile(r"Components\.manager"), "Cm"),
-    ]
-OTHER_CHROME = re.compile(r"Components\.[a-zA-Z]")
+CHROME_ALIASES = {
+    "classes": "Cc",
+    "interfaces": "Ci",
+    "utils": "Cu",
+    "results": "Cr",
+    "manager": "Cm",
+    }
 
-def scan_for_bad_chrome(fn, lines, stderr):
-    problems = False
-    old_chrome = set() # i.e. "Cc" when we see "Components.classes"
+def find_bad_chrome(lines, components=None):
+    """
+    Returns None, or a (needs, lines) tuple describing the uses of
+    'Components' found in LINES: NEEDS is a set of the aliases (like "Cc")
+    that should be imported from the 'chrome' module instead, and LINES is a
+    list of (lineno, line) tuples for the offending lines. COMPONENTS is the
+    second result of jslexer.scan(), if the caller already has it.
+    """
+    # note: this scanner is not obligated to spot all possible forms of
+    # chrome access. The scanner is detecting voluntary requests for
+    # chrome. Runtime tools will enforce allowance or denial of access.
+    if components is None:
+        deps, components = jslexer.scan("".join(lines))
+    if not components:
+        return None
+    uses = {} # maps lineno to set of aliases, like "Cc"
+    for (prop, lineno) in components:
+        uses.setdefault(lineno, set()).add(CHROME_ALIASES.get(prop))
+    old_chrome = set()
     old_chrome_lines = [] # list of (lineno, line.strip()) tuples
-    for lineno,line in enumerate(lines):
-        # note: this scanner is not obligated to spot all possible forms of
-        # chrome access. The scanner is detecting voluntary requests for
-        # chrome. Runtime tools will enforce allowance or denial of access.
-        line = line.strip()
-        iscomment = False
-        for commentprefix in COMMENT_PREFIXES:
-            if line.startswith(commentprefix):
-                iscomment = True
-                break
-        if iscomment:
-            continue
-        old_chrome_in_this_line = set()
-        for (regexp,alias) in CHROME_ALIASES:
-            if regexp.search(line):
-                old_chrome_in_this_line.add(alias)
+    for lineno in sorted(uses):
+        old_chrome_in_this_line = uses[lineno] - set([None])
         if not old_chrome_in_this_line:
-            if OTHER_CHROME.search(line):
-                old_chrome_in_this_line.add("components")
+            old_chrome_in_this_line.add("components")
         old_chrome.update(old_chrome_in_this_line)
-        if old_chrome_in_this_line:
-            old_chrome_lines.append( (lineno+1, line) )
+        old_chrome_lines.append( (lineno, lines[lineno-1].strip()) )
+    return old_chrome, old_chrome_lines
 
-    if old_chrome:
-        print >>stderr, """
+def report_bad_chrome(fn, chrome, stderr):
+    (old_chrome, old_chrome_lines) = chrome
+    print >>stderr, """
 The following lines from file %(fn)s:
 %(lines)s
 use 'Components' to access chrome authority. To do so, you need to add a
@@ -780,19 +1193,42 @@ Then you can use any shortcuts to its properties that you import from the
         "lines": "\n".join([" %3d: %s" % (lineno,line)
                             for (lineno, line) in old_chrome_lines]),
         }
-        problems = True
-    return problems
 
-def scan_module(fn, lines, stderr=sys.stderr):
-    filename = os.path.basename(fn)
-    requires, locations = scan_requirements_with_grep(fn, lines)
-    if filename == "cuddlefish.js":
+def scan_for_bad_chrome(fn, lines, stderr):
+    chrome = find_bad_chrome(lines)
+    if chrome:
+        report_bad_chrome(fn, chrome, stderr)
+        return True
+    return False
+
+def scan_js(fn, lines):
+    """
+    Scans the lines of the module FN without reporting anything, in a single
+    pass of the jslexer. Returns (requires, locations, chrome), where chrome
+    is None or the problem description from find_bad_chrome(). This is what
+    the scan cache stores.
+    """
+    requires = {}
+    locations = {}
+    deps, components = jslexer.scan("".join(lines))
+    for (kind, modname, lineno) in deps:
+        requires[modname] = {}
+        if kind != "define" and modname not in locations:
+            locations[modname] = lineno
+    if os.path.basename(fn) == "cuddlefish.js":
         # this is the loader: don't scan for chrome
-        problems = False
+        chrome = None
     else:
-        problems = scan_for_bad_chrome(fn, lines, stderr)
-    return requires, problems, locations
+        chrome = find_bad_chrome(lines, components)
+    return requires, locations, chrome
 
+def scan_module(fn, lines, stderr=sys.stderr):
+    requires, locations, chrome = scan_js(fn, lines)
+    problems = False
+    if chrome:
+        report_bad_chrome(fn, chrome, stderr)
+        problems = True
+    return requires, problems, locations
 
 
 if __name__ == '__main__':
@@ -0,0 +1,213 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Runs the targets of 'cfx testex', 'testaddons', 'testpkgs' and 'testall'
+(an example, a test add-on or a package, each tested by its own 'cfx test'
+or 'cfx testrun'), up to --parallel of them at a time.
+
+Each target runs in a cfx process of its own, with its own temporary
+directory, so the profiles, logs and result files of two targets never
+meet. The targets which took longest the last time go first, so that the
+last ones to finish are short ones. With more than one at a time, the
+output of each target is held back until it is done, then printed in one
+piece.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import simplejson as json
+
+from cuddlefish.cache import to_str
+
+class Target:
+    def __init__(self, name, arguments):
+        self.name = name
+        self.arguments = arguments # for cuddlefish.run()
+        self.returncode = None
+        self.duration = None
+
+    def failed(self):
+        return self.returncode != 0
+
+def get_child_env(tmpdir):
+    env = dict(os.environ)
+    for name in ("TMPDIR", "TMP", "TEMP"):
+        env[name] = tmpdir
+    python_lib = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    paths = [python_lib]
+    if env.get("PYTHONPATH"):
+        paths.extend([path for path in env["PYTHONPATH"].split(os.pathsep)
+                      if path != python_lib])
+    env["PYTHONPATH"] = os.pathsep.join(paths)
+    return env
+
+def run_target(target, env_root, defaults, output=None, processes=None):
+    """
+    Runs TARGET in a child process and sets its returncode and duration.
+    The child writes to OUTPUT, a file, or to our own stdout and stderr.
+    The child is in PROCESSES, a list, if given, while it runs.
+    """
+    tmpdir = tempfile.mkdtemp(prefix="cfx-target-")
+    try:
+        spec = os.path.join(tmpdir, "target.json")
+        f = open(spec, "w")
+        f.write(json.dumps({"arguments": target.arguments,
+                            "defaults": defaults,
+                            "env_root": env_root}))
+        f.close()
+        started = time.time()
+        process = subprocess.Popen([sys.executable, "-m",
+                                    "cuddlefish.orchestrator", spec],
+                                   stdout=output, stderr=output,
+                                   env=get_child_env(tmpdir))
+        if processes is not None:
+            processes.append(process)
+        try:
+            target.returncode = process.wait()
+        finally:
+            if processes is not None:
+                processes.remove(process)
+        target.duration = time.time() - started
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def order_targets(targets, durations=None):
+    """
+    Returns TARGETS, the longest first according to DURATIONS (a
+    DurationsCache), with the ones it doesn't know about first of all.
+    """
+    def key(target):
+        duration = None
+        if durations is not None:
+            duration = durations.get(target.name)
+        if duration is None:
+            duration = float("inf")
+        return (-duration, target.name)
+    return sorted(targets, key=key)
+
+def run_targets(targets, env_root, defaults, parallel=1, durations=None,
+                stop_on_error=False, out=sys.stderr):
+    """
+    Runs TARGETS, PARALLEL at a time, with the options DEFAULTS, and records
+    how long each took in DURATIONS. With STOP_ON_ERROR, no target is
+    started after one fails. Prints a summary, and returns True if they
+    all passed. On a ^C, the targets which are running are killed before
+    the KeyboardInterrupt goes up.
+    """
+    pending = order_targets(targets, durations)
+    done = []
+    processes = []
+    lock = threading.Lock()
+    state = {"failed": False, "interrupted": False}
+
+    def report(message):
+        out.write(message)
+        out.flush()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending or state["interrupted"] or \
+                   (stop_on_error and state["failed"]):
+                    return
+                target = pending.pop(0)
+                if parallel == 1:
+                    report("Testing %s...\n" % target.name)
+            finally:
+                lock.release()
+            if parallel == 1:
+                run_target(target, env_root, defaults, processes=processes)
+            else:
+                output = tempfile.TemporaryFile()
+                try:
+                    run_target(target, env_root, defaults, output, processes)
+                    output.seek(0)
+                    lock.acquire()
+                    try:
+                        report("Testing %s...\n" % target.name)
+                        report(output.read())
+                    finally:
+                        lock.release()
+                finally:
+                    output.close()
+            lock.acquire()
+            try:
+                done.append(target)
+                if target.failed():
+                    state["failed"] = True
+                report("%s %s in %.1f seconds.\n" %
+                       (target.name,
+                        target.failed() and "failed" or "passed",
+                        target.duration))
+            finally:
+                lock.release()
+
+    threads = [threading.Thread(target=worker)
+               for i in range(max(1, min(parallel, len(pending))))]
+    try:
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # a join() with a timeout lets a ^C through to us
+            while thread.isAlive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        lock.acquire()
+        try:
+            state["interrupted"] = True
+        finally:
+            lock.release()
+        for process in list(processes):
+            try:
+                process.kill()
+            except OSError:
+                pass # it was done already
+            process.wait()
+        raise
+
+    if durations is not None:
+        for target in done:
+            durations.record(target.name, target.duration)
+        durations.save()
+
+    if done:
+        report("Targets, longest first:\n")
+        for target in sorted(done, key=lambda target: -target.duration):
+            report("%8.1fs  %-6s  %s\n" % (target.duration,
+                                           target.failed() and "FAIL" or "ok",
+                                           target.name))
+    skipped = [target.name for target in pending]
+    if skipped:
+        report("Not run, after a failure: %s\n" % ", ".join(skipped))
+    return not state["failed"] and not skipped
+
+def to_defaults(data):
+    # the parsed options, as they were before going through JSON
+    if isinstance(data, dict):
+        return dict([(to_str(key), to_defaults(value))
+                     for (key, value) in data.items()])
+    if isinstance(data, list):
+        return [to_defaults(value) for value in data]
+    return to_str(data)
+
+def main(spec):
+    """
+    What a target's process runs: cuddlefish.run() with the arguments of
+    the target, which exits with its status.
+    """
+    from cuddlefish import run
+    spec = to_defaults(json.loads(open(spec).read()))
+    run(arguments=spec["arguments"], defaults=spec["defaults"],
+        env_root=spec["env_root"])
+
+if __name__ == '__main__':
+    main(sys.argv[1])
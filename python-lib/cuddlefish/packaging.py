@@ -9,6 +9,7 @@ import copy
 
 import simplejson as json
 from cuddlefish.bunch import Bunch
+from cuddlefish import profiler, hashing
 
 MANIFEST_NAME = 'package.json'
 DEFAULT_LOADER = 'addon-sdk'
@@ -119,10 +120,12 @@ def validate_permissions(perms):
         raise ValueError("Error: `cross-domain-content` permissions in \
  package.json file must be an array of strings:\n  %s" % perms)
 
-def get_metadata(pkg_cfg, deps):
+def get_metadata(pkg_cfg, deps, graph=None):
+    if graph is None:
+        graph = PackageGraph(pkg_cfg)
     metadata = Bunch()
     for pkg_name in deps:
-        cfg = pkg_cfg.packages[pkg_name]
+        cfg = graph.get_package(pkg_name)
         metadata[pkg_name] = Bunch()
         for prop in METADATA_PROPS:
             if cfg.get(prop):
@@ -168,7 +171,28 @@ def load_json_file(path):
         raise MalformedJsonFileError('%s when reading "%s"' % (str(e),
                                                                path))
 
-def get_config_in_dir(path):
+def get_config_in_dir(path, cache=None):
+    """
+    Returns the config of the package in directory PATH. CACHE is an
+    optional cache.DiscoveryCache, which spares us reading package.json and
+    probing for directories when nothing has changed.
+    """
+    if cache is not None:
+        config = cache.get_config(path)
+        if config is not None:
+            config = Bunch(config)
+            config.root_dir = path
+            return config
+    base_json = _read_config_in_dir(path)
+    if cache is not None:
+        # everything _read_config_in_dir() looks at is either package.json,
+        # an entry in PATH, or lib/main.js
+        watched = [path, os.path.join(path, MANIFEST_NAME)]
+        watched.extend(base_json.get('lib', []))
+        cache.set_config(path, base_json, watched)
+    return base_json
+
+def _read_config_in_dir(path):
     package_json = os.path.join(path, MANIFEST_NAME)
     if not (os.path.exists(package_json) and
             os.path.isfile(package_json)):
@@ -236,7 +260,7 @@ def _is_same_file(a, b):
         return os.path.samefile(a, b)
     return a == b
 
-def build_config(root_dir, target_cfg, packagepath=[]):
+def build_config(root_dir, target_cfg, packagepath=[], cache=None):
     dirs_to_scan = [env_root] # root is addon-sdk dir, diff from root_dir in tests
 
     def add_packages_from_config(pkgconfig):
@@ -255,17 +279,16 @@ def build_config(root_dir, target_cfg, packagepath=[]):
 
     while dirs_to_scan:
         packages_dir = dirs_to_scan.pop()
-        if os.path.exists(os.path.join(packages_dir, "package.json")):
-            package_paths = [packages_dir]
-        else:
-            package_paths = [os.path.join(packages_dir, dirname)
-                             for dirname in os.listdir(packages_dir)
-                             if not dirname.startswith('.')]
-            package_paths = [dirname for dirname in package_paths
-                             if os.path.isdir(dirname)]
+        package_paths = None
+        if cache is not None:
+            package_paths = cache.get_listing(packages_dir)
+        if package_paths is None:
+            package_paths = _find_package_paths(packages_dir)
+            if cache is not None:
+                cache.set_listing(packages_dir, package_paths)
 
         for path in package_paths:
-            pkgconfig = get_config_in_dir(path)
+            pkgconfig = get_config_in_dir(path, cache)
             if pkgconfig.name in packages:
                 otherpkg = packages[pkgconfig.name]
                 if not _is_same_file(otherpkg.root_dir, path):
@@ -276,30 +299,189 @@ def build_config(root_dir, target_cfg, packagepath=[]):
 
     return Bunch(packages=packages)
 
-def get_deps_for_targets(pkg_cfg, targets):
-    visited = []
-    deps_left = [[dep, None] for dep in list(targets)]
-
-    while deps_left:
-        [dep, required_by] = deps_left.pop()
-        if dep not in visited:
-            visited.append(dep)
-            if dep not in pkg_cfg.packages:
-                required_reason = ("required by '%s'" % (required_by)) \
-                                    if required_by is not None \
-                                    else "specified as target"
-                raise PackageNotFoundError(dep, required_reason)
-            dep_cfg = pkg_cfg.packages[dep]
-            deps_left.extend([[i, dep] for i in dep_cfg.get('dependencies', [])])
-            deps_left.extend([[i, dep] for i in dep_cfg.get('extra_dependencies', [])])
-
-    return visited
+def _find_package_paths(packages_dir):
+    if os.path.exists(os.path.join(packages_dir, "package.json")):
+        return [packages_dir]
+    package_paths = [os.path.join(packages_dir, dirname)
+                     for dirname in os.listdir(packages_dir)
+                     if not dirname.startswith('.')]
+    return [dirname for dirname in package_paths
+            if os.path.isdir(dirname)]
+
+class PackageGraph:
+    """
+    The dependency graph of the packages in a pkg_cfg, built once so that
+    the questions we keep asking about it don't each walk every
+    package.json again. The graph reflects pkg_cfg as it was when the
+    graph was made: set .extra_dependencies before making one.
+    """
+
+    def __init__(self, pkg_cfg):
+        self.packages = pkg_cfg.packages
+        self.edges = {} # maps package name to the names it depends on
+        for (name, cfg) in self.packages.items():
+            self.edges[name] = (list(cfg.get('dependencies', [])) +
+                                list(cfg.get('extra_dependencies', [])))
+        self._search_deps = None
+        self._search_paths = {} # see search_path()
+
+    def __contains__(self, name):
+        return name in self.packages
+
+    def get_package(self, name, required_by=None):
+        if name not in self.packages:
+            required_reason = ("required by '%s'" % (required_by)) \
+                                if required_by is not None \
+                                else "specified as target"
+            raise PackageNotFoundError(name, required_reason)
+        return self.packages[name]
+
+    def get_deps(self, targets):
+        """
+        Returns the names of TARGETS and of all the packages they depend on,
+        directly or not, in the order in which they were reached.
+        """
+        visited = []
+        seen = set()
+        deps_left = [[dep, None] for dep in list(targets)]
+
+        while deps_left:
+            [dep, required_by] = deps_left.pop()
+            if dep not in seen:
+                seen.add(dep)
+                visited.append(dep)
+                self.get_package(dep, required_by)
+                deps_left.extend([[i, dep] for i in self.edges[dep]])
+
+        return visited
+
+    def topological_order(self, names=None):
+        """
+        Returns NAMES (all packages by default) so that each package comes
+        after the ones it depends on, as far as cycles allow. Packages are
+        otherwise in alphabetical order, and dependencies which are not in
+        NAMES are left out.
+        """
+        if names is None:
+            names = self.packages.keys()
+        wanted = set(names)
+        order = []
+        done = set()
+        for root in sorted(wanted):
+            if root in done:
+                continue
+            done.add(root)
+            # an explicit stack of (name, remaining dependencies), so that
+            # long chains of packages don't hit the recursion limit
+            stack = [(root, iter(sorted(self.edges.get(root, []))))]
+            while stack:
+                (name, children) = stack[-1]
+                for child in children:
+                    if child in wanted and child not in done:
+                        done.add(child)
+                        stack.append((child,
+                                      iter(sorted(self.edges.get(child, [])))))
+                        break
+                else:
+                    stack.pop()
+                    order.append(name)
+        return order
+
+    def find_cycles(self):
+        """
+        Returns a list of dependency cycles, each one a sorted list of the
+        names of the packages which depend on each other.
+        """
+        # Tarjan's strongly connected components, without recursion
+        index = {}
+        lowlink = {}
+        on_stack = set()
+        stack = []
+        cycles = []
+        for root in sorted(self.packages):
+            if root in index:
+                continue
+            work = [(root, iter(self.edges[root]))]
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                (name, children) = work[-1]
+                for child in children:
+                    if child not in self.packages:
+                        continue
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(self.edges[child])))
+                        break
+                    if child in on_stack:
+                        lowlink[name] = min(lowlink[name], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[name])
+                    if lowlink[name] == index[name]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == name:
+                                break
+                        if len(component) > 1 or name in self.edges[name]:
+                            cycles.append(sorted(component))
+        return sorted(cycles)
+
+    def search_path(self, pkgname, deps):
+        """
+        Returns the names of the packages in which a require() from package
+        PKGNAME looks for a module: PKGNAME itself, then its dependencies,
+        or all of DEPS in alphabetical order if it doesn't declare any.
+        Search paths are remembered for as long as the same DEPS list is
+        given.
+        """
+        if deps is not self._search_deps:
+            self._search_deps = deps
+            self._search_paths = {}
+        searchpath = self._search_paths.get(pkgname)
+        if searchpath is None:
+            searchpath = [pkgname] # search self first
+            us = self.packages[pkgname]
+            if 'dependencies' in us:
+                # only look in dependencies
+                searchpath.extend(us['dependencies'])
+            else:
+                # they didn't declare any dependencies (or they declared an
+                # empty list, but we'll treat that as not declaring one,
+                # because it's easier), so look in all deps, sorted
+                # alphabetically, so addon-kit comes first. Note that DEPS
+                # usually includes all packages found by traversing the
+                # ".dependencies" lists in each package.json, starting from
+                # the main addon package, plus everything added by
+                # --extra-packages
+                searchpath.extend(sorted(deps))
+            self._search_paths[pkgname] = searchpath
+        return searchpath
+
+def get_deps_for_targets(pkg_cfg, targets, graph=None):
+    if graph is None:
+        graph = PackageGraph(pkg_cfg)
+    return graph.get_deps(targets)
 
 def generate_build_for_target(pkg_cfg, target, deps,
                               include_tests=True,
                               include_dep_tests=False,
                               is_running_tests=False,
-                              default_loader=DEFAULT_LOADER):
+                              default_loader=DEFAULT_LOADER,
+                              locale_cache=None, jobs=1):
+    """
+    LOCALE_CACHE is an optional cache.LocaleCache of parsed .properties
+    files, and with JOBS > 1 the files it doesn't know are parsed by that
+    many threads.
+    """
 
     build = Bunch(# Contains section directories for all packages:
                   packages=Bunch(),
@@ -343,24 +525,10 @@ def generate_build_for_target(pkg_cfg, target, deps,
             fullpath = os.path.join(path, filename)
             if os.path.isfile(fullpath) and filename.endswith('.properties'):
                 language = filename[:-len('.properties')]
+                locale_files.append((language, fullpath))
 
-                from property_parser import parse_file, MalformedLocaleFileError
-                try:
-                    content = parse_file(fullpath)
-                except MalformedLocaleFileError, msg:
-                    print msg[0]
-                    sys.exit(1)
-
-                # Merge current locales into global locale hashtable.
-                # Locale files only contains one big JSON object
-                # that act as an hastable of:
-                # "keys to translate" => "translated keys"
-                if language in build.locale:
-                    merge = (build.locale[language].items() +
-                             content.items())
-                    build.locale[language] = Bunch(merge)
-                else:
-                    build.locale[language] = content
+    # the .properties files to merge, in order: later ones win
+    locale_files = []
 
     def add_dep_to_build(dep):
         dep_cfg = pkg_cfg.packages[dep]
@@ -385,6 +553,23 @@ def generate_build_for_target(pkg_cfg, target, deps,
     if 'loader' not in build:
         add_dep_to_build(DEFAULT_LOADER)
 
+    from property_parser import MalformedLocaleFileError
+    fullpaths = [fullpath for (language, fullpath) in locale_files]
+    for ((language, fullpath), content) in zip(locale_files,
+                                               parse_locale_files(fullpaths,
+                                                                  locale_cache,
+                                                                  jobs)):
+        if isinstance(content, MalformedLocaleFileError):
+            print content[0]
+            sys.exit(1)
+        # Merge current locales into global locale hashtable.
+        # Locale files only contains one big JSON object
+        # that act as an hastable of:
+        # "keys to translate" => "translated keys"
+        if language not in build.locale:
+            build.locale[language] = Bunch()
+        build.locale[language].update(content)
+
     if 'icon' in target_cfg:
         build['icon'] = os.path.join(target_cfg.root_dir, target_cfg.icon)
         del target_cfg['icon']
@@ -405,6 +590,49 @@ def generate_build_for_target(pkg_cfg, target, deps,
 
     return build
 
+def _parse_locale_file(fullpath):
+    from property_parser import parse_file, MalformedLocaleFileError
+    span = profiler.begin("parse locale", args={"file": fullpath})
+    try:
+        return parse_file(fullpath)
+    except MalformedLocaleFileError, e:
+        return e
+    finally:
+        profiler.end(span)
+
+def parse_locale_files(fullpaths, cache=None, jobs=1):
+    """
+    Returns the parsed contents of each of the .properties files FULLPATHS,
+    or a MalformedLocaleFileError for those which can't be parsed. The
+    results may be shared with CACHE (a cache.LocaleCache), so they must
+    not be modified.
+    """
+    results = [None] * len(fullpaths)
+    if cache is not None:
+        digests = hashing.hash_files(fullpaths)
+        for i in range(len(fullpaths)):
+            results[i] = cache.lookup(digests[i])
+    todo = [i for i in range(len(fullpaths)) if results[i] is None]
+    def parse(i):
+        return _parse_locale_file(fullpaths[i])
+    if jobs > 1 and len(todo) > 1:
+        # parsing is mostly Python code, so this mostly overlaps the reads
+        # and utf-8 decoding of the files
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(jobs, len(todo)))
+        try:
+            parsed = pool.map(parse, todo)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        parsed = [parse(i) for i in todo]
+    for (i, content) in zip(todo, parsed):
+        results[i] = content
+        if cache is not None and isinstance(content, dict):
+            cache.store(digests[i], content)
+    return results
+
 def _get_files_in_dir(path):
     data = {}
     files = os.listdir(path)
@@ -0,0 +1,115 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+A tiny profiler for the phases of a cfx build, for 'cfx --profile-build'.
+
+Code marks the interesting spans of time with begin() and end():
+
+    span = profiler.begin("build_manifest")
+    try:
+        ...
+    finally:
+        profiler.end(span)
+
+These calls cost next to nothing until start() has been called. save()
+writes what was recorded in the Chrome trace-event format (load it in
+chrome://tracing or https://ui.perfetto.dev), and summary() sums up the
+time spent per span name.
+"""
+
+import os
+import time
+import thread
+import threading
+import simplejson as json
+
+_events = None # list of trace events, or None when not profiling
+_lock = threading.Lock()
+_origin = 0
+
+def start():
+    global _events, _origin
+    _events = []
+    _origin = time.time()
+
+def stop():
+    global _events
+    _events = None
+
+def is_active():
+    return _events is not None
+
+def begin(name, category="build", args=None):
+    """
+    Starts a span called NAME, and returns a token to give to end(). ARGS is
+    an optional dict of details, shown along with the span.
+    """
+    if _events is None:
+        return None
+    return (name, category, args, time.time())
+
+def end(span):
+    if span is None or _events is None:
+        return
+    (name, category, args, started) = span
+    add(name, started, time.time() - started, category, args)
+
+def add(name, started, duration, category="build", args=None):
+    """
+    Records a span which started at time.time() STARTED and lasted DURATION
+    seconds.
+    """
+    if _events is None:
+        return
+    event = {"name": name,
+             "cat": category,
+             "ph": "X",
+             "ts": int((started - _origin) * 1e6),
+             "dur": int(duration * 1e6),
+             "pid": os.getpid(),
+             "tid": thread.get_ident(),
+             }
+    if args:
+        event["args"] = args
+    _lock.acquire()
+    try:
+        _events.append(event)
+    finally:
+        _lock.release()
+
+def call(name, f, *args, **kwargs):
+    # calls f(*args, **kwargs) in a span called NAME
+    span = begin(name)
+    try:
+        return f(*args, **kwargs)
+    finally:
+        end(span)
+
+def save(path):
+    events = sorted(_events or [], key=lambda e: (e["ts"], -e["dur"]))
+    f = open(path, "w")
+    try:
+        f.write(json.dumps({"traceEvents": events,
+                            "displayTimeUnit": "ms"}, indent=1))
+    finally:
+        f.close()
+
+def summary(categories=None):
+    """
+    Returns a text table with the total time, count and name of each kind
+    of span, slowest first. Spans whose category isn't in CATEGORIES (all
+    of them by default) are left out.
+    """
+    totals = {}
+    for e in _events or []:
+        if categories and e["cat"] not in categories:
+            continue
+        (total, count) = totals.get((e["cat"], e["name"]), (0, 0))
+        totals[(e["cat"], e["name"])] = (total + e["dur"], count + 1)
+    lines = ["%10s %6s  %s" % ("ms", "count", "span")]
+    for ((category, name), (total, count)) in sorted(totals.items(),
+                                                    key=lambda i: -i[1][0]):
+        lines.append("%10.1f %6d  %s" % (total / 1000.0, count, name))
+    return "\n".join(lines)
@@ -0,0 +1,256 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+The results of 'cfx test --parseable', read a line at a time from the
+output of the application as run_app() follows it, with the time each test
+started and ended. They can be written out as JSON (--results-json) or as
+JUnit XML (--results-junit), which CI servers understand.
+
+The lines this knows about look like:
+
+    TEST-START | test-foo.testBar
+    TEST-PASS | test-foo.testBar | message
+    TEST-KNOWN-FAIL | test-foo.testBar | message
+    TEST-UNEXPECTED-FAIL | test-foo.testBar | message
+    TEST-UNEXPECTED-PASS | test-foo.testBar | message
+    TEST-END | test-foo.testBar
+
+and, between tests, the "description: amount" lines of --profile-memory.
+Everything else is ignored.
+"""
+
+import re
+import time
+import xml.dom.minidom
+import simplejson as json
+
+TEST_LINE = re.compile(r'^(TEST-[A-Z-]+) \| (.*?)(?: \| (.*))?$')
+MEMORY_LINE = re.compile(r'^([^|]+): (\d+)$')
+
+def split_test_name(name):
+    """
+    Splits the name of a test, which is the id of its module and the name
+    of its function, into those two.
+
+      >>> split_test_name("./test-foo.test bar.baz")
+      ('./test-foo', 'test bar.baz')
+      >>> split_test_name("startup")
+      ('', 'startup')
+    """
+    slash = name.rfind("/") + 1
+    dot = name.find(".", slash)
+    if dot < 0:
+        return "", name
+    return name[:dot], name[dot+1:]
+
+class TestResult:
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.passed = 0
+        self.known_failures = 0
+        self.failures = [] # the unexpected failures and passes
+
+    def get_duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def get_status(self):
+        # "error" is for tests which never ended: a crash or a timeout
+        if self.failures:
+            return "fail"
+        if self.end is None:
+            return "error"
+        return "pass"
+
+    def to_json(self):
+        return {"name": self.name,
+                "status": self.get_status(),
+                "start": self.start,
+                "duration": self.get_duration(),
+                "passed": self.passed,
+                "known_failures": self.known_failures,
+                "failures": self.failures}
+
+class TestResults:
+    """
+    Feed it each line of output, then call finish(). CLOCK is what time it
+    is, and is there for the tests.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.start = clock()
+        self.end = None
+        self.tests = [] # in the order they started, repeated by --times
+        self.current = None
+        self.by_name = {} # the latest run of each test
+        self.errors = [] # failures which came outside of any test
+        self.memory = {}
+
+    def feed(self, line):
+        if isinstance(line, str):
+            line = line.decode("utf-8", "replace")
+        line = line.rstrip("\r\n")
+        match = TEST_LINE.match(line)
+        if not match:
+            if self.current is None:
+                match = MEMORY_LINE.match(line)
+                if match:
+                    self.memory[match.group(1)] = int(match.group(2))
+            return
+        (kind, name, message) = match.groups()
+        if kind == "TEST-START":
+            test = TestResult(name, self.clock())
+            self.tests.append(test)
+            self.by_name[name] = test
+            self.current = test
+            return
+        test = self.by_name.get(name)
+        if test is None:
+            # like console.error(), which doesn't name the test
+            test = self.current
+            message = line[len(kind) + 3:]
+        if kind == "TEST-END":
+            if test is not None and test.end is None:
+                test.end = self.clock()
+            if test is self.current:
+                self.current = None
+        elif test is None:
+            if kind.startswith("TEST-UNEXPECTED-"):
+                self.errors.append(line)
+        elif kind == "TEST-PASS":
+            test.passed += 1
+        elif kind == "TEST-KNOWN-FAIL":
+            test.known_failures += 1
+        elif kind.startswith("TEST-UNEXPECTED-"):
+            test.failures.append("%s | %s" % (kind, message or ""))
+
+    def finish(self):
+        self.end = self.clock()
+        self.current = None
+
+    def get_durations(self):
+        """
+        Returns {test name: seconds} for the tests which ended, from their
+        latest run.
+        """
+        return dict([(test.name, test.get_duration())
+                     for test in self.by_name.values()
+                     if test.end is not None])
+
+    def get_counts(self):
+        counts = {"pass": 0, "fail": 0, "error": 0}
+        for test in self.tests:
+            counts[test.get_status()] += 1
+        return counts
+
+    def to_json(self):
+        duration = None
+        if self.end is not None:
+            duration = self.end - self.start
+        return {"duration": duration,
+                "counts": self.get_counts(),
+                "tests": [test.to_json() for test in self.tests],
+                "errors": self.errors,
+                "memory": self.memory}
+
+    def write_json(self, filename):
+        f = open(filename, "w")
+        try:
+            f.write(json.dumps(self.to_json(), indent=2, sort_keys=True))
+        finally:
+            f.close()
+
+    def to_junit(self):
+        """
+        Returns a JUnit XML document, with a <testsuite> for each test
+        module, and one named "harness" for the errors outside of tests.
+        """
+        impl = xml.dom.minidom.getDOMImplementation()
+        doc = impl.createDocument(None, "testsuites", None)
+        root = doc.documentElement
+        suites = {}
+        order = []
+        for test in self.tests:
+            (module, name) = split_test_name(test.name)
+            if module not in suites:
+                suites[module] = []
+                order.append(module)
+            suites[module].append((name, test))
+
+        def add_suite(module, cases):
+            suite = doc.createElement("testsuite")
+            suite.setAttribute("name", module)
+            suite.setAttribute("tests", str(len(cases)))
+            statuses = [test.get_status() for (name, test) in cases]
+            suite.setAttribute("failures", str(statuses.count("fail")))
+            suite.setAttribute("errors", str(statuses.count("error")))
+            total = sum([test.get_duration() or 0 for (name, test) in cases])
+            suite.setAttribute("time", "%.3f" % total)
+            root.appendChild(suite)
+            return suite
+
+        for module in order:
+            suite = add_suite(module, suites[module])
+            for (name, test) in suites[module]:
+                case = doc.createElement("testcase")
+                case.setAttribute("classname", module)
+                case.setAttribute("name", name)
+                case.setAttribute("time", "%.3f" % (test.get_duration() or 0))
+                for failure in test.failures:
+                    element = doc.createElement("failure")
+                    element.setAttribute("message", failure.split("\n")[0])
+                    element.appendChild(doc.createTextNode(failure))
+                    case.appendChild(element)
+                if test.get_status() == "error":
+                    element = doc.createElement("error")
+                    element.setAttribute("message", "The test never ended.")
+                    case.appendChild(element)
+                suite.appendChild(case)
+        if self.errors:
+            suite = add_suite("harness", [])
+            suite.setAttribute("tests", "1")
+            suite.setAttribute("errors", "1")
+            case = doc.createElement("testcase")
+            case.setAttribute("classname", "harness")
+            case.setAttribute("name", "harness")
+            case.setAttribute("time", "0.000")
+            for error in self.errors:
+                element = doc.createElement("error")
+                element.setAttribute("message", error)
+                case.appendChild(element)
+            suite.appendChild(case)
+        return doc
+
+    def write_junit(self, filename):
+        f = open(filename, "w")
+        try:
+            f.write(self.to_junit().toprettyxml(indent="  ",
+                                                encoding="utf-8"))
+        finally:
+            f.close()
+
+def merge_results(results_list):
+    """
+    Returns one TestResults with the tests and errors of all those in
+    RESULTS_LIST, like the shards of a test run, from the first start to
+    the last end.
+    """
+    merged = TestResults()
+    if results_list:
+        merged.start = min([results.start for results in results_list])
+        ends = [results.end for results in results_list]
+        merged.end = None
+        if None not in ends:
+            merged.end = max(ends)
+    for results in results_list:
+        merged.tests.extend(results.tests)
+        merged.by_name.update(results.by_name)
+        merged.errors.extend(results.errors)
+        merged.memory.update(results.memory)
+    return merged
+
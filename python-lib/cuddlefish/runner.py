@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import io
 import os
 import sys
 import time
@@ -11,8 +12,11 @@ import shlex
 import subprocess
 import re
 import shutil
+from StringIO import StringIO
 
 import mozrunner
+from cuddlefish import profiler
+from cuddlefish.watcher import get_watcher
 from cuddlefish.prefs import DEFAULT_COMMON_PREFS
 from cuddlefish.prefs import DEFAULT_FIREFOX_PREFS
 from cuddlefish.prefs import DEFAULT_THUNDERBIRD_PREFS
@@ -39,43 +43,154 @@ RUN_TIMEOUT = 5400     #1.5 hours (1.5 * 60 * 60 sec)
 # than the amount of time any test takes to report results.
 OUTPUT_TIMEOUT = 300   #five minutes (60 * 5 sec)
 
-def follow_file(filename):
-    """
-    Generator that yields the latest unread content from the given
-    file, or None if no new content is available.
+# Longest we'll wait for the output or the result files to change before
+# checking the timeouts above, in seconds.
+WATCH_TIMEOUT = 1
+
+class Tailer:
+    r"""
+    Follows the file FILENAME, through a single handle which stays open,
+    reading into a buffer that is reused. What it reads goes as it is to the
+    consumers added with add_chunk_consumer(), like an echo to the terminal
+    which shouldn't wait for the end of a line, and a complete line at a
+    time to those added with add_consumer(). The file doesn't have to exist
+    yet; if it's truncated, it's read again from the start, and if it's
+    replaced (removed and created again, or renamed over), the new one is
+    followed once the old one has been read to its end.
 
     For example:
 
       >>> f = open('temp.txt', 'w')
       >>> f.write('hello')
       >>> f.flush()
-      >>> tail = follow_file('temp.txt')
-      >>> tail.next()
-      'hello'
-      >>> tail.next() is None
+      >>> lines = []
+      >>> chunks = []
+      >>> tail = Tailer('temp.txt')
+      >>> tail.add_consumer(lines.append)
+      >>> tail.add_chunk_consumer(chunks.append)
+      >>> tail.poll()
       True
-      >>> f.write('there')
+      >>> lines
+      []
+      >>> chunks
+      ['hello']
+      >>> f.write(' there\nand')
       >>> f.flush()
-      >>> tail.next()
-      'there'
+      >>> tail.poll()
+      True
+      >>> tail.poll()
+      False
+      >>> lines
+      ['hello there\n']
+      >>> f.write(' more\nbye')
       >>> f.close()
+      >>> tail.close()
+      >>> lines
+      ['hello there\n', 'and more\n', 'bye']
+      >>> "".join(chunks)
+      'hello there\nand more\nbye'
       >>> os.remove('temp.txt')
     """
 
-    last_pos = 0
-    last_size = 0
-    while True:
-        newstuff = None
-        if os.path.exists(filename):
-            size = os.stat(filename).st_size
-            if size > last_size:
-                last_size = size
-                f = open(filename, 'r')
-                f.seek(last_pos)
-                newstuff = f.read()
-                last_pos = f.tell()
-                f.close()
-        yield newstuff
+    def __init__(self, filename, bufsize=64*1024):
+        self.filename = filename
+        self.consumers = []
+        self.chunk_consumers = []
+        self.f = None
+        self.pos = 0
+        self.partial = ""
+        self.closed = False
+        self.buffer = bytearray(bufsize)
+        self.view = memoryview(self.buffer)
+
+    def add_consumer(self, consumer):
+        self.consumers.append(consumer)
+
+    def add_chunk_consumer(self, consumer):
+        self.chunk_consumers.append(consumer)
+
+    def _open(self):
+        try:
+            self.f = io.open(self.filename, "rb", buffering=0)
+        except IOError:
+            return False
+        self.pos = 0
+        return True
+
+    def _replaced(self):
+        # Windows has no inode numbers, so there we only notice truncation
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+        ino = os.fstat(self.f.fileno()).st_ino
+        return bool(st.st_ino and ino) and st.st_ino != ino
+
+    def read(self):
+        """
+        Returns what was appended to the file since the last call, or None.
+        """
+        if self.f is None and not self._open():
+            return None
+        chunks = []
+        while True:
+            n = self.f.readinto(self.buffer)
+            if n:
+                chunks.append(self.view[:n].tobytes())
+                self.pos += n
+                continue
+            # only look at the file by name when there's nothing to read
+            if chunks:
+                break
+            if os.fstat(self.f.fileno()).st_size < self.pos:
+                self.f.seek(0)
+                self.pos = 0
+                continue
+            if self._replaced():
+                self.f.close()
+                if self._open():
+                    continue
+                self.f = None
+            break
+        if chunks:
+            return "".join(chunks)
+        return None
+
+    def poll(self):
+        """
+        Reads what's new, hands it to the chunk consumers, and the lines it
+        completes to the consumers. Returns True if there was anything new,
+        even without a whole line.
+        """
+        data = self.read()
+        if not data:
+            return False
+        for consumer in self.chunk_consumers:
+            consumer(data)
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            for consumer in self.consumers:
+                consumer(line + "\n")
+        return True
+
+    def close(self):
+        """
+        Reads what's left of the file, hands the last line to the consumers,
+        even if it isn't complete, and closes the file.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        while self.poll():
+            pass
+        if self.partial:
+            partial, self.partial = self.partial, ""
+            for consumer in self.consumers:
+                consumer(partial)
+        if self.f is not None:
+            self.f.close()
+            self.f = None
 
 # subprocess.check_output only appeared in python2.7, so this code is taken
 # from python source code for compatibility with py2.5/2.6
@@ -398,7 +513,16 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
             bundle_sdk=True,
             pkgdir="",
             enable_e10s=False,
-            no_connections=False):
+            no_connections=False,
+            jobs=1,
+            install_xpi=False, results=None, runners=None):
+    """
+    Runs the add-on, or its tests, and returns 0 if they passed, -1 if not.
+    The output of the application is fed a line at a time to RESULTS, a
+    cuddlefish.results.TestResults, if given. The runner of the application
+    is in RUNNERS, a list, if given, while it runs, so that another thread
+    can stop it.
+    """
     if binary:
         binary = os.path.expanduser(binary)
 
@@ -475,8 +599,6 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
         if os.path.exists(logfile):
             os.remove(logfile)
 
-    logfile_tail = None
-
     # We always buffer output through a logfile for two reasons:
     # 1. On Windows, it's the only way to print console output to stdout/err.
     # 2. It enables us to keep track of the last time output was emitted,
@@ -484,11 +606,11 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
     if not logfile:
         fileno,logfile = tempfile.mkstemp(prefix="harness-log-")
         os.close(fileno)
-    logfile_tail = follow_file(logfile)
     atexit.register(maybe_remove_logfile)
 
     logfile = os.path.abspath(os.path.expanduser(logfile))
     maybe_remove_logfile()
+    logfile_tail = Tailer(logfile)
 
     env = {}
     env.update(os.environ)
@@ -500,18 +622,27 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
     if norun:
         cmdargs.append("-no-remote")
 
-    # Create the addon XPI so mozrunner will copy it to the profile it creates.
-    # We delete it below after getting mozrunner to create the profile.
-    from cuddlefish.xpi import build_xpi
-    xpi_path = tempfile.mktemp(suffix='cfx-tmp.xpi')
-    build_xpi(template_root_dir=harness_root_dir,
-              manifest=manifest_rdf,
-              xpi_path=xpi_path,
-              harness_options=harness_options,
-              limit_to=used_files,
-              bundle_sdk=bundle_sdk,
-              pkgdir=pkgdir)
-    addons.append(xpi_path)
+    # The addon is only run here, so by default we lay it out straight in
+    # the profile rather than zip it up for mozrunner to unzip it again.
+    # On a device, the profile gets the XPI.
+    from cuddlefish.xpi import build_xpi, build_unpacked, DEV_COMPRESSION
+    install_xpi = install_xpi or app_type == "fennec-on-device"
+    if install_xpi:
+        # Create the addon XPI so mozrunner will copy it to the profile it
+        # creates. We delete it below after getting mozrunner to create the
+        # profile.
+        xpi_path = tempfile.mktemp(suffix='cfx-tmp.xpi')
+        profiler.call("build_xpi", build_xpi,
+                      template_root_dir=harness_root_dir,
+                      manifest=manifest_rdf,
+                      xpi_path=xpi_path,
+                      harness_options=harness_options,
+                      limit_to=used_files,
+                      bundle_sdk=bundle_sdk,
+                      pkgdir=pkgdir,
+                      jobs=jobs,
+                      compression=DEV_COMPRESSION)
+        addons.append(xpi_path)
 
     starttime = last_output_time = time.time()
 
@@ -522,7 +653,7 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
     # maintain.
     fileno,outfile = tempfile.mkstemp(prefix="harness-stdout-")
     os.close(fileno)
-    outfile_tail = follow_file(outfile)
+    outfile_tail = Tailer(outfile)
     def maybe_remove_outfile():
         if os.path.exists(outfile):
             try:
@@ -555,12 +686,30 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
                            preferences, overloads)
 
     # the XPI file is copied into the profile here
+    span = profiler.begin("create profile", "run")
     profile = profile_class(addons=addons,
                             profile=profiledir,
                             preferences=preferences)
+    profiler.end(span)
 
-    # Delete the temporary xpi file
-    os.remove(xpi_path)
+    if install_xpi:
+        # Delete the temporary xpi file
+        os.remove(xpi_path)
+    else:
+        addon_id = mozrunner.addon_details(StringIO(str(manifest_rdf)))["id"]
+        addon_dir = os.path.join(profile.profile, "extensions", addon_id)
+        if os.path.exists(addon_dir + ".xpi"):
+            # left in a --profiledir by an earlier run
+            os.remove(addon_dir + ".xpi")
+        profiler.call("build_unpacked", build_unpacked,
+                      template_root_dir=harness_root_dir,
+                      manifest=manifest_rdf,
+                      addon_dir=addon_dir,
+                      harness_options=harness_options,
+                      limit_to=used_files,
+                      bundle_sdk=bundle_sdk,
+                      pkgdir=pkgdir)
+        profile.addons_installed.append(addon_dir)
 
     # Copy overloaded files registered in set_overloaded_modules
     # For testing on device, we have to copy overloaded files from fs
@@ -700,47 +849,69 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
         print " ".join(runner.command) + " " + (" ".join(runner.cmdargs))
         return 0
 
+    # watch before starting, so that no write goes unnoticed
+    watcher = get_watcher([f for f in (logfile, outfile, resultfile) if f])
+    started = time.time()
+    startup_span = profiler.begin("browser startup", "run")
     runner.start()
+    if runners is not None:
+        runners.append(runner)
 
     done = False
     result = None
-    test_name = "Jetpack startup"
+    test_names = ["Jetpack startup"]
+
+    def echo(data):
+        sys.stderr.write(data)
+        sys.stderr.flush()
+    def track_test_name(line):
+        match = PARSEABLE_TEST_NAME.search(line)
+        if match:
+            test_names.append(match.group(1))
+    tails = (logfile_tail, outfile_tail)
+    for tail in tails:
+        tail.add_chunk_consumer(echo)
+        if is_running_tests and parseable:
+            tail.add_consumer(track_test_name)
+        if results is not None:
+            tail.add_consumer(results.feed)
 
     def Timeout(message, test_name, parseable):
         if parseable:
-            sys.stderr.write("TEST-UNEXPECTED-FAIL | %s | %s\n" % (test_name, message))
+            line = "TEST-UNEXPECTED-FAIL | %s | %s\n" % (test_name, message)
+            sys.stderr.write(line)
             sys.stderr.flush()
+            if results is not None:
+                results.feed(line)
         return Exception(message)
 
     try:
         while not done:
-            time.sleep(0.05)
-            for tail in (logfile_tail, outfile_tail):
-                if tail:
-                    new_chars = tail.next()
-                    if new_chars:
+            # the files are only read when one of them was written to (or,
+            # with a PollingWatcher, every time); otherwise all there is to
+            # do is to check the timeouts
+            if watcher.wait(WATCH_TIMEOUT):
+                for tail in tails:
+                    if tail.poll():
                         last_output_time = time.time()
-                        sys.stderr.write(new_chars)
-                        sys.stderr.flush()
-                        if is_running_tests and parseable:
-                            match = PARSEABLE_TEST_NAME.search(new_chars)
-                            if match:
-                                test_name = match.group(1)
-            if os.path.exists(resultfile):
-                result = open(resultfile).read()
-                if result:
-                    if result in ['OK', 'FAIL']:
-                        done = True
-                    else:
-                        sys.stderr.write("Hrm, resultfile (%s) contained something weird (%d bytes)\n" % (resultfile, len(result)))
-                        sys.stderr.write("'"+result+"'\n")
+                        # the first output means the add-on is running
+                        profiler.end(startup_span)
+                        startup_span = None
+                if os.path.exists(resultfile):
+                    result = open(resultfile).read()
+                    if result:
+                        if result in ['OK', 'FAIL']:
+                            done = True
+                        else:
+                            sys.stderr.write("Hrm, resultfile (%s) contained something weird (%d bytes)\n" % (resultfile, len(result)))
+                            sys.stderr.write("'"+result+"'\n")
             if enforce_timeouts:
                 if time.time() - last_output_time > OUTPUT_TIMEOUT:
                     raise Timeout("Test output exceeded timeout (%ds)." %
-                                  OUTPUT_TIMEOUT, test_name, parseable)
+                                  OUTPUT_TIMEOUT, test_names[-1], parseable)
                 if time.time() - starttime > RUN_TIMEOUT:
                     raise Timeout("Test run exceeded timeout (%ds)." %
-                                  RUN_TIMEOUT, test_name, parseable)
+                                  RUN_TIMEOUT, test_names[-1], parseable)
     except:
         if not noquit:
             runner.stop()
@@ -753,6 +924,17 @@ def run_app(harness_root_dir, manifest_rdf, harness_options,
         except:
             pass
     finally:
+        if runners is not None:
+            runners.remove(runner)
+        profiler.end(startup_span)
+        profiler.add("application run", started, time.time() - started, "run")
+        watcher.close()
+        # close() reads what the application wrote as it exited, which has
+        # to reach the results before they are finished
+        for tail in tails:
+            tail.close()
+        if results is not None:
+            results.finish()
         outf.close()
         if profile:
             profile.cleanup()
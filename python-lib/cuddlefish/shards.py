@@ -0,0 +1,88 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Splits the test modules of 'cfx test --shards N' between N runs of the
+application, each with its own profile, result file and log, and runs them
+at the same time. The tests are mostly waiting on the application, so one
+thread per shard, each in run_app(), is all it takes.
+"""
+
+import sys
+import threading
+
+from cuddlefish.results import split_test_name
+
+def get_module_durations(results):
+    """
+    Returns {test module name: seconds} from a TestResults, where the names
+    are like "test-foo", as in ManifestBuilder.test_entries, and the
+    seconds are the total of its tests.
+    """
+    durations = {}
+    for (name, duration) in results.get_durations().items():
+        testname = split_test_name(name)[0].split("/")[-1]
+        durations[testname] = durations.get(testname, 0) + duration
+    return durations
+
+def partition(testnames, count, durations={}):
+    """
+    Splits TESTNAMES into up to COUNT sorted lists which should take about
+    as long to run as each other, according to DURATIONS, in seconds. Tests
+    which have no duration yet are counted as average ones. The longest
+    tests go first, each to the shard which has the least to run so far.
+
+      >>> partition(["test-a", "test-b", "test-c", "test-d"], 2,
+      ...           {"test-a": 3, "test-b": 1, "test-c": 1})
+      [['test-a'], ['test-b', 'test-c', 'test-d']]
+      >>> partition(["test-a", "test-b"], 3)
+      [['test-a'], ['test-b']]
+    """
+    known = [durations[name] for name in testnames if name in durations]
+    default = 1.0
+    if known:
+        default = float(sum(known)) / len(known)
+    weights = dict([(name, durations.get(name, default))
+                    for name in testnames])
+    shards = [[] for i in range(count)]
+    loads = [0] * count
+    for name in sorted(testnames, key=lambda name: (-weights[name], name)):
+        i = loads.index(min(loads))
+        shards[i].append(name)
+        loads[i] += weights[name]
+    return [sorted(shard) for shard in shards if shard]
+
+def run_shards(shards, run_shard, stop=None):
+    """
+    Calls RUN_SHARD(index, testnames) for each list of SHARDS, each in its
+    own thread, and returns what they return, in order. If any of them
+    raises, the first exception is raised again once they are all done. On
+    a ^C, STOP() is called, if given, to stop what the shards are running
+    before the KeyboardInterrupt goes up; their threads are left behind.
+    """
+    returns = [None] * len(shards)
+    errors = []
+    def run(index, testnames):
+        try:
+            returns[index] = run_shard(index, testnames)
+        except:
+            errors.append(sys.exc_info())
+    threads = []
+    try:
+        for (index, testnames) in enumerate(shards):
+            thread = threading.Thread(target=run, args=(index, testnames))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            # a join() with a timeout lets a ^C through to us
+            while thread.isAlive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        if stop is not None:
+            stop()
+        raise
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return returns
@@ -0,0 +1,187 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+What an XPI is made of, for 'cfx xpi --size-report', and whether it fits
+the limits of a budget file, for 'cfx xpi --size-budget'.
+
+A budget file is JSON, with sizes in compressed bytes, which is what users
+download:
+
+    {"xpi": 500000,
+     "packages": {"addon-sdk": 400000, "my-addon": 50000}}
+
+Both keys are optional.
+"""
+
+import zipfile
+from collections import deque
+import simplejson as json
+from cuddlefish.manifest import ManifestEntry
+from cuddlefish.xpi import map_used_files, ZIPSEP
+
+class BadBudgetError(Exception):
+    pass
+
+def get_require_chains(manifest):
+    """
+    Returns a dict that maps each ManifestEntry of the ManifestBuilder
+    MANIFEST to the paths of the modules through which it is reached: a
+    root (the top module first, then modules which nothing requires, like
+    the loader's), then each module that require()s the next one. Modules
+    are visited breadth-first, so each chain is a shortest one.
+    """
+    users = manifest.get_reverse_dependencies()
+    top_path = getattr(manifest, "top_path", None)
+    def root_order(me):
+        return (me.get_path() != top_path, me in users, me.get_path())
+    chains = {}
+    for root in sorted(manifest.get_module_entries(), key=root_order):
+        if root in chains:
+            continue
+        chains[root] = [root.get_path()]
+        pending = deque([root])
+        while pending:
+            me = pending.popleft()
+            for reqname in sorted(me.requirements):
+                them = me.requirements[reqname]
+                if isinstance(them, ManifestEntry) and them not in chains:
+                    chains[them] = chains[me] + [them.get_path()]
+                    pending.append(them)
+    return chains
+
+def split_arcname(arcname):
+    # returns (package, section, name) for an entry of resources/, or
+    # ("", "", arcname) for the files of the XPI itself
+    bits = arcname.split(ZIPSEP)
+    if bits[0] == "resources" and len(bits) > 3:
+        return bits[1], bits[2], ZIPSEP.join(bits[3:])
+    return "", "", arcname
+
+class SizeReport:
+    """
+    The uncompressed and compressed size of each file of the XPI at
+    XPI_PATH. With MANIFEST, the ManifestBuilder of the build, and
+    PACKAGES, the section directories that went in the XPI ({package:
+    {section: dirname}}, as in harness-options.json), modules are told
+    apart from other files, along with the require() chain that pulled
+    each of them in.
+    """
+    def __init__(self, xpi_path, manifest=None, packages={}):
+        self.xpi_path = xpi_path
+        self.entries = [] # (package, section, name, size, compressed)
+        self.chains = {} # maps the arcname of each module to its chain
+        zf = zipfile.ZipFile(xpi_path, "r")
+        try:
+            for zinfo in zf.infolist():
+                if zinfo.filename.endswith(ZIPSEP):
+                    continue
+                self.entries.append(split_arcname(zinfo.filename) +
+                                    (zinfo.file_size, zinfo.compress_size))
+        finally:
+            zf.close()
+        if manifest is not None:
+            chains = get_require_chains(manifest)
+            sections = []
+            for package in packages:
+                for (section, dirname) in packages[package].items():
+                    sections.append((ZIPSEP.join(["resources", package,
+                                                  section]), dirname))
+            by_filename = dict([(me.js_filename, me)
+                                for me in manifest.get_module_entries()])
+            for (arcname, abspath) in map_used_files(sections, by_filename,
+                                                     []).items():
+                self.chains[arcname] = chains[by_filename[abspath]]
+
+    def get_totals(self):
+        """
+        Returns {(package, section): [size, compressed]}, with the totals of
+        each package under (package, None) and of the whole XPI under
+        (None, None).
+        """
+        totals = {}
+        for (package, section, name, size, compressed) in self.entries:
+            for key in ((package, section), (package, None), (None, None)):
+                total = totals.setdefault(key, [0, 0])
+                total[0] += size
+                total[1] += compressed
+        return totals
+
+    def format(self):
+        totals = self.get_totals()
+        (size, compressed) = totals.get((None, None), [0, 0])
+        lines = ["Size of %s: %d files, %d bytes, %d compressed" %
+                 (self.xpi_path, len(self.entries), size, compressed),
+                 "%10s %10s" % ("bytes", "compressed")]
+        def by_compressed_size(key):
+            return (-totals[key][1], key)
+        packages = sorted([key for key in totals
+                           if key[0] is not None and key[1] is None],
+                          key=by_compressed_size)
+        for (package, ignored) in packages:
+            (size, compressed) = totals[(package, None)]
+            lines.append("%10d %10d  %s" % (size, compressed,
+                                            package or "(xpi)"))
+            sections = sorted([key for key in totals
+                               if key[0] == package and key[1] is not None],
+                              key=by_compressed_size)
+            for (package, section) in sections:
+                indent = "  "
+                if section:
+                    (size, compressed) = totals[(package, section)]
+                    lines.append("%10d %10d    %s" % (size, compressed,
+                                                      section))
+                    indent = "    "
+                entries = [entry for entry in self.entries
+                           if entry[:2] == (package, section)]
+                entries.sort(key=lambda entry: (-entry[4], entry[2]))
+                for (package, section, name, size, compressed) in entries:
+                    line = "%10d %10d  %s%s" % (size, compressed, indent, name)
+                    arcname = ZIPSEP.join(["resources", package, section,
+                                           name])
+                    if arcname in self.chains:
+                        line += "  (%s)" % " -> ".join(self.chains[arcname])
+                    lines.append(line)
+        return "\n".join(lines)
+
+    def check_budget(self, budget):
+        """
+        Returns a message for each limit of BUDGET (see load_budget()) that
+        the XPI is over, so an empty list if it fits.
+        """
+        totals = self.get_totals()
+        over = []
+        limit = budget.get("xpi")
+        compressed = totals.get((None, None), [0, 0])[1]
+        if limit is not None and compressed > limit:
+            over.append("The XPI is %d bytes compressed, over its budget of "
+                        "%d bytes." % (compressed, limit))
+        for (package, limit) in sorted(budget.get("packages", {}).items()):
+            compressed = totals.get((package, None), [0, 0])[1]
+            if compressed > limit:
+                over.append("Package '%s' is %d bytes compressed, over its "
+                            "budget of %d bytes." % (package, compressed,
+                                                     limit))
+        return over
+
+def load_budget(fn):
+    """
+    Reads the budget file FN, raising BadBudgetError if it isn't one.
+    """
+    try:
+        budget = json.loads(open(fn, "r").read())
+    except (IOError, ValueError), e:
+        raise BadBudgetError("Can't read the size budget %s: %s" % (fn, e))
+    def is_size(value):
+        return isinstance(value, (int, long)) and value >= 0
+    if (not isinstance(budget, dict)
+        or not set(budget) <= set(["xpi", "packages"])
+        or ("xpi" in budget and not is_size(budget["xpi"]))
+        or not isinstance(budget.get("packages", {}), dict)
+        or not all([is_size(value)
+                    for value in budget.get("packages", {}).values()])):
+        raise BadBudgetError("The size budget %s must look like "
+                             '{"xpi": 500000, "packages": {"name": 100000}}.'
+                             % fn)
+    return budget
@@ -0,0 +1,126 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import unittest
+import zipfile
+import simplejson as json
+
+from cuddlefish import packaging, manifest, xpi, bundler
+from cuddlefish.tests.test_xpi import xpi_template_path, fake_manifest
+from test_linker import up
+
+class FakeManifest:
+    def __init__(self, entries):
+        self.entries = entries
+    def get_module_entries(self):
+        return frozenset(self.entries)
+
+def make_entry(package, name, requirements={}):
+    me = manifest.ManifestEntry()
+    me.packageName = package
+    me.sectionName = "lib"
+    me.moduleName = name
+    me.requirements = requirements
+    return me
+
+class Bundler(unittest.TestCase):
+    def setUp(self):
+        self.basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+
+    def get_manifest(self):
+        root = up(os.path.abspath(__file__), 4)
+        linker_files = os.path.join(up(os.path.abspath(__file__)),
+                                    "linker-files")
+        target_cfg = packaging.get_config_in_dir(os.path.join(linker_files,
+                                                              "three"))
+        pkg_cfg = packaging.build_config(root, target_cfg, packagepath=[
+            os.path.join(linker_files, "three-deps")])
+        deps = packaging.get_deps_for_targets(pkg_cfg,
+                                              [target_cfg.name, "addon-sdk"])
+        m = manifest.build_manifest(target_cfg, pkg_cfg, deps,
+                                    scan_tests=False)
+        return pkg_cfg, target_cfg, m
+
+    def test_unbundled(self):
+        worker = make_entry("addon-sdk", "sdk/content/content-worker")
+        sandbox = make_entry("addon-sdk", "sdk/content/sandbox",
+                             {"./content-worker.js": worker,
+                              "chrome": "chrome"})
+        loader = make_entry("addon-sdk", "toolkit/loader")
+        main = make_entry("one", "main", {"sdk/content/sandbox": sandbox})
+        unbundled = bundler.get_unbundled_entries(
+            FakeManifest([worker, sandbox, loader, main]))
+        self.failUnlessEqual(unbundled, set([worker, loader]))
+
+        # what the loader of toolkit/require loads by URL stays a file, and
+        # so does everything it requires
+        heritage = make_entry("addon-sdk", "sdk/core/heritage")
+        util = make_entry("addon-sdk", "framescript/util",
+                          {"sdk/core/heritage": heritage})
+        shared = make_entry("addon-sdk", "toolkit/require")
+        menu = make_entry("addon-sdk", "sdk/context-menu@2",
+                          {"toolkit/require": shared,
+                           "framescript/util": util})
+        unbundled = bundler.get_unbundled_entries(
+            FakeManifest([heritage, util, shared, menu]))
+        self.failUnlessEqual(unbundled, set([heritage, util, shared]))
+
+    def test_bundle_modules(self):
+        pkg_cfg, target_cfg, m = self.get_manifest()
+        modules = dict([(me.get_path(), me.js_filename)
+                        for me in m.get_module_entries()])
+        # three-a/main and three-a/subdir/subfile don't fit together
+        index, bundles, bundled_files = bundler.bundle_modules(m, True,
+                                                               max_size=500)
+        self.failUnlessEqual(sorted(index), sorted(modules))
+        self.failUnlessEqual(bundled_files, set(modules.values()))
+        self.failUnlessEqual(index["three-a/main"], "bundles/three-a-0.json")
+        self.failUnlessEqual(index["three-a/subdir/subfile"],
+                             "bundles/three-a-1.json")
+        self.failUnlessEqual(index["three-c/main"], index["three-c/sub/foo"])
+        for (path, arcname) in index.items():
+            sources = json.loads(bundles[arcname])
+            self.failUnlessEqual(sources[path],
+                                 open(modules[path], "rb").read())
+
+        index, bundles, bundled_files = bundler.bundle_modules(m, False)
+        self.failIf([path for path in index if path.startswith("sdk/")])
+        self.failUnlessEqual(sorted(bundles),
+                             ["bundles/three-0.json", "bundles/three-a-0.json",
+                              "bundles/three-b-0.json",
+                              "bundles/three-c-0.json"])
+
+    def test_xpi(self):
+        pkg_cfg, target_cfg, m = self.get_manifest()
+        index, bundles, bundled_files = bundler.bundle_modules(m, True)
+        build = packaging.generate_build_for_target(pkg_cfg, target_cfg.name,
+                                                    m.get_used_packages(),
+                                                    include_tests=False)
+        options = {'main': target_cfg.main, 'bundles': index}
+        options.update(build)
+        xpi_path = os.path.join(self.basedir, "three.xpi")
+        xpi.build_xpi(template_root_dir=xpi_template_path,
+                      manifest=fake_manifest,
+                      xpi_path=xpi_path,
+                      harness_options=options,
+                      limit_to=set(m.get_used_files(True)) - bundled_files,
+                      extra_data=bundles)
+        zf = zipfile.ZipFile(xpi_path, "r")
+        names = zf.namelist()
+        self.failUnless("bundles/" in names)
+        for arcname in bundles:
+            self.failUnlessEqual(zf.read(arcname), bundles[arcname])
+        self.failIf("resources/three/lib/main.js" in names)
+        self.failUnless("resources/three/data/msg.txt" in names)
+        self.failUnlessEqual(json.loads(zf.read("harness-options.json"))
+                             ["bundles"], index)
+        zf.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import hashlib
+import unittest
+from cuddlefish import hashing
+
+class Hashing(unittest.TestCase):
+    def setUp(self):
+        self.basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+        hashing.forget()
+
+    def tearDown(self):
+        hashing.forget()
+
+    def make_file(self, name, data):
+        fn = os.path.join(self.basedir, name)
+        open(fn, "wb").write(data)
+        return fn
+
+    def test_hash_file(self):
+        for data in ["", "small", "x" * (hashing.CHUNK_SIZE + 1),
+                     "y" * hashing.MMAP_THRESHOLD]:
+            fn = self.make_file("data", data)
+            os.utime(fn, (len(data), len(data))) # make each version distinct
+            self.failUnlessEqual(hashing.hash_file(fn),
+                                 hashlib.sha256(data).hexdigest())
+
+    def test_memo(self):
+        fn = self.make_file("memo", "one")
+        os.utime(fn, (1, 1))
+        digest = hashing.hash_file(fn)
+        self.failUnlessEqual(hashing.hash_file(fn), digest)
+        self.failUnlessEqual((hashing.stats.hits, hashing.stats.misses), (1, 1))
+        # a file with the same size and mtime but another inode is hashed
+        fn2 = self.make_file("memo2", "two")
+        os.utime(fn2, (1, 1))
+        self.failIfEqual(hashing.hash_file(fn2), digest)
+        # changing the file makes us read it again
+        open(fn, "wb").write("three")
+        self.failUnlessEqual(hashing.hash_file(fn),
+                             hashlib.sha256("three").hexdigest())
+        self.failUnlessEqual(hashing.stats.misses, 3)
+
+    def test_hash_files(self):
+        data = ["%d" % i * (hashing.PARALLEL_THRESHOLD / 4) for i in range(8)]
+        fns = [self.make_file("f%d" % i, d) for (i, d) in enumerate(data)]
+        self.failUnlessEqual(hashing.hash_files(fns),
+                             [hashlib.sha256(d).hexdigest() for d in data])
+        self.failUnlessEqual(hashing.hash_files(fns[:2] + fns[:2], jobs=1),
+                             [hashlib.sha256(d).hexdigest()
+                              for d in data[:2] + data[:2]])
+        self.failUnlessEqual(hashing.stats.misses, 8)
+
+if __name__ == "__main__":
+    unittest.main()
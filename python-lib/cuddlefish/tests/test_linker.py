@@ -10,6 +10,7 @@ import simplejson as json
 import unittest
 import cuddlefish
 from cuddlefish import packaging, manifest
+from cuddlefish.cache import ScanCache, GraphCache
 
 def up(path, generations=1):
     for i in range(generations):
@@ -79,6 +80,238 @@ class Basic(unittest.TestCase):
                           target_cfg, pkg_cfg, deps, scan_tests=False,
                           abort_on_missing=True)
 
+    def test_scan_cache(self):
+        target_cfg = self.get_pkg("one")
+        pkg_cfg = packaging.build_config(ROOT, target_cfg)
+        deps = packaging.get_deps_for_targets(pkg_cfg,
+                                              [target_cfg.name, "addon-sdk"])
+        basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(basedir):
+            shutil.rmtree(basedir)
+        cache_file = os.path.join(basedir, "scan.json")
+        def requirements(m):
+            # main.js requires both "./two" and "two.js", which yield two
+            # entries for the same path, so don't compare moduleName
+            m = m.get_harness_options_manifest(False)
+            return dict([(path, (entry["requirements"], entry["jsSHA256"]))
+                         for (path, entry) in m.items()])
+        expected = requirements(manifest.build_manifest(target_cfg, pkg_cfg,
+                                                        deps, scan_tests=False))
+
+        cold = ScanCache(cache_file)
+        m = manifest.build_manifest(target_cfg, pkg_cfg, deps,
+                                    scan_tests=False, scan_cache=cold)
+        self.failUnlessEqual(requirements(m), expected)
+        self.failUnless(cold.misses > 0)
+        self.failUnless(os.path.exists(cache_file))
+
+        # a fresh process would load the cache from disk
+        warm = ScanCache(cache_file)
+        m = manifest.build_manifest(target_cfg, pkg_cfg, deps,
+                                    scan_tests=False, scan_cache=warm)
+        self.failUnlessEqual(requirements(m), expected)
+        self.failUnlessEqual((warm.hits, warm.misses),
+                             (cold.hits + cold.misses, 0))
+
+    def test_parallel_build(self):
+        basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(basedir):
+            shutil.rmtree(basedir)
+        libdir = os.path.join(basedir, "parallel", "lib")
+        os.makedirs(libdir)
+        open(os.path.join(basedir, "parallel", "package.json"), "w").write(
+            '{"name": "parallel", "id": "jid1-parallel"}\n')
+        open(os.path.join(libdir, "main.js"), "w").write(
+            'var timer = require("api-utils/timer");\n'
+            'var two = require("./two");\n'
+            'var missing = require("missing-one");\n')
+        open(os.path.join(libdir, "two.js"), "w").write(
+            'var tabs = require("addon-kit/tabs");\n'
+            'var missing = require("missing-two");\n'
+            'var main = require("./main");\n')
+        target_cfg = packaging.get_config_in_dir(
+            os.path.join(basedir, "parallel"))
+        pkg_cfg = packaging.build_config(ROOT, target_cfg)
+        deps = packaging.get_deps_for_targets(pkg_cfg,
+                                              [target_cfg.name, "addon-sdk"])
+        def build(jobs, scan_processes=False):
+            stderr = StringIO()
+            m = manifest.ManifestBuilder(target_cfg, pkg_cfg, deps, [],
+                                         stderr=stderr, jobs=jobs,
+                                         scan_processes=scan_processes)
+            m.build(False, None)
+            return m.get_harness_options_manifest(True), stderr.getvalue()
+        serial_manifest, serial_warnings = build(1)
+        self.failUnless("missing module: missing-one" in serial_warnings)
+        self.failUnless("require('addon-kit/tabs')" in serial_warnings)
+        for (jobs, scan_processes) in [(4, False), (4, True)]:
+            parallel_manifest, parallel_warnings = build(jobs, scan_processes)
+            self.failUnlessEqual(parallel_manifest, serial_manifest)
+            self.failUnlessEqual(parallel_warnings, serial_warnings)
+
+    def test_graph_cache(self):
+        basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(basedir):
+            shutil.rmtree(basedir)
+        pkgdir = os.path.join(basedir, "graph")
+        libdir = os.path.join(pkgdir, "lib")
+        os.makedirs(libdir)
+        open(os.path.join(pkgdir, "package.json"), "w").write(
+            '{"name": "graph", "id": "jid1-graph"}\n')
+        open(os.path.join(libdir, "main.js"), "w").write(
+            'var timer = require("api-utils/timer");\n'
+            'var two = require("./two");\n'
+            'var other = require("other");\n')
+        open(os.path.join(libdir, "two.js"), "w").write(
+            'var main = require("./main");\n')
+        target_cfg = packaging.get_config_in_dir(pkgdir)
+        pkg_cfg = packaging.build_config(ROOT, target_cfg)
+        deps = packaging.get_deps_for_targets(pkg_cfg,
+                                              [target_cfg.name, "addon-sdk"])
+        cache_file = os.path.join(pkgdir, ".cfx-cache", "graph.json")
+        def build():
+            stderr = StringIO()
+            graph_cache = GraphCache(cache_file)
+            m = manifest.ManifestBuilder(target_cfg, pkg_cfg, deps, [],
+                                         stderr=stderr, graph_cache=graph_cache)
+            m.build(False, None)
+            m.save_graph()
+            return (m, graph_cache, m.get_harness_options_manifest(True),
+                    stderr.getvalue())
+
+        m, graph_cache, cold_manifest, cold_warnings = build()
+        self.failUnless("missing module: other" in cold_warnings)
+        self.failUnlessEqual(m.resolutions_loaded, 0)
+        self.failUnless(os.path.exists(cache_file))
+
+        m, graph_cache, warm_manifest, warm_warnings = build()
+        self.failUnlessEqual(warm_manifest, cold_manifest)
+        self.failUnlessEqual(warm_warnings, cold_warnings)
+        self.failUnlessEqual(m.resolution_misses, 0)
+        self.failUnlessEqual(m.file_index.syscalls, 0)
+        self.failUnlessEqual(graph_cache.hash_misses, 0)
+
+        warm_loaded = m.resolutions_loaded
+
+        # a changed module gets hashed and resolves its requires again, the
+        # other modules keep theirs
+        open(os.path.join(libdir, "two.js"), "a").write("// changed\n")
+        os.utime(os.path.join(libdir, "two.js"), (0, 0))
+        m, graph_cache, changed_manifest, warnings = build()
+        self.failUnlessEqual(graph_cache.hash_misses, 1)
+        self.failUnlessEqual(m.resolutions_loaded, warm_loaded - 1)
+        self.failUnlessEqual(m.resolution_misses, 1)
+        self.failIfEqual(changed_manifest["graph/two"]["jsSHA256"],
+                         cold_manifest["graph/two"]["jsSHA256"])
+
+        # so does one saved by renaming a new copy over it, which touches
+        # lib/ but leaves the same names in it
+        new_two = os.path.join(libdir, "two.js.new")
+        open(new_two, "w").write('var main = require("./main");\n')
+        os.rename(new_two, os.path.join(libdir, "two.js"))
+        os.utime(libdir, (1, 1))
+        m, graph_cache, renamed_manifest, warnings = build()
+        self.failUnlessEqual(m.resolutions_loaded, warm_loaded - 1)
+        self.failUnlessEqual(m.resolution_misses, 1)
+        self.failUnlessEqual(renamed_manifest, cold_manifest)
+
+        # adding a module may change how requires resolve, so the ones
+        # which looked in lib/ are resolved again
+        open(os.path.join(libdir, "other.js"), "w").write("\n")
+        os.utime(libdir, (0, 0))
+        m, graph_cache, added_manifest, warnings = build()
+        self.failUnless(m.resolutions_loaded < warm_loaded)
+        self.failIf("missing module" in warnings)
+        self.failUnlessEqual(added_manifest["graph/main"]["requirements"]
+                             ["other"], "graph/other")
+
+    def test_affected_tests(self):
+        basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(basedir):
+            shutil.rmtree(basedir)
+        pkgdir = os.path.abspath(os.path.join(basedir, "affected"))
+        for d in ["lib", "test", "data"]:
+            os.makedirs(os.path.join(pkgdir, d))
+        files = {"package.json": '{"name": "affected", "id": "jid1-aff"}\n',
+                 "README.md": "",
+                 "data/panel.html": "",
+                 "lib/a.js": 'require("./b");\n',
+                 "lib/b.js": "",
+                 "lib/c.js": "",
+                 "test/test-a.js": 'require("./a");\n',
+                 "test/test-b.js": 'require("./b");\n',
+                 "test/test-c.js": 'require("./c");\n',
+                 }
+        for (name, data) in files.items():
+            open(os.path.join(pkgdir, name), "w").write(data)
+        target_cfg = packaging.get_config_in_dir(pkgdir)
+        pkg_cfg = packaging.build_config(ROOT, target_cfg)
+        deps = packaging.get_deps_for_targets(pkg_cfg,
+                                              [target_cfg.name, "addon-sdk"])
+        m = manifest.build_manifest(target_cfg, pkg_cfg, deps, scan_tests=True)
+        def affected(*names):
+            changed = set([os.path.join(pkgdir, name) for name in names])
+            tests = m.get_affected_tests(changed)
+            if tests is not None:
+                tests = sorted(tests)
+            return tests
+        self.failUnlessEqual(affected("lib/b.js"), ["test-a", "test-b"])
+        self.failUnlessEqual(affected("lib/a.js"), ["test-a"])
+        self.failUnlessEqual(affected("test/test-c.js", "README.md"),
+                             ["test-c"])
+        self.failUnlessEqual(affected(), [])
+        self.failUnlessEqual(affected("lib/a.js", "data/panel.html"), None)
+        self.failUnlessEqual(affected("package.json"), None)
+        # --filter matches the test modules' paths in the XPI
+        self.failUnlessEqual(cuddlefish.filter_test_names(
+            target_cfg.name, affected("lib/b.js"), r"tests/test-a\.js$"),
+            ["test-a"])
+        self.failUnlessEqual(cuddlefish.filter_test_names(
+            target_cfg.name, affected("lib/b.js"), r"^resources/affected/"),
+            ["test-a", "test-b"])
+        self.failUnlessEqual(cuddlefish.get_tests_filter(["test-a"], "a:b"),
+                             r"(^|/)(test\-a)\.js$:b")
+
+    def test_file_index(self):
+        index = manifest.FileIndex()
+        lib = os.path.join(get_linker_files_dir("one"), "lib")
+        self.failUnless(index.exists(os.path.join(lib, "two.js")))
+        self.failUnless(index.exists(os.path.join(lib, "subdir")))
+        self.failIf(index.exists(os.path.join(lib, "four.js")))
+        self.failUnlessEqual(index.syscalls, 2) # listed lib/ once
+        self.failUnless(index.exists(os.path.join(lib, "subdir", "three.js")))
+        self.failIf(index.exists(os.path.join(lib, "nonexistent", "two.js")))
+        self.failUnlessEqual(index.lookups, 5)
+        self.failUnlessEqual(index.mtimes[os.path.join(lib, "nonexistent")],
+                             None)
+        self.failUnlessEqual(index.mtimes[lib], os.stat(lib).st_mtime)
+
+    def test_resolution_cache(self):
+        target_cfg = self.get_pkg("one")
+        pkg_cfg = packaging.build_config(ROOT, target_cfg)
+        deps = packaging.get_deps_for_targets(pkg_cfg,
+                                              [target_cfg.name, "addon-sdk"])
+        m = manifest.ManifestBuilder(target_cfg, pkg_cfg, deps, [])
+        main = m.find_top(target_cfg)
+        two = m._find_module_in_package("one", "lib", "two", [])
+        sub = m._find_module_in_package("one", "lib", "subdir/three", [])
+        # "./two" from main and "../two" from subdir/three are the same
+        mi, new_reqname = m.resolve_req(main, "./two", [])
+        self.failUnlessEqual((mi, new_reqname), (two, None))
+        mi, new_reqname = m.resolve_req(sub, "../two", [])
+        self.failUnlessEqual((mi, new_reqname), (two, None))
+        self.failUnlessEqual((m.resolution_hits, m.resolution_misses), (1, 1))
+        # misses are remembered too, along with where we looked
+        looked_in = []
+        self.failUnlessEqual(m.resolve_req(main, "missing", looked_in),
+                             (None, None))
+        self.failUnless(looked_in)
+        looked_in_again = []
+        self.failUnlessEqual(m.resolve_req(two, "missing", looked_in_again),
+                             (None, None))
+        self.failUnlessEqual(looked_in_again, looked_in)
+        self.failUnlessEqual((m.resolution_hits, m.resolution_misses), (2, 2))
+
     def test_main_in_deps(self):
         target_cfg = self.get_pkg("three")
         package_path = [get_linker_files_dir("three-deps")]
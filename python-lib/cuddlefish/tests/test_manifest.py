@@ -147,6 +147,39 @@ class Require(unittest.TestCase, Extra):
         requires = self.scan(mod)
         self.failUnlessKeysAre(requires, ["bar", "me"])
 
+    def test_comments_and_strings(self):
+        mod = """/*
+        Use it like this:
+        var foo = require('one'); foo.bar();
+        */
+        var two = require('two');"""
+        requires, locations = self.scan_locations(mod)
+        self.failUnlessKeysAre(requires, ["two"])
+        self.failUnlessEqual(locations, {"two": 5})
+
+        mod = """var msg = 'please use require("one") instead';"""
+        requires = self.scan(mod)
+        self.failUnlessKeysAre(requires, [])
+
+        mod = """var msg = `require("one") ${require("two")} \\` require('x')`;
+        var three = require("three");"""
+        requires, locations = self.scan_locations(mod)
+        self.failUnlessKeysAre(requires, ["two", "three"])
+        self.failUnlessEqual(locations, {"two": 1, "three": 2})
+
+        mod = """var re = /["']/g; var one = require('one');"""
+        requires = self.scan(mod)
+        self.failUnlessKeysAre(requires, ["one"])
+
+        # block comment lines starting with require() are linker hints
+        mod = """/* Trick the linker into including these modules
+        require('./content-worker.js');
+         * require('not-a-hint');
+        */"""
+        requires, locations = self.scan_locations(mod)
+        self.failUnlessKeysAre(requires, ["./content-worker.js"])
+        self.failUnlessEqual(locations, {"./content-worker.js": 2})
+
 def scan2(text, fn="fake.js"):
     stderr = StringIO()
     lines = StringIO(text).readlines()
@@ -0,0 +1,125 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import sys
+import time
+import errno
+import shutil
+import signal
+import thread
+import unittest
+from StringIO import StringIO
+
+from cuddlefish.orchestrator import Target, order_targets, run_targets
+from cuddlefish.cache import DurationsCache
+from cuddlefish.tests import env_root
+
+tests_path = os.path.abspath(os.path.dirname(__file__))
+
+# Stands in for a Firefox which hangs, once it has written down its own pid
+# and that of the cfx which started it.
+HUNG_FIREFOX = """#!%(python)s
+import os, sys, time
+if "-v" in sys.argv:
+    print "Mozilla Firefox 38.0"
+    sys.exit(0)
+f = open(%(pids)r, "w")
+f.write("%%d %%d" %% (os.getppid(), os.getpid()))
+f.close()
+time.sleep(60)
+"""
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        if e.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
+class Orchestrator(unittest.TestCase):
+    def setUp(self):
+        self.basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+        self.durations = DurationsCache(os.path.join(self.basedir,
+                                                     "test-targets.json"))
+
+    def test_order(self):
+        self.durations.record("short", 1)
+        self.durations.record("long", 10)
+        targets = [Target(name, []) for name in ("short", "long", "new")]
+        self.failUnlessEqual([t.name for t in order_targets(targets)],
+                             ["long", "new", "short"])
+        self.failUnlessEqual([t.name for t in order_targets(targets,
+                                                            self.durations)],
+                             ["new", "long", "short"])
+
+    def test_run(self):
+        defaults = {"filter": "", "verbose": False}
+        def get_targets():
+            # "cfx --version" exits with 0, an unknown command doesn't
+            return [Target("good", ["--version"]),
+                    Target("bad", ["no-such-command"]),
+                    Target("good-too", ["--version"])]
+        out = StringIO()
+        targets = get_targets()
+        self.failIf(run_targets(targets, env_root, defaults, parallel=2,
+                                durations=self.durations, out=out))
+        self.failUnlessEqual([t.failed() for t in targets],
+                             [False, True, False])
+        self.failUnless("Targets, longest first:" in out.getvalue())
+        self.failUnless(self.durations.get("bad") is not None)
+        saved = DurationsCache(self.durations.path)
+        self.failUnlessEqual(sorted(saved.entries),
+                             ["bad", "good", "good-too"])
+
+        # the longest one goes first, and nothing starts after it fails
+        self.durations.record("bad", 1000)
+        out = StringIO()
+        targets = get_targets()
+        self.failIf(run_targets(targets, env_root, defaults,
+                                durations=self.durations, stop_on_error=True,
+                                out=out))
+        self.failUnlessEqual([t.returncode is None for t in targets],
+                             [True, False, True])
+        self.failUnless("Not run, after a failure: good, good-too"
+                        in out.getvalue())
+
+        self.failUnless(run_targets([get_targets()[0]], env_root, defaults,
+                                    parallel=2, out=StringIO()))
+
+    def test_interrupt(self):
+        basedir = os.path.abspath(self.basedir)
+        binary = os.path.join(basedir, "firefox")
+        pids = os.path.join(basedir, "pids")
+        f = open(binary, "w")
+        f.write(HUNG_FIREFOX % {"python": sys.executable, "pids": pids})
+        f.close()
+        os.chmod(binary, 0755)
+        addon_path = os.path.join(tests_path, "addons", "simplest-test")
+        defaults = {"filter": "", "verbose": False}
+        def interrupt():
+            # a ^C once the browser is up
+            while not os.path.exists(pids) or not open(pids).read():
+                time.sleep(0.1)
+            thread.interrupt_main()
+        thread.start_new_thread(interrupt, ())
+        targets = [Target("hung", ["test", "--pkgdir", addon_path,
+                                   "-b", binary, "--no-cache"])]
+        self.failUnlessRaises(KeyboardInterrupt, run_targets, targets,
+                              env_root, defaults, out=StringIO())
+        (cfx_pid, firefox_pid) = map(int, open(pids).read().split())
+        try:
+            # the cfx of the target was killed, and waited for
+            self.failIf(is_running(cfx_pid))
+        finally:
+            if is_running(firefox_pid):
+                os.kill(firefox_pid, signal.SIGKILL)
+
+if __name__ == '__main__':
+    unittest.main()
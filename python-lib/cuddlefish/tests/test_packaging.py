@@ -3,10 +3,12 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os
+import shutil
 import unittest
 
 from cuddlefish import packaging
 from cuddlefish.bunch import Bunch
+from cuddlefish.cache import DiscoveryCache, LocaleCache
 
 tests_path = os.path.abspath(os.path.dirname(__file__))
 static_files_path = os.path.join(tests_path, 'static-files')
@@ -66,6 +68,159 @@ class PackagePath(unittest.TestCase):
         self.assertEqual(sorted(["jspath-one"]),
                          sorted(all_packages - base_packages))
 
+class Discovery(unittest.TestCase):
+    def test_discovery_cache(self):
+        basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(basedir):
+            shutil.rmtree(basedir)
+        packages_dir = os.path.join(basedir, "packages")
+        for name in ["one", "two"]:
+            os.makedirs(os.path.join(packages_dir, name, "lib"))
+            open(os.path.join(packages_dir, name, "package.json"),
+                 "w").write('{"dependencies": ["addon-sdk"]}\n')
+        target_cfg = packaging.get_config_in_dir(
+            os.path.join(packages_dir, "one"))
+        cache_file = os.path.join(basedir, ".cfx-cache", "packages.json")
+        def build_config():
+            cache = DiscoveryCache(cache_file)
+            pkg_cfg = packaging.build_config(basedir, target_cfg, cache=cache)
+            cache.save()
+            return pkg_cfg, cache
+
+        uncached = packaging.build_config(basedir, target_cfg)
+        cold, cache = build_config()
+        self.assertEqual(cold, uncached)
+        self.assertEqual(cache.hits, 0)
+        warm, cache = build_config()
+        self.assertEqual(warm, uncached)
+        self.assertEqual(cache.misses, 0)
+        self.assertEqual(warm.packages.two.root_dir,
+                         os.path.join(packages_dir, "two"))
+
+        # adding lib/main.js gives the package a "main"
+        self.assertFalse("main" in warm.packages.two)
+        libdir = os.path.join(packages_dir, "two", "lib")
+        open(os.path.join(libdir, "main.js"), "w").write("\n")
+        os.utime(libdir, (0, 0))
+        pkg_cfg, cache = build_config()
+        self.assertEqual(pkg_cfg.packages.two.main, "main")
+        self.assertEqual(cache.misses, 1)
+
+        # and new packages are found
+        os.makedirs(os.path.join(packages_dir, "three"))
+        open(os.path.join(packages_dir, "three", "package.json"),
+             "w").write('{}\n')
+        os.utime(packages_dir, (0, 0))
+        pkg_cfg, cache = build_config()
+        self.assertTrue("three" in pkg_cfg.packages)
+        self.assertEqual(pkg_cfg, packaging.build_config(basedir, target_cfg))
+
+class Locales(unittest.TestCase):
+    def test_locale_cache(self):
+        basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(basedir):
+            shutil.rmtree(basedir)
+        packages_dir = os.path.join(basedir, "packages")
+        files = {"one": {"fr-FR": "hello = bonjour\nbye = salut\n",
+                         "de": "hello = hallo\n"},
+                 "two": {"fr-FR": ("bye = au revoir\n"
+                                   "apples = pommes\n"
+                                   "apples[one] = pomme\n")}}
+        for (name, locales) in files.items():
+            locale_dir = os.path.join(packages_dir, name, "locale")
+            os.makedirs(locale_dir)
+            open(os.path.join(packages_dir, name, "package.json"), "w").write(
+                '{"dependencies": ["two"]}\n' if name == "one" else '{}\n')
+            for (language, text) in locales.items():
+                open(os.path.join(locale_dir, language + ".properties"),
+                     "w").write(text)
+        target_cfg = packaging.get_config_in_dir(
+            os.path.join(packages_dir, "one"))
+        pkg_cfg = packaging.build_config(basedir, target_cfg)
+        deps = ["one", "two"]
+        cache_file = os.path.join(basedir, ".cfx-cache", "locales.json")
+        def build(jobs=1):
+            cache = LocaleCache(cache_file)
+            build = packaging.generate_build_for_target(pkg_cfg, "one", deps,
+                                                        locale_cache=cache,
+                                                        jobs=jobs)
+            cache.save()
+            return build.locale, cache
+
+        uncached = packaging.generate_build_for_target(pkg_cfg, "one",
+                                                       deps).locale
+        # later packages win
+        self.assertEqual(uncached, {"fr-FR": {"hello": "bonjour",
+                                              "bye": "au revoir",
+                                              "apples": {"other": "pommes",
+                                                         "one": "pomme"}},
+                                    "de": {"hello": "hallo"}})
+        cold, cache = build(jobs=2)
+        self.assertEqual(cold, uncached)
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+        warm, cache = build()
+        self.assertEqual(warm, uncached)
+        self.assertEqual((cache.hits, cache.misses), (3, 0))
+        # merging didn't modify what the cache holds
+        warm, cache = build()
+        self.assertEqual(warm, uncached)
+
+class Graph(unittest.TestCase):
+    def get_graph(self, dependencies):
+        packages = Bunch()
+        for (name, deps) in dependencies.items():
+            packages[name] = Bunch(name=name)
+            if deps is not None:
+                packages[name].dependencies = deps
+        return packaging.PackageGraph(Bunch(packages=packages))
+
+    def test_deps(self):
+        graph = self.get_graph({"top": ["middle", "addon-sdk"],
+                                "middle": ["addon-sdk"],
+                                "addon-sdk": [],
+                                "unused": ["top"]})
+        self.assertTrue("top" in graph)
+        self.assertFalse("missing" in graph)
+        self.assertEqual(graph.get_deps(["top"]),
+                         ["top", "addon-sdk", "middle"])
+        self.assertEqual(graph.topological_order(),
+                         ["addon-sdk", "middle", "top", "unused"])
+        self.assertEqual(graph.topological_order(["top", "middle"]),
+                         ["middle", "top"])
+        self.assertEqual(graph.find_cycles(), [])
+        self.assertRaises(packaging.PackageNotFoundError,
+                          graph.get_deps, ["top", "missing"])
+
+        broken = self.get_graph({"top": ["missing"]})
+        try:
+            broken.get_deps(["top"])
+        except packaging.PackageNotFoundError, e:
+            self.assertEqual(str(e), "missing (required by 'top')")
+        else:
+            self.fail("PackageNotFoundError not raised")
+
+    def test_cycles(self):
+        graph = self.get_graph({"a": ["b"], "b": ["c"], "c": ["a", "d"],
+                                "d": [], "e": ["e"]})
+        self.assertEqual(graph.find_cycles(), [["a", "b", "c"], ["e"]])
+        self.assertEqual(sorted(graph.get_deps(["a"])), ["a", "b", "c", "d"])
+        order = graph.topological_order()
+        self.assertEqual(sorted(order), ["a", "b", "c", "d", "e"])
+        self.assertTrue(order.index("d") < order.index("c"))
+
+    def test_search_path(self):
+        graph = self.get_graph({"declared": ["b-lib"], "undeclared": None,
+                                "b-lib": [], "a-lib": []})
+        deps = ["undeclared", "b-lib", "a-lib"]
+        self.assertEqual(graph.search_path("declared", deps),
+                         ["declared", "b-lib"])
+        self.assertEqual(graph.search_path("undeclared", deps),
+                         ["undeclared", "a-lib", "b-lib", "undeclared"])
+        self.assertTrue(graph.search_path("undeclared", deps) is
+                        graph.search_path("undeclared", deps))
+        self.assertEqual(graph.search_path("undeclared", ["a-lib"]),
+                         ["undeclared", "a-lib"])
+
 class Directories(unittest.TestCase):
     # for bug 652227
     packages_path = os.path.join(tests_path, "bug-652227-files", "packages")
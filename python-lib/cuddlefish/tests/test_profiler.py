@@ -0,0 +1,61 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+import simplejson as json
+
+from cuddlefish import profiler
+
+class Profiler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        profiler.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_inactive(self):
+        self.failIf(profiler.is_active())
+        span = profiler.begin("nothing")
+        self.failUnlessEqual(span, None)
+        profiler.end(span)
+        self.failUnlessEqual(profiler.call("add", lambda a, b: a+b, 1, b=2), 3)
+        self.failUnlessEqual(profiler.summary().splitlines()[1:], [])
+
+    def test_trace(self):
+        profiler.start()
+        outer = profiler.begin("build_manifest")
+        for i in range(3):
+            profiler.call("scan module", lambda: None)
+        inner = profiler.begin("browser startup", "run", {"app": "firefox"})
+        profiler.end(inner)
+        profiler.end(outer)
+
+        fn = os.path.join(self.tmpdir, "profile.json")
+        profiler.save(fn)
+        events = json.load(open(fn))["traceEvents"]
+        self.failUnlessEqual(len(events), 5)
+        # the enclosing span comes first
+        self.failUnlessEqual(events[0]["name"], "build_manifest")
+        for e in events:
+            self.failUnlessEqual(e["ph"], "X")
+            self.failUnless(e["ts"] >= events[0]["ts"])
+            self.failUnless(e["dur"] <= events[0]["dur"])
+        startup = [e for e in events if e["name"] == "browser startup"][0]
+        self.failUnlessEqual(startup["cat"], "run")
+        self.failUnlessEqual(startup["args"], {"app": "firefox"})
+
+        lines = profiler.summary().splitlines()
+        self.failUnlessEqual(len(lines), 4)
+        self.failUnless(["3", "scan", "module"] in
+                        [line.split()[1:] for line in lines], lines)
+        lines = profiler.summary(["run"]).splitlines()
+        self.failUnlessEqual(len(lines), 2)
+        self.failUnless(lines[1].endswith("1  browser startup"))
+
+if __name__ == '__main__':
+    unittest.main()
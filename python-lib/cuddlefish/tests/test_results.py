@@ -0,0 +1,116 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import unittest
+import xml.dom.minidom
+import simplejson as json
+
+from cuddlefish.results import TestResults
+
+OUTPUT = """\
+Using binary at '/usr/bin/firefox'.
+TEST-START | ./test-a.testOne
+TEST-PASS | ./test-a.testOne | one == one
+TEST-PASS | ./test-a.testOne | two == two
+TEST-END | ./test-a.testOne
+TEST-START | ./test-a.testTwo
+TEST-KNOWN-FAIL | ./test-a.testTwo | todo
+TEST-UNEXPECTED-FAIL | ./test-a.testTwo | 1 != 2
+TEST-INFO | Traceback (most recent call last):
+TEST-UNEXPECTED-FAIL | an error without a test name
+TEST-END | ./test-a.testTwo
+TEST-START | ./test-b.testThree \xc3\xa9
+TEST-PASS | ./test-b.testThree \xc3\xa9 | ok
+TEST-END | ./test-b.testThree \xc3\xa9
+
+resident: 123456
+Tracked memory objects in testing sandbox: 7
+TEST-START | ./test-b.testHang
+TEST-PASS | ./test-b.testHang | started
+TEST-UNEXPECTED-FAIL | ./test-b.testHang | Test output exceeded timeout (300s).
+"""
+
+class Clock:
+    def __init__(self):
+        self.now = 100
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+class Results(unittest.TestCase):
+    def setUp(self):
+        self.basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+
+    def get_results(self):
+        results = TestResults(clock=Clock())
+        results.feed("TEST-UNEXPECTED-FAIL | Jetpack startup | oops\n")
+        for line in OUTPUT.splitlines(True):
+            results.feed(line)
+        results.finish()
+        return results
+
+    def test_feed(self):
+        results = self.get_results()
+        self.failUnlessEqual([test.name for test in results.tests],
+                             [u"./test-a.testOne", u"./test-a.testTwo",
+                              u"./test-b.testThree \xe9",
+                              u"./test-b.testHang"])
+        (one, two, three, hang) = results.tests
+        self.failUnlessEqual((one.start, one.end), (102, 103))
+        self.failUnlessEqual(one.passed, 2)
+        self.failUnlessEqual(one.get_status(), "pass")
+        self.failUnlessEqual(two.known_failures, 1)
+        self.failUnlessEqual(two.failures,
+                             ["TEST-UNEXPECTED-FAIL | 1 != 2",
+                              "TEST-UNEXPECTED-FAIL | "
+                              "an error without a test name"])
+        self.failUnlessEqual(two.get_status(), "fail")
+        self.failUnlessEqual(hang.get_duration(), None)
+        self.failUnlessEqual(hang.get_status(), "fail")
+        self.failUnlessEqual(results.errors,
+                             ["TEST-UNEXPECTED-FAIL | Jetpack startup | oops"])
+        self.failUnlessEqual(results.memory,
+                             {"resident": 123456,
+                              "Tracked memory objects in testing sandbox": 7})
+        self.failUnlessEqual(results.get_durations(),
+                             {u"./test-a.testOne": 1, u"./test-a.testTwo": 1,
+                              u"./test-b.testThree \xe9": 1})
+        self.failUnlessEqual(results.get_counts(),
+                             {"pass": 2, "fail": 2, "error": 0})
+
+    def test_reports(self):
+        results = self.get_results()
+        fn = os.path.join(self.basedir, "results.json")
+        results.write_json(fn)
+        data = json.loads(open(fn).read())
+        self.failUnlessEqual(data["duration"], 8)
+        self.failUnlessEqual(len(data["tests"]), 4)
+        self.failUnlessEqual(data["tests"][0]["duration"], 1)
+
+        fn = os.path.join(self.basedir, "results.xml")
+        results.write_junit(fn)
+        doc = xml.dom.minidom.parse(fn)
+        suites = doc.getElementsByTagName("testsuite")
+        self.failUnlessEqual([(suite.getAttribute("name"),
+                               suite.getAttribute("tests"),
+                               suite.getAttribute("failures"))
+                              for suite in suites],
+                             [("./test-a", "2", "1"), ("./test-b", "2", "1"),
+                              ("harness", "1", "0")])
+        cases = suites[1].getElementsByTagName("testcase")
+        self.failUnlessEqual(cases[0].getAttribute("name"),
+                             u"testThree \xe9")
+        self.failUnlessEqual(cases[0].getAttribute("time"), "1.000")
+        failures = cases[1].getElementsByTagName("failure")
+        self.failUnlessEqual(failures[0].getAttribute("message"),
+                             "TEST-UNEXPECTED-FAIL | "
+                             "Test output exceeded timeout (300s).")
+
+if __name__ == '__main__':
+    unittest.main()
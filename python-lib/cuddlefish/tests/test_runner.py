@@ -2,6 +2,56 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
+import sys
+import shutil
+import unittest
+import simplejson as json
+from StringIO import StringIO
+
+from cuddlefish.runner import Tailer, PARSEABLE_TEST_NAME
+
+tests_path = os.path.abspath(os.path.dirname(__file__))
+
+# Stands in for Firefox: it finds the result file in the harness options of
+# the add-on, and writes the end of its output after the result.
+FAKE_FIREFOX = """#!%(python)s
+import os, sys, time
+import simplejson as json
+if "-v" in sys.argv:
+    print "Mozilla Firefox 38.0"
+    sys.exit(0)
+profile = sys.argv[sys.argv.index("-profile") + 1]
+for (dirpath, dirnames, filenames) in os.walk(profile):
+    if "harness-options.json" in filenames:
+        options = os.path.join(dirpath, "harness-options.json")
+result_file = json.loads(open(options).read())["resultFile"]
+print "TEST-START | test-late.test_one"
+print "TEST-PASS | test-late.test_one | ok"
+print "TEST-END | test-late.test_one"
+print "TEST-START | test-late.test_two"
+sys.stdout.flush()
+f = open(result_file, "w")
+f.write("OK")
+f.close()
+time.sleep(0.5)
+print "TEST-PASS | test-late.test_two | ok"
+print "TEST-END | test-late.test_two"
+"""
+
+# Stands in for a Firefox which hangs in the middle of a test.
+HUNG_FIREFOX = """#!%(python)s
+import sys, time
+if "-v" in sys.argv:
+    print "Mozilla Firefox 38.0"
+    sys.exit(0)
+print "TEST-START | test-late.test_one"
+print "TEST-PASS | test-late.test_one | ok"
+print "TEST-END | test-late.test_one"
+print "TEST-START | test-late.test_two"
+sys.stdout.flush()
+time.sleep(60)
+"""
 
 def xulrunner_app_runner_doctests():
     """
@@ -25,3 +75,126 @@ def xulrunner_app_runner_doctests():
     """
 
     pass
+
+class TailerTests(unittest.TestCase):
+    def setUp(self):
+        self.basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+        self.filename = os.path.join(self.basedir, "log")
+        self.lines = []
+        self.tail = Tailer(self.filename, bufsize=8)
+        self.tail.add_consumer(self.lines.append)
+
+    def tearDown(self):
+        self.tail.close()
+
+    def write(self, data, mode="a"):
+        f = open(self.filename, mode)
+        f.write(data)
+        f.close()
+
+    def test_lines(self):
+        self.failIf(self.tail.poll()) # no file yet
+        self.write("TEST-START | test-a.te")
+        self.failUnless(self.tail.poll())
+        self.write("st_one\nTEST-PASS | test-a.test_one | ok\nTEST-START")
+        self.failUnless(self.tail.poll())
+        self.failUnlessEqual(self.lines,
+                             ["TEST-START | test-a.test_one\n",
+                              "TEST-PASS | test-a.test_one | ok\n"])
+        # a match that spans two reads is found in the line
+        match = PARSEABLE_TEST_NAME.search(self.lines[0])
+        self.failUnlessEqual(match.group(1), "test-a.test_one")
+        self.tail.close()
+        self.failUnlessEqual(self.lines[-1], "TEST-START")
+
+    def test_chunks(self):
+        # a prompt, or progress without a newline, is passed on right away
+        chunks = []
+        self.tail.add_chunk_consumer(chunks.append)
+        self.write("Password: ")
+        self.failUnless(self.tail.poll())
+        self.failUnlessEqual(chunks, ["Password: "])
+        self.failUnlessEqual(self.lines, [])
+        self.write("ok\n")
+        self.tail.poll()
+        self.failUnlessEqual(chunks, ["Password: ", "ok\n"])
+        self.failUnlessEqual(self.lines, ["Password: ok\n"])
+
+    def test_close(self):
+        # what was written since the last poll() isn't lost
+        self.write("one\n")
+        self.tail.poll()
+        self.write("two\nthree and more")
+        self.tail.close()
+        self.failUnlessEqual(self.lines, ["one\n", "two\n", "three and more"])
+        self.tail.close()
+        self.failUnlessEqual(len(self.lines), 3)
+
+    def test_truncate(self):
+        self.write("one\ntwo\n")
+        self.tail.poll()
+        self.write("three\n", "w")
+        self.failUnless(self.tail.poll())
+        self.failUnlessEqual(self.lines, ["one\n", "two\n", "three\n"])
+
+    def test_replace(self):
+        self.write("one\n")
+        self.tail.poll()
+        self.write("two\n") # still in the old file
+        os.rename(self.filename, self.filename + ".old")
+        self.write("three and more\n")
+        self.failUnless(self.tail.poll())
+        self.failUnless(self.tail.poll())
+        self.failIf(self.tail.poll())
+        self.failUnlessEqual(self.lines,
+                             ["one\n", "two\n", "three and more\n"])
+
+class RunAppTests(unittest.TestCase):
+    def setUp(self):
+        self.basedir = os.path.abspath(os.path.join(".test_tmp", self.id()))
+        if os.path.isdir(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+
+    def run_tests(self, script, exception=SystemExit):
+        binary = os.path.join(self.basedir, "firefox")
+        f = open(binary, "w")
+        f.write(script % {"python": sys.executable})
+        f.close()
+        os.chmod(binary, 0755)
+        results_json = os.path.join(self.basedir, "results.json")
+        addon_path = os.path.join(tests_path, "addons", "simplest-test")
+        import cuddlefish
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = StringIO()
+        try:
+            self.failUnlessRaises(exception, cuddlefish.run,
+                                  arguments=["test", "--pkgdir", addon_path,
+                                             "-b", binary, "--no-cache",
+                                             "--results-json", results_json])
+        finally:
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+        results = json.loads(open(results_json).read())
+        return [(test["name"], test["status"]) for test in results["tests"]]
+
+    def test_output_after_result(self):
+        # the lines which came after the result file was written are in
+        self.failUnlessEqual(self.run_tests(FAKE_FIREFOX),
+                             [("test-late.test_one", "pass"),
+                              ("test-late.test_two", "pass")])
+
+    def test_results_after_timeout(self):
+        from cuddlefish import runner
+        old_timeout = runner.OUTPUT_TIMEOUT
+        runner.OUTPUT_TIMEOUT = 2
+        try:
+            tests = self.run_tests(HUNG_FIREFOX, Exception)
+        finally:
+            runner.OUTPUT_TIMEOUT = old_timeout
+        # the report is written before the timeout goes up, with the test
+        # which hung in it
+        self.failUnlessEqual(tests, [("test-late.test_one", "pass"),
+                                     ("test-late.test_two", "fail")])
@@ -0,0 +1,172 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import sys
+import time
+import thread
+import threading
+import shutil
+import unittest
+import simplejson as json
+from StringIO import StringIO
+
+from cuddlefish import shards
+from cuddlefish.cache import DurationsCache
+from cuddlefish.results import TestResults, merge_results
+
+# Stands in for Firefox and the test harness: it runs (without running
+# anything) the test modules of the add-on that the filter selects, the
+# way unit-test-finder.js does.
+FAKE_FIREFOX = """#!%(python)s
+import os, re, sys
+import simplejson as json
+if "-v" in sys.argv:
+    print "Mozilla Firefox 38.0"
+    sys.exit(0)
+profile = sys.argv[sys.argv.index("-profile") + 1]
+for (dirpath, dirnames, filenames) in os.walk(profile):
+    if "harness-options.json" in filenames:
+        addon = dirpath
+options = json.loads(open(os.path.join(addon, "harness-options.json")).read())
+file_re = (options.get("filter") or "").split(":")[0]
+for (dirpath, dirnames, filenames) in os.walk(os.path.join(addon,
+                                                           "resources")):
+    for filename in sorted(filenames):
+        entry = os.path.join(dirpath, filename)[len(addon) + 1:]
+        entry = entry.replace(os.sep, "/")
+        match = re.search(r"tests?/(test-[^./]+)\\.js$", entry)
+        if match and re.search(file_re, entry):
+            print "TEST-START | %%s.test_it" %% match.group(1)
+            print "TEST-PASS | %%s.test_it | ok" %% match.group(1)
+            print "TEST-END | %%s.test_it" %% match.group(1)
+sys.stdout.flush()
+f = open(options["resultFile"], "w")
+f.write("OK")
+f.close()
+"""
+
+def make_results(clock, lines):
+    results = TestResults(clock=clock)
+    for line in lines:
+        results.feed(line + "\n")
+    results.finish()
+    return results
+
+class Shards(unittest.TestCase):
+    def setUp(self):
+        self.basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+
+    def test_partition(self):
+        testnames = ["test-%d" % i for i in range(10)]
+        durations = dict([(name, i) for (i, name) in enumerate(testnames)])
+        parts = shards.partition(testnames, 3, durations)
+        self.failUnlessEqual(sorted(sum(parts, [])), testnames)
+        loads = [sum([durations[name] for name in part]) for part in parts]
+        self.failUnlessEqual(sorted(loads), [14, 15, 16])
+        self.failUnlessEqual(shards.partition([], 4), [])
+
+    def test_run_shards(self):
+        def run_shard(index, testnames):
+            # the last shard ends first
+            time.sleep(0.05 * (2 - index))
+            return (index, testnames)
+        self.failUnlessEqual(shards.run_shards([["a"], ["b", "c"]], run_shard),
+                             [(0, ["a"]), (1, ["b", "c"])])
+        done = []
+        def fail_shard(index, testnames):
+            done.append(index)
+            if index == 0:
+                raise ValueError("oops")
+            return 0
+        self.failUnlessRaises(ValueError, shards.run_shards, [["a"], ["b"]],
+                              fail_shard)
+        self.failUnlessEqual(sorted(done), [0, 1])
+
+    def test_run_shards_interrupted(self):
+        stopped = threading.Event()
+        def run_shard(index, testnames):
+            if index == 1:
+                # as a ^C would
+                thread.interrupt_main()
+            stopped.wait(10)
+            return 0
+        self.failUnlessRaises(KeyboardInterrupt, shards.run_shards,
+                              [["a"], ["b"]], run_shard, stopped.set)
+        # the shards were stopped before the ^C went up
+        self.failUnless(stopped.isSet())
+
+    def test_durations(self):
+        ticks = iter(range(100))
+        clock = lambda: ticks.next()
+        one = make_results(clock, ["TEST-START | ./test-a.test1",
+                                   "TEST-END | ./test-a.test1",
+                                   "TEST-START | pkg/tests/test-b.test2",
+                                   "TEST-UNEXPECTED-FAIL | pkg/tests/test-b"
+                                   ".test2 | 1 != 2"])
+        two = make_results(clock, ["TEST-START | ./test-a.test3",
+                                   "TEST-END | ./test-a.test3",
+                                   "TEST-UNEXPECTED-FAIL | Jetpack startup"
+                                   " | oops"])
+        merged = merge_results([one, two])
+        self.failUnlessEqual((merged.start, merged.end), (0, 8))
+        self.failUnlessEqual([test.name for test in merged.tests],
+                             ["./test-a.test1", "pkg/tests/test-b.test2",
+                              "./test-a.test3"])
+        self.failUnlessEqual(merged.get_counts(),
+                             {"pass": 2, "fail": 1, "error": 0})
+        self.failUnlessEqual(len(merged.errors), 1)
+        self.failUnlessEqual(shards.get_module_durations(merged),
+                             {"test-a": 2})
+
+        fn = os.path.join(self.basedir, "test-durations.json")
+        cache = DurationsCache(fn)
+        self.failUnlessEqual(cache.get("test-a"), None)
+        cache.record("test-a", 2.5)
+        cache.save()
+        self.failUnlessEqual(DurationsCache(fn).get("test-a"), 2.5)
+
+    def test_filter(self):
+        pkgdir = os.path.abspath(os.path.join(self.basedir, "sharded"))
+        for d in ["lib", "test"]:
+            os.makedirs(os.path.join(pkgdir, d))
+        files = {"package.json": '{"name": "sharded", "id": "jid1-shard"}\n',
+                 "lib/main.js": "",
+                 "test/test-a.js": "",
+                 "test/test-b.js": "",
+                 "test/test-c.js": "",
+                 "test/test-ab.js": "",
+                 }
+        for (name, data) in files.items():
+            open(os.path.join(pkgdir, name), "w").write(data)
+        binary = os.path.join(os.path.abspath(self.basedir), "firefox")
+        f = open(binary, "w")
+        f.write(FAKE_FIREFOX % {"python": sys.executable})
+        f.close()
+        os.chmod(binary, 0755)
+        results_json = os.path.join(os.path.abspath(self.basedir),
+                                    "results.json")
+        import cuddlefish
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = StringIO()
+        try:
+            self.failUnlessRaises(SystemExit, cuddlefish.run,
+                                  arguments=["test", "--pkgdir", pkgdir,
+                                             "-b", binary, "--no-cache",
+                                             "--shards", "2",
+                                             "-f", r"tests/test-(a|c)\.js$",
+                                             "--results-json", results_json])
+        finally:
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+        # only the modules that -f selects ran, each in one of the shards
+        results = json.loads(open(results_json).read())
+        self.failUnlessEqual(sorted([test["name"]
+                                     for test in results["tests"]]),
+                             ["test-a.test_it", "test-c.test_it"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import unittest
+import zipfile
+import simplejson as json
+
+from cuddlefish import packaging, manifest, xpi
+from cuddlefish.sizereport import SizeReport, load_budget, BadBudgetError
+from cuddlefish.tests.test_xpi import xpi_template_path, fake_manifest
+from test_linker import up
+
+class SizeReportTests(unittest.TestCase):
+    def setUp(self):
+        self.basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+
+    def build(self):
+        root = up(os.path.abspath(__file__), 4)
+        linker_files = os.path.join(up(os.path.abspath(__file__)),
+                                    "linker-files")
+        target_cfg = packaging.get_config_in_dir(os.path.join(linker_files,
+                                                              "three"))
+        pkg_cfg = packaging.build_config(root, target_cfg, packagepath=[
+            os.path.join(linker_files, "three-deps")])
+        deps = packaging.get_deps_for_targets(pkg_cfg,
+                                              [target_cfg.name, "addon-sdk"])
+        m = manifest.build_manifest(target_cfg, pkg_cfg, deps,
+                                    scan_tests=False)
+        build = packaging.generate_build_for_target(pkg_cfg, target_cfg.name,
+                                                    m.get_used_packages(),
+                                                    include_tests=False)
+        options = {'main': target_cfg.main}
+        options.update(build)
+        packages = options['packages'].copy()
+        xpi_path = os.path.join(self.basedir, "three.xpi")
+        xpi.build_xpi(template_root_dir=xpi_template_path,
+                      manifest=fake_manifest,
+                      xpi_path=xpi_path,
+                      harness_options=options,
+                      limit_to=set(m.get_used_files(True)))
+        return SizeReport(xpi_path, m, packages)
+
+    def test_report(self):
+        report = self.build()
+        zf = zipfile.ZipFile(report.xpi_path, "r")
+        files = [zinfo for zinfo in zf.infolist()
+                 if not zinfo.filename.endswith("/")]
+        zf.close()
+        totals = report.get_totals()
+        self.failUnlessEqual(totals[(None, None)],
+                             [sum([zinfo.file_size for zinfo in files]),
+                              sum([zinfo.compress_size for zinfo in files])])
+        self.failUnlessEqual(sum([totals[key][1] for key in totals
+                                  if key[0] is not None and key[1] is None]),
+                             totals[(None, None)][1])
+        self.failUnless(("three", "data") in totals)
+        self.failUnless(("", None) in totals) # install.rdf and the like
+
+        chains = report.chains
+        self.failUnlessEqual(chains["resources/three/lib/main.js"],
+                             ["three/main"])
+        self.failUnlessEqual(
+            chains["resources/three-a/lib/subdir/subfile.js"],
+            ["three/main", "three-a/main", "three-a/subdir/subfile"])
+        self.failUnlessEqual(chains["resources/addon-sdk/lib/sdk/self.js"],
+                             ["three/main", "three-a/main", "sdk/self"])
+        self.failIf("resources/three/data/msg.txt" in chains)
+
+        lines = report.format().splitlines()
+        self.failUnlessEqual(lines[0].split(":")[1].split()[0],
+                             str(len(files)))
+        self.failUnless([line for line in lines
+                         if line.endswith("      subdir/subfile.js  (three/main"
+                                          " -> three-a/main"
+                                          " -> three-a/subdir/subfile)")],
+                        lines)
+
+    def test_budget(self):
+        report = self.build()
+        totals = report.get_totals()
+        self.failUnlessEqual(report.check_budget({}), [])
+        size = totals[(None, None)][1]
+        self.failUnlessEqual(report.check_budget({"xpi": size}), [])
+        over = report.check_budget({"xpi": size - 1,
+                                    "packages": {"three": 0, "three-a": 10**6,
+                                                 "not-in-the-xpi": 0}})
+        self.failUnlessEqual(len(over), 2)
+        self.failUnless(over[0].startswith("The XPI is %d bytes" % size))
+        self.failUnless(over[1].startswith("Package 'three' is"))
+
+        fn = os.path.join(self.basedir, "budget.json")
+        budget = {"xpi": 1000, "packages": {"three": 10}}
+        open(fn, "w").write(json.dumps(budget))
+        self.failUnlessEqual(load_budget(fn), budget)
+        for bad in ['{"xpi": "1000"}', '{"packages": {"three": -1}}',
+                    '{"size": 1}', '[1000]', '{"xpi":']:
+            open(fn, "w").write(bad)
+            self.failUnlessRaises(BadBudgetError, load_budget, fn)
+        self.failUnlessRaises(BadBudgetError, load_budget, fn + ".missing")
+
+if __name__ == '__main__':
+    unittest.main()
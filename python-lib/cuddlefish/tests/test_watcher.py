@@ -0,0 +1,56 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import sys
+import time
+import shutil
+import unittest
+
+from cuddlefish import watcher
+
+class Watcher(unittest.TestCase):
+    def setUp(self):
+        self.basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+
+    def test_polling(self):
+        w = watcher.PollingWatcher([os.path.join(self.basedir, "log")])
+        start = time.time()
+        self.failUnless(w.wait(10))
+        self.failUnless(time.time() - start < 1)
+        w.close()
+
+    def test_inotify(self):
+        if not sys.platform.startswith("linux"):
+            return
+        log = os.path.join(self.basedir, "log")
+        result = os.path.join(self.basedir, "result")
+        w = watcher.get_watcher([log, result])
+        self.failUnless(isinstance(w, watcher.InotifyWatcher))
+        try:
+            self.failIf(w.wait(0.1))
+            # other files of the directory don't count
+            open(os.path.join(self.basedir, "other"), "w").write("hi")
+            self.failIf(w.wait(0.1))
+            # a file which doesn't exist yet does
+            f = open(log, "w")
+            self.failUnless(w.wait(10))
+            f.write("hello")
+            f.flush()
+            start = time.time()
+            self.failUnless(w.wait(10))
+            self.failUnless(time.time() - start < 1)
+            self.failIf(w.wait(0))
+            f.close()
+            # written before we wait is noticed too
+            open(result, "w").write("OK")
+            self.failUnless(w.wait(10))
+        finally:
+            w.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,7 +10,9 @@ import shutil
 
 import simplejson as json
 from cuddlefish import xpi, packaging, manifest, buildJID
+from cuddlefish.cache import XPIEntryCache, XPIOutputCache
 from cuddlefish.tests import test_packaging
+from cuddlefish.util import filter_filenames, filter_dirnames
 from test_linker import up
 
 import xml.etree.ElementTree as ElementTree
@@ -97,6 +99,308 @@ class ExtraHarnessOptions(unittest.TestCase):
                               self.xpiname, pkg_name, "bug-669274-files",
                               extra_harness_options={"main": "already in use"})
 
+class IncrementalXPI(unittest.TestCase):
+    def setUp(self):
+        self.basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+        self.xpiname = os.path.join(self.basedir, "aardvark.xpi")
+        self.cache_file = os.path.join(self.basedir, ".cfx-cache", "xpi.json")
+
+    def build(self):
+        entry_cache = XPIEntryCache(self.cache_file)
+        create_xpi(self.xpiname, "implicit-icon", "bug-588119-files",
+                   entry_cache=entry_cache)
+        # harness-options.json has a new random jetpackID every time
+        zf = zipfile.ZipFile(self.xpiname, "r")
+        self.failUnlessEqual(zf.testzip(), None)
+        entries = [(zinfo.filename, zinfo.CRC, zinfo.compress_size,
+                    xpi.read_raw(zf, zinfo)) for zinfo in zf.infolist()
+                   if zinfo.filename != "harness-options.json"]
+        zf.close()
+        return entry_cache, entries
+
+    def test_reuse(self):
+        entry_cache, cold = self.build()
+        self.failUnlessEqual(entry_cache.reused, 0)
+        compressed = entry_cache.compressed
+        self.failUnless(compressed > 2)
+        self.failIf(os.path.exists(self.xpiname + ".tmp"))
+
+        entry_cache, warm = self.build()
+        self.failUnlessEqual((entry_cache.reused, entry_cache.compressed),
+                             (compressed, 0))
+        self.failUnlessEqual(warm, cold)
+
+        # entries made from a file with another digest get compressed again
+        entry_cache = XPIEntryCache(self.cache_file)
+        entries = entry_cache.get_entries(self.xpiname)
+        entries["icon.png"][0] = "0" * 64
+        entry_cache.set_entries(self.xpiname, entries)
+        entry_cache.save()
+        entry_cache, changed = self.build()
+        self.failUnlessEqual((entry_cache.reused, entry_cache.compressed),
+                             (compressed - 1, 1))
+        self.failUnlessEqual(changed, cold)
+
+class UsedFiles(unittest.TestCase):
+    def test_map_used_files(self):
+        # map_used_files() finds what walking the sections would
+        root = up(os.path.abspath(__file__), 4)
+        lib = os.path.join(root, "lib")
+        data = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(data):
+            shutil.rmtree(data)
+        for name in ["a.js", ".hidden.js", "b.js~", "ignored.js",
+                     os.path.join("sub", "c.html"),
+                     os.path.join(".hg", "d.js")]:
+            fn = os.path.join(data, name)
+            if not os.path.isdir(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            open(fn, "w").write(name)
+        sections = [("resources/addon-sdk/lib", lib),
+                    ("resources/addon-sdk/sdk", os.path.join(lib, "sdk")),
+                    ("resources/addon/data", data)]
+        ignored = ["ignored.js"]
+        limit_to = set([os.path.join(root, "README.md"),
+                        os.path.join(lib, "sdk"), os.path.join(lib, "nope")])
+        for dirpath, dirnames, filenames in os.walk(data):
+            for filename in filenames:
+                limit_to.add(os.path.join(dirpath, filename))
+        for dirpath, dirnames, filenames in os.walk(lib):
+            for filename in filenames[::3]:
+                limit_to.add(os.path.join(dirpath, filename))
+        expected = {}
+        for (base_arcpath, abs_dirname) in sections:
+            for dirpath, dirnames, filenames in os.walk(abs_dirname):
+                dirnames[:] = filter_dirnames(dirnames)
+                for filename in filter_filenames(filenames, ignored):
+                    abspath = os.path.join(dirpath, filename)
+                    if abspath in limit_to:
+                        arcpath = "/".join([base_arcpath,
+                                            xpi.make_zipfile_path(abs_dirname,
+                                                                  abspath)])
+                        expected[arcpath] = abspath
+        self.failUnless(len(expected) > 100)
+        self.failUnless("resources/addon/data/sub/c.html" in expected)
+        self.failIf("resources/addon/data/.hg/d.js" in expected)
+        self.failUnlessEqual(xpi.map_used_files(sections, limit_to, ignored),
+                             expected)
+
+class CachedXPI(unittest.TestCase):
+    def setUp(self):
+        self.basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+        self.xpiname = os.path.join(self.basedir, "aardvark.xpi")
+        self.cache_dir = os.path.join(self.basedir, ".cfx-cache", "xpis")
+
+    def build(self, jetpackID, output_cache=None):
+        create_xpi(self.xpiname, "implicit-icon", "bug-588119-files",
+                   output_cache=output_cache, jetpackID=jetpackID)
+        return open(self.xpiname, "rb").read()
+
+    def test_reproducible(self):
+        first = self.build("aardvark@jetpack")
+        self.failUnlessEqual(self.build("aardvark@jetpack"), first)
+        zf = zipfile.ZipFile(self.xpiname, "r")
+        for zinfo in zf.infolist():
+            self.failUnlessEqual(zinfo.date_time, xpi.ZIP_EPOCH)
+        zf.close()
+        self.failIfEqual(self.build("zebra@jetpack"), first)
+
+    def test_output_cache(self):
+        output_cache = XPIOutputCache(self.cache_dir, keep=2)
+        cold = self.build("aardvark@jetpack", output_cache)
+        self.failUnlessEqual((output_cache.hits, output_cache.misses), (0, 1))
+        self.failUnlessEqual(len(os.listdir(self.cache_dir)), 1)
+
+        os.remove(self.xpiname)
+        self.failUnlessEqual(self.build("aardvark@jetpack", output_cache), cold)
+        self.failUnlessEqual((output_cache.hits, output_cache.misses), (1, 1))
+        cached = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        self.failIf(os.path.exists(self.xpiname + ".tmp"))
+
+        # changing the output in place, say to sign it, leaves the cached
+        # XPI as it was
+        f = open(self.xpiname, "r+b")
+        f.seek(0, 2)
+        f.write("signature")
+        f.close()
+        self.failUnlessEqual(open(cached, "rb").read(), cold)
+        self.failUnlessEqual(self.build("aardvark@jetpack", output_cache), cold)
+        self.failUnlessEqual((output_cache.hits, output_cache.misses), (2, 1))
+
+        # another input makes another XPI, and the cached ones stay intact
+        self.failIfEqual(self.build("zebra@jetpack", output_cache), cold)
+        self.failUnlessEqual((output_cache.hits, output_cache.misses), (2, 2))
+        self.failUnlessEqual(open(cached, "rb").read(), cold)
+        self.build("yak@jetpack", output_cache)
+        self.failUnlessEqual(len(os.listdir(self.cache_dir)), 2)
+
+class UnpackedXPI(unittest.TestCase):
+    def test_build_unpacked(self):
+        # build_unpacked() lays out what unzipping the XPI would
+        basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(basedir):
+            shutil.rmtree(basedir)
+        os.makedirs(basedir)
+        xpiname = os.path.join(basedir, "aardvark.xpi")
+        create_xpi(xpiname, "implicit-icon", "bug-588119-files",
+                   jetpackID="aardvark@jetpack")
+        addon_dir = os.path.join(basedir, "extensions", "aardvark@jetpack")
+        os.makedirs(os.path.join(addon_dir, "stale"))
+        configs = test_packaging.get_configs("implicit-icon",
+                                             "bug-588119-files")
+        options = {'main': configs.target_cfg.main,
+                   'jetpackID': "aardvark@jetpack", }
+        options.update(configs.build)
+        xpi.build_unpacked(template_root_dir=xpi_template_path,
+                           manifest=fake_manifest,
+                           addon_dir=addon_dir,
+                           harness_options=options)
+
+        found = []
+        for dirpath, dirnames, filenames in os.walk(addon_dir):
+            for name in dirnames:
+                found.append(xpi.make_zipfile_path(
+                    addon_dir, os.path.join(dirpath, name)) + "/")
+            for name in filenames:
+                found.append(xpi.make_zipfile_path(
+                    addon_dir, os.path.join(dirpath, name)))
+        zf = zipfile.ZipFile(xpiname, "r")
+        self.failUnlessEqual(sorted(found), sorted(zf.namelist()))
+        for zinfo in zf.infolist():
+            if not zinfo.filename.endswith("/"):
+                fn = os.path.join(addon_dir, *zinfo.filename.split("/"))
+                self.failUnlessEqual(open(fn, "rb").read(),
+                                     zf.read(zinfo.filename))
+        zf.close()
+        icon = os.path.join(up(os.path.abspath(__file__)),
+                            "bug-588119-files", "packages", "implicit-icon",
+                            "icon.png")
+        if hasattr(os, "link"):
+            self.failUnless(os.path.samefile(icon,
+                                             os.path.join(addon_dir,
+                                                          "icon.png")))
+
+class ParallelXPI(unittest.TestCase):
+    def test_compress_file(self):
+        # compress_file() makes the same entries as ZipFile.write()
+        basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(basedir):
+            shutil.rmtree(basedir)
+        os.makedirs(basedir)
+        big = os.path.join(basedir, "big.js")
+        open(big, "w").write("".join(["var x%d = require('x%d');\n" % (i, i)
+                                      for i in range(10000)]))
+        empty = os.path.join(basedir, "empty.js")
+        open(empty, "w").close()
+        xpiname = os.path.join(basedir, "write.xpi")
+        zf = zipfile.ZipFile(xpiname, "w", zipfile.ZIP_DEFLATED)
+        for fn in (big, empty):
+            zf.write(fn, os.path.basename(fn))
+        zf.close()
+        zf = zipfile.ZipFile(xpiname, "r")
+        for fn in (big, empty):
+            expected = zf.getinfo(os.path.basename(fn))
+            zinfo, data = xpi.compress_file(fn, os.path.basename(fn))
+            self.failUnlessEqual(data, xpi.read_raw(zf, expected))
+            for attr in ("external_attr", "compress_type", "CRC",
+                         "file_size", "compress_size"):
+                self.failUnlessEqual(getattr(zinfo, attr),
+                                     getattr(expected, attr))
+            # zip files store the time in 2 second steps
+            self.failUnlessEqual(zinfo.date_time[:5] +
+                                 (zinfo.date_time[5] // 2 * 2,),
+                                 expected.date_time)
+        zf.close()
+
+    def test_compression_policy(self):
+        basedir = os.path.join(".test_tmp", self.id())
+        if os.path.isdir(basedir):
+            shutil.rmtree(basedir)
+        os.makedirs(basedir)
+        files = {"icon.png": "not really a png, but compressible " * 100,
+                 "noise.dat": os.urandom(100000),
+                 "little-noise.dat": os.urandom(1000),
+                 "main.js": "var x = require('x'); x.doStuff();\n" * 1000}
+        for (name, data) in files.items():
+            open(os.path.join(basedir, name), "wb").write(data)
+        def compress(policy):
+            xpiname = os.path.join(basedir, "policy.xpi")
+            zf = zipfile.ZipFile(xpiname, "w", zipfile.ZIP_DEFLATED)
+            for name in sorted(files):
+                zinfo, data = policy.compress(os.path.join(basedir, name),
+                                              name)
+                xpi.write_raw(zf, zinfo, data)
+            zf.close()
+            zf = zipfile.ZipFile(xpiname, "r")
+            for name in files:
+                self.failUnlessEqual(zf.read(name), files[name])
+            infos = dict([(zinfo.filename, zinfo) for zinfo in zf.infolist()])
+            zf.close()
+            return infos
+
+        dev = compress(xpi.DEV_COMPRESSION)
+        release = compress(xpi.RELEASE_COMPRESSION)
+        for infos in (dev, release):
+            self.failUnlessEqual(infos["icon.png"].compress_type,
+                                 zipfile.ZIP_STORED)
+            self.failUnlessEqual(infos["noise.dat"].compress_type,
+                                 zipfile.ZIP_STORED)
+            self.failUnlessEqual(infos["little-noise.dat"].compress_type,
+                                 zipfile.ZIP_STORED)
+            self.failUnlessEqual(infos["main.js"].compress_type,
+                                 zipfile.ZIP_DEFLATED)
+        self.failUnless(release["main.js"].compress_size <=
+                        dev["main.js"].compress_size)
+        # without a trial, incompressible data still gets deflated
+        infos = compress(xpi.DEFAULT_COMPRESSION)
+        self.failUnlessEqual(infos["noise.dat"].compress_type,
+                             zipfile.ZIP_DEFLATED)
+
+        # the trial doesn't compress anything twice
+        fed = []
+        class Compressor:
+            def __init__(self, *args):
+                self.cmpr = compressobj(*args)
+            def compress(self, data):
+                fed.append(len(data))
+                return self.cmpr.compress(data)
+            def copy(self):
+                return self.cmpr.copy()
+            def flush(self):
+                return self.cmpr.flush()
+        compressobj = xpi.zlib.compressobj
+        xpi.zlib.compressobj = Compressor
+        try:
+            # noise.dat is stored from its second chunk on
+            for (name, size) in [("main.js", len(files["main.js"])),
+                                 ("noise.dat", xpi.READ_SIZE)]:
+                del fed[:]
+                xpi.DEV_COMPRESSION.compress(os.path.join(basedir, name),
+                                             name)
+                self.failUnlessEqual(sum(fed), size)
+        finally:
+            xpi.zlib.compressobj = compressobj
+
+    def test_jobs(self):
+        xpis = []
+        for jobs in (1, 3):
+            xpiname = "parallel-%d.xpi" % jobs
+            create_xpi(xpiname, "implicit-icon", "bug-588119-files",
+                       jobs=jobs)
+            zf = zipfile.ZipFile(xpiname, "r")
+            xpis.append([(zinfo.filename, zinfo.CRC, xpi.read_raw(zf, zinfo))
+                         for zinfo in zf.infolist()
+                         if zinfo.filename != "harness-options.json"])
+            zf.close()
+            os.remove(xpiname)
+        self.failUnlessEqual(xpis[0], xpis[1])
+
 class SmallXPI(unittest.TestCase):
     def setUp(self):
         self.root = up(os.path.abspath(__file__), 4)
@@ -295,16 +599,20 @@ def document_dir_files(path):
         print "  %s" % contents
 
 def create_xpi(xpiname, pkg_name='aardvark', dirname='static-files',
-               extra_harness_options={}):
+               extra_harness_options={}, entry_cache=None, jobs=1,
+               output_cache=None, jetpackID=None):
     configs = test_packaging.get_configs(pkg_name, dirname)
     options = {'main': configs.target_cfg.main,
-               'jetpackID': buildJID(configs.target_cfg), }
+               'jetpackID': jetpackID or buildJID(configs.target_cfg), }
     options.update(configs.build)
     xpi.build_xpi(template_root_dir=xpi_template_path,
                   manifest=fake_manifest,
                   xpi_path=xpiname,
                   harness_options=options,
-                  extra_harness_options=extra_harness_options)
+                  extra_harness_options=extra_harness_options,
+                  entry_cache=entry_cache,
+                  jobs=jobs,
+                  output_cache=output_cache)
 
 if __name__ == '__main__':
     unittest.main()
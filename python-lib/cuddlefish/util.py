@@ -5,7 +5,7 @@
 
 IGNORED_FILE_PREFIXES = ["."]
 IGNORED_FILE_SUFFIXES = ["~", ".swp"]
-IGNORED_DIRS = [".git", ".svn", ".hg"]
+IGNORED_DIRS = [".git", ".svn", ".hg", ".cfx-cache"]
 
 def filter_filenames(filenames, ignored_files=[".hgignore"]):
     for filename in filenames:
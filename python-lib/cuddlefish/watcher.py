@@ -0,0 +1,135 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Waits for files to be written to, so that run_app() can react to the
+output and the result of the application as soon as they show up, rather
+than check for them every few milliseconds.
+
+On Linux, this uses inotify, through ctypes. Elsewhere, or if inotify
+can't be used (say, out of watches), wait() simply sleeps for
+POLL_INTERVAL, which is what run_app() used to do.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+
+# how long the polling fallback sleeps between checks, in seconds
+POLL_INTERVAL = 0.05
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+IN_EVENT_HEADER = "iIII" # wd, mask, cookie, len
+IN_EVENT_HEADER_SIZE = struct.calcsize(IN_EVENT_HEADER)
+
+class PollingWatcher:
+    """
+    Doesn't watch anything: wait() returns after POLL_INTERVAL seconds (or
+    TIMEOUT, if sooner), and the caller checks its files itself.
+    """
+    def __init__(self, filenames):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(max(0, min(timeout, POLL_INTERVAL)))
+        return True
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """
+    Watches FILENAMES through the directories which hold them, since the
+    files may not exist yet, or be removed and created again.
+    """
+    def __init__(self, filenames):
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        # raises AttributeError if this libc has no inotify
+        self._add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.names = {} # maps each watch descriptor to the names it watches
+        try:
+            dirnames = {}
+            for filename in filenames:
+                (dirname, name) = os.path.split(os.path.abspath(filename))
+                dirnames.setdefault(dirname, set()).add(name)
+            for (dirname, names) in dirnames.items():
+                mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+                wd = self._add_watch(self.fd, dirname, mask)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(),
+                                  "inotify_add_watch failed for %s" % dirname)
+                self.names[wd] = names
+        except:
+            os.close(self.fd)
+            raise
+
+    def _read_events(self):
+        # returns True if one of the events is about one of our files
+        found = False
+        while True:
+            try:
+                data = os.read(self.fd, 64*1024)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return found
+                raise
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = struct.unpack_from(
+                    IN_EVENT_HEADER, data, offset)
+                offset += IN_EVENT_HEADER_SIZE
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+                if name in self.names.get(wd, ()):
+                    found = True
+
+    def wait(self, timeout):
+        """
+        Returns True as soon as one of the files is written to, or False
+        after TIMEOUT seconds. The events that come in between two calls
+        are kept, so nothing is missed while the caller reads the files.
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                readable = select.select([self.fd], [], [], remaining)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable and self._read_events():
+                return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def get_watcher(filenames):
+    """
+    Returns an InotifyWatcher for FILENAMES if we can have one, or a
+    PollingWatcher.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(filenames)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(filenames)
@@ -3,9 +3,16 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os
+import time
+import shutil
+import hashlib
+import zlib
+import struct
 import zipfile
 import simplejson as json
 from cuddlefish.util import filter_filenames, filter_dirnames
+from cuddlefish import profiler, hashing
+from cuddlefish.cache import link_or_copy
 
 class HarnessOptionAlreadyDefinedError(Exception):
     """You cannot use --harness-option on keys that already exist in
@@ -13,153 +20,643 @@ class HarnessOptionAlreadyDefinedError(Exception):
 
 ZIPSEP = "/" # always use "/" in zipfiles
 
+# build_xpi() dates every entry with the earliest time a zip file can hold,
+# so that the XPI depends only on what goes into it
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
 def make_zipfile_path(localroot, localpath):
     return ZIPSEP.join(localpath[len(localroot)+1:].split(os.sep))
 
 def mkzipdir(zf, path):
-    dirinfo = zipfile.ZipInfo(path)
+    dirinfo = zipfile.ZipInfo(path, ZIP_EPOCH)
     dirinfo.external_attr = int("040755", 8) << 16L
     zf.writestr(dirinfo, "")
 
-def build_xpi(template_root_dir, manifest, xpi_path,
-              harness_options, limit_to=None, extra_harness_options={},
-              bundle_sdk=True, pkgdir=""):
-    IGNORED_FILES = [".hgignore", ".DS_Store",
-                     "application.ini", xpi_path]
-    IGNORED_TOP_LVL_FILES = ["install.rdf"]
-
-    files_to_copy = {} # maps zipfile path to local-disk abspath
-    dirs_to_create = set() # zipfile paths, no trailing slash
-
-    zf = zipfile.ZipFile(xpi_path, "w", zipfile.ZIP_DEFLATED)
-
-    zf.writestr('install.rdf', str(manifest))
-
-    # Handle add-on icon
-    if 'icon' in harness_options:
-        zf.write(os.path.join(str(harness_options['icon'])), 'icon.png')
-        del harness_options['icon']
-
-    if 'icon64' in harness_options:
-        zf.write(os.path.join(str(harness_options['icon64'])), 'icon64.png')
-        del harness_options['icon64']
-
-    # chrome.manifest
-    if os.path.isfile(os.path.join(pkgdir, 'chrome.manifest')):
-      files_to_copy['chrome.manifest'] = os.path.join(pkgdir, 'chrome.manifest')
-
-    # chrome folder (would contain content, skin, and locale folders typically)
-    folder = 'chrome'
-    if os.path.exists(os.path.join(pkgdir, folder)):
-      dirs_to_create.add('chrome')
-      # cp -r folder
-      abs_dirname = os.path.join(pkgdir, folder)
-      for dirpath, dirnames, filenames in os.walk(abs_dirname):
-          goodfiles = list(filter_filenames(filenames, IGNORED_FILES))
-          dirnames[:] = filter_dirnames(dirnames)
-          for dirname in dirnames:
-            arcpath = make_zipfile_path(template_root_dir,
-                                        os.path.join(dirpath, dirname))
-            dirs_to_create.add(arcpath)
-          for filename in goodfiles:
-              abspath = os.path.join(dirpath, filename)
-              arcpath = ZIPSEP.join(
-                  [folder,
-                   make_zipfile_path(abs_dirname, os.path.join(dirpath, filename)),
-                   ])
-              files_to_copy[str(arcpath)] = str(abspath)
-
-    for dirpath, dirnames, filenames in os.walk(template_root_dir):
-        if template_root_dir == dirpath:
-            filenames = list(filter_filenames(filenames, IGNORED_TOP_LVL_FILES))
-        filenames = list(filter_filenames(filenames, IGNORED_FILES))
-        dirnames[:] = filter_dirnames(dirnames)
-        for dirname in dirnames:
-            arcpath = make_zipfile_path(template_root_dir,
-                                        os.path.join(dirpath, dirname))
-            dirs_to_create.add(arcpath)
-        for filename in filenames:
-            abspath = os.path.join(dirpath, filename)
-            arcpath = make_zipfile_path(template_root_dir, abspath)
-            files_to_copy[arcpath] = abspath
-
-    # `packages` attribute contains a dictionnary of dictionnary
-    # of all packages sections directories
-    for packageName in harness_options['packages']:
-      base_arcpath = ZIPSEP.join(['resources', packageName])
-      # Eventually strip sdk files. We need to do that in addition to the
-      # whilelist as the whitelist is only used for `cfx xpi`:
-      if not bundle_sdk and packageName == 'addon-sdk':
-          continue
-      # Always write the top directory, even if it contains no files, since
-      # the harness will try to access it.
-      dirs_to_create.add(base_arcpath)
-      for sectionName in harness_options['packages'][packageName]:
-        abs_dirname = harness_options['packages'][packageName][sectionName]
-        base_arcpath = ZIPSEP.join(['resources', packageName, sectionName])
-        # Always write the top directory, even if it contains no files, since
-        # the harness will try to access it.
-        dirs_to_create.add(base_arcpath)
-        # cp -r stuff from abs_dirname/ into ZIP/resources/RESOURCEBASE/
-        for dirpath, dirnames, filenames in os.walk(abs_dirname):
-            goodfiles = list(filter_filenames(filenames, IGNORED_FILES))
+def read_raw(zf, zinfo):
+    """
+    Returns the data of the entry ZINFO of the ZipFile ZF as it is stored in
+    the archive, i.e. still compressed.
+    """
+    zf.fp.seek(zinfo.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader,
+                            zf.fp.read(zipfile.sizeFileHeader))
+    if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile("Bad magic number for file header")
+    zf.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] +
+               fheader[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+    return zf.fp.read(zinfo.compress_size)
+
+def write_raw(zf, zinfo, data):
+    """
+    Adds an entry to the ZipFile ZF, like ZipFile.writestr() does, but with
+    DATA already compressed: ZINFO must have the compress_type, CRC,
+    file_size and compress_size that go with it. zipfile has no API for
+    this, so we do what writestr() does ourselves.
+    """
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zip64 = (zinfo.file_size > zipfile.ZIP64_LIMIT or
+             zinfo.compress_size > zipfile.ZIP64_LIMIT)
+    zf.fp.write(zinfo.FileHeader(zip64))
+    zf.fp.write(data)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+READ_SIZE = 64*1024
+
+def compress_file(abspath, arcname, level=zlib.Z_DEFAULT_COMPRESSION,
+                  min_saving=None, date_time=None):
+    """
+    Returns (zinfo, data) for an entry ARCNAME made from the file ABSPATH,
+    with DATA compressed at LEVEL: the same entry as ZipFile.write() makes,
+    but without a ZipFile, so that several files can be compressed at once
+    (zlib lets go of the GIL while it works). See write_raw().
+
+    A LEVEL of None stores the file uncompressed. So does a MIN_SAVING
+    (between 0 and 1) when compressing the first READ_SIZE bytes of the
+    file saves less than that fraction of their size. That trial is part
+    of compressing the file, not done on the side.
+
+    The entry is dated DATE_TIME, or by default like the file.
+    """
+    span = profiler.begin("compress file", args={"file": arcname})
+    info = os.stat(abspath)
+    if date_time is None:
+        date_time = time.localtime(info.st_mtime)[0:6]
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = (info.st_mode & 0xFFFF) << 16L
+    if level is None:
+        cmpr = None
+    else:
+        # raw deflate data, as in ZipFile.write()
+        cmpr = zlib.compressobj(level, zlib.DEFLATED, -15)
+    def saves_enough(compressed, size):
+        return compressed <= size * (1 - min_saving)
+    crc = 0
+    file_size = 0
+    chunks = []
+    first = None # the first chunk, while the trial is undecided
+    f = open(abspath, "rb")
+    try:
+        while True:
+            buf = f.read(READ_SIZE)
+            if not buf:
+                break
+            if first is not None:
+                # the trial: if the first chunk doesn't compress well, the
+                # rest of the file most likely won't either. Flushing a copy
+                # of the compressor only encodes what it holds, and what the
+                # first chunk was compressed to is kept
+                trial = len(chunks[0]) + len(cmpr.copy().flush())
+                if not saves_enough(trial, len(first)):
+                    cmpr = None
+                    chunks = [first]
+                first = None
+            file_size += len(buf)
+            crc = zlib.crc32(buf, crc) & 0xffffffff
+            if cmpr:
+                if min_saving is not None and file_size == len(buf):
+                    first = buf
+                buf = cmpr.compress(buf)
+            chunks.append(buf)
+    finally:
+        f.close()
+    if cmpr:
+        chunks.append(cmpr.flush())
+        if first is not None and not saves_enough(len("".join(chunks)),
+                                                  len(first)):
+            # a file of a single chunk is its own trial
+            cmpr = None
+            chunks = [first]
+    if cmpr:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+    else:
+        zinfo.compress_type = zipfile.ZIP_STORED
+    data = "".join(chunks)
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(data)
+    profiler.end(span)
+    return zinfo, data
+
+class CompressionPolicy:
+    """
+    Decides how build_xpi() compresses each file: not at all for formats
+    which are compressed already (images, fonts, media and archives), at
+    LEVEL for the others, unless a trial shows that compressing saves less
+    than MIN_SAVING of the size (see compress_file()).
+    """
+    STORED_EXTENSIONS = set([".png", ".jpg", ".jpeg", ".gif", ".webp",
+                             ".woff", ".woff2",
+                             ".mp3", ".mp4", ".m4a", ".m4v", ".ogg", ".oga",
+                             ".ogv", ".opus", ".webm", ".flac",
+                             ".zip", ".xpi", ".jar", ".gz", ".bz2", ".xz"])
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION, min_saving=None):
+        self.level = level
+        self.min_saving = min_saving
+
+    def get_level(self, arcname):
+        # the compression level for ARCNAME, or None to store it
+        if os.path.splitext(arcname)[1].lower() in self.STORED_EXTENSIONS:
+            return None
+        return self.level
+
+    def describe(self, arcname):
+        # what decides the data of ARCNAME besides its content, for the
+        # XPIEntryCache
+        return [self.get_level(arcname), self.min_saving]
+
+    def compress(self, abspath, arcname, date_time=None):
+        return compress_file(abspath, arcname, self.get_level(arcname),
+                             self.min_saving, date_time)
+
+# zipfile's level, and formats which are compressed already are stored
+DEFAULT_COMPRESSION = CompressionPolicy()
+# cfx run and cfx test build an XPI which is used once, right away
+DEV_COMPRESSION = CompressionPolicy(level=1, min_saving=0.1)
+# while the XPI of cfx xpi is shipped
+RELEASE_COMPRESSION = CompressionPolicy(level=9, min_saving=0.02)
+
+class EntryWriter:
+    """
+    Adds files to the ZipFile ZF, in the order in which write() is called.
+    FILES lists the (abspath, arcname) of all the files which will be
+    written: with JOBS > 1, those which can't be copied from PREVIOUS (a
+    PreviousXPI, or None) are compressed ahead by a pool of JOBS threads.
+    The archive is the same either way. POLICY is the CompressionPolicy.
+    Entries copied from PREVIOUS, or compressed, are counted in
+    ENTRY_CACHE and described in SOURCES.
+    """
+    def __init__(self, zf, files, previous=None, entry_cache=None,
+                 sources=None, jobs=1, policy=DEFAULT_COMPRESSION):
+        self.zf = zf
+        self.policy = policy
+        self.previous = previous
+        self.entry_cache = entry_cache
+        self.sources = sources
+        self.digests = {} # maps arcname to SHA-256, with a PreviousXPI
+        self.reusable = {} # maps arcname to the ZipInfo in PREVIOUS
+        self.pending = {} # maps arcname to the AsyncResult of compress_file
+        self.pool = None
+        todo = []
+        for (abspath, arcname) in files:
+            if previous is not None:
+                sha256 = hashing.hash_file(abspath)
+                self.digests[arcname] = sha256
+                old_zinfo = previous.get(arcname, sha256,
+                                         policy.describe(arcname))
+                if old_zinfo is not None:
+                    self.reusable[arcname] = old_zinfo
+                    continue
+            todo.append((abspath, arcname))
+        if jobs > 1 and len(todo) > 1:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(min(jobs, len(todo)))
+            for (abspath, arcname) in todo:
+                self.pending[arcname] = self.pool.apply_async(
+                    policy.compress, (abspath, arcname, ZIP_EPOCH))
+
+    def write(self, abspath, arcname):
+        entry = None
+        if arcname in self.reusable:
+            entry = self.previous.copy(self.reusable.pop(arcname), abspath)
+        if entry is not None:
+            self.entry_cache.reused += 1
+        else:
+            if arcname in self.pending:
+                entry = self.pending.pop(arcname).get()
+            else:
+                entry = self.policy.compress(abspath, arcname, ZIP_EPOCH)
+            if self.entry_cache is not None:
+                self.entry_cache.compressed += 1
+        (zinfo, data) = entry
+        write_raw(self.zf, zinfo, data)
+        if self.previous is not None:
+            self.sources[arcname] = [self.digests[arcname], zinfo.CRC,
+                                     zinfo.file_size, zinfo.compress_size,
+                                     zinfo.compress_type,
+                                     self.policy.describe(arcname)]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+class PreviousXPI:
+    """
+    The XPI that an earlier build_xpi() left at the same path, from which
+    we copy the compressed data of the files which haven't changed since,
+    instead of compressing them again. SOURCES maps the name of each entry
+    to [sha256, CRC, file_size, compress_size, compress_type, policy],
+    where sha256 is the digest of the file the entry was made from, policy
+    is what CompressionPolicy.describe() said about it, and the rest must
+    match the entry for us to trust it.
+    """
+    def __init__(self, xpi_path, sources):
+        self.sources = sources
+        self.zf = None
+        if sources:
+            try:
+                self.zf = zipfile.ZipFile(xpi_path, "r")
+            except (IOError, zipfile.BadZipfile):
+                pass
+
+    def get(self, arcname, sha256, policy):
+        # returns the ZipInfo of ARCNAME if we can reuse it, or None
+        if self.zf is None:
+            return None
+        source = self.sources.get(arcname)
+        try:
+            zinfo = self.zf.getinfo(arcname)
+        except KeyError:
+            return None
+        if source != [sha256, zinfo.CRC, zinfo.file_size, zinfo.compress_size,
+                      zinfo.compress_type, policy]:
+            return None
+        return zinfo
+
+    def copy(self, old_zinfo, abspath):
+        """
+        Returns (zinfo, data) for the entry OLD_ZINFO, with the ZipInfo
+        that EntryWriter would make for ABSPATH, or None if the old
+        XPI can't be read after all.
+        """
+        try:
+            data = read_raw(self.zf, old_zinfo)
+        except (IOError, zipfile.BadZipfile):
+            return None
+        info = os.stat(abspath)
+        zinfo = zipfile.ZipInfo(old_zinfo.filename, ZIP_EPOCH)
+        zinfo.external_attr = (info.st_mode & 0xFFFF) << 16L
+        for attr in ("compress_type", "CRC", "file_size", "compress_size"):
+            setattr(zinfo, attr, getattr(old_zinfo, attr))
+        return zinfo, data
+
+    def close(self):
+        if self.zf is not None:
+            self.zf.close()
+
+def map_used_files(sections, limit_to, ignored_files):
+    """
+    Returns {arcpath: abspath} for the files of LIMIT_TO which are inside
+    the SECTIONS, (base_arcpath, abs_dirname) pairs: the same files that
+    walking every section directory and keeping the ones in LIMIT_TO finds,
+    but without listing all the files that aren't used.
+    """
+    by_prefix = {} # maps abs_dirname + os.sep to base_arcpaths
+    for (base_arcpath, abs_dirname) in sections:
+        prefix = abs_dirname
+        if not prefix.endswith(os.sep):
+            prefix += os.sep
+        by_prefix.setdefault(prefix, []).append(base_arcpath)
+    files_to_copy = {}
+    for abspath in limit_to:
+        if not os.path.isfile(abspath):
+            continue # nor does the walk find directories or missing files
+        # look for each parent directory of the file in the table: sections
+        # may be nested, e.g. "lib" being the package's root directory
+        i = abspath.find(os.sep)
+        while i >= 0:
+            prefix = abspath[:i+1]
+            i = abspath.find(os.sep, i+1)
+            if prefix not in by_prefix:
+                continue
+            bits = abspath[len(prefix):].split(os.sep)
+            # the walk skips ignored directories and files
+            if filter_dirnames(bits[:-1]) != bits[:-1]:
+                continue
+            if not list(filter_filenames(bits[-1:], ignored_files)):
+                continue
+            for base_arcpath in by_prefix[prefix]:
+                arcpath = ZIPSEP.join([base_arcpath] + bits)
+                files_to_copy[str(arcpath)] = str(abspath)
+    return files_to_copy
+
+# part of the digest of XPIContents: bump it whenever build_xpi() changes
+# what it makes of the same inputs
+OUTPUT_FORMAT_VERSION = 1
+
+class XPIContents:
+    """
+    Everything build_xpi() puts in an XPI, in order: ITEMS lists
+    (arcname, kind, value) where kind is "dir" (value is None), "file"
+    (value is the abspath of the file) or "data" (value is (data,
+    external_attr, compress_type)). Collecting it all first lets us hash
+    the inputs of the XPI before deciding whether to build it.
+
+    EXTRA_DATA maps the arcname of files made by cfx, like module bundles,
+    to their data.
+    """
+    def __init__(self, template_root_dir, manifest, xpi_path,
+                 harness_options, limit_to=None, extra_harness_options={},
+                 bundle_sdk=True, pkgdir="", extra_data={}):
+        self.items = []
+        IGNORED_FILES = [".hgignore", ".DS_Store",
+                         "application.ini", xpi_path]
+        IGNORED_TOP_LVL_FILES = ["install.rdf"]
+
+        files_to_copy = {} # maps zipfile path to local-disk abspath
+        dirs_to_create = set() # zipfile paths, no trailing slash
+
+        # Handle add-on icon
+        icons = [] # (abspath, arcname), written right after install.rdf
+        if 'icon' in harness_options:
+            icons.append((os.path.join(str(harness_options['icon'])),
+                          'icon.png'))
+            del harness_options['icon']
+
+        if 'icon64' in harness_options:
+            icons.append((os.path.join(str(harness_options['icon64'])),
+                          'icon64.png'))
+            del harness_options['icon64']
+
+        # chrome.manifest
+        if os.path.isfile(os.path.join(pkgdir, 'chrome.manifest')):
+          files_to_copy['chrome.manifest'] = os.path.join(pkgdir,
+                                                          'chrome.manifest')
+
+        # chrome folder (would contain content, skin, and locale folders
+        # typically)
+        folder = 'chrome'
+        if os.path.exists(os.path.join(pkgdir, folder)):
+          dirs_to_create.add('chrome')
+          # cp -r folder
+          abs_dirname = os.path.join(pkgdir, folder)
+          for dirpath, dirnames, filenames in os.walk(abs_dirname):
+              goodfiles = list(filter_filenames(filenames, IGNORED_FILES))
+              dirnames[:] = filter_dirnames(dirnames)
+              for dirname in dirnames:
+                arcpath = make_zipfile_path(template_root_dir,
+                                            os.path.join(dirpath, dirname))
+                dirs_to_create.add(arcpath)
+              for filename in goodfiles:
+                  abspath = os.path.join(dirpath, filename)
+                  arcpath = ZIPSEP.join(
+                      [folder,
+                       make_zipfile_path(abs_dirname,
+                                         os.path.join(dirpath, filename)),
+                       ])
+                  files_to_copy[str(arcpath)] = str(abspath)
+
+        for dirpath, dirnames, filenames in os.walk(template_root_dir):
+            if template_root_dir == dirpath:
+                filenames = list(filter_filenames(filenames,
+                                                  IGNORED_TOP_LVL_FILES))
+            filenames = list(filter_filenames(filenames, IGNORED_FILES))
             dirnames[:] = filter_dirnames(dirnames)
-            for filename in goodfiles:
+            for dirname in dirnames:
+                arcpath = make_zipfile_path(template_root_dir,
+                                            os.path.join(dirpath, dirname))
+                dirs_to_create.add(arcpath)
+            for filename in filenames:
                 abspath = os.path.join(dirpath, filename)
-                if limit_to is not None and abspath not in limit_to:
-                    continue  # strip unused files
-                arcpath = ZIPSEP.join(
-                    ['resources',
-                     packageName,
-                     sectionName,
-                     make_zipfile_path(abs_dirname,
-                                       os.path.join(dirpath, filename)),
-                     ])
-                files_to_copy[str(arcpath)] = str(abspath)
-    del harness_options['packages']
-
-    locales_json_data = {"locales": []}
-    mkzipdir(zf, "locale/")
-    for language in sorted(harness_options['locale']):
-        locales_json_data["locales"].append(language)
-        locale = harness_options['locale'][language]
-        # Be carefull about strings, we need to always ensure working with UTF-8
-        jsonStr = json.dumps(locale, indent=1, sort_keys=True, ensure_ascii=False)
-        info = zipfile.ZipInfo('locale/' + language + '.json')
-        info.external_attr = 0644 << 16L
-        zf.writestr(info, jsonStr.encode( "utf-8" ))
-    del harness_options['locale']
-
-    jsonStr = json.dumps(locales_json_data, ensure_ascii=True) +"\n"
-    info = zipfile.ZipInfo('locales.json')
-    info.external_attr = 0644 << 16L
-    zf.writestr(info, jsonStr.encode("utf-8"))
-
-    # now figure out which directories we need: all retained files parents
-    for arcpath in files_to_copy:
-        bits = arcpath.split("/")
-        for i in range(1,len(bits)):
-            parentpath = ZIPSEP.join(bits[0:i])
-            dirs_to_create.add(parentpath)
-
-    # Create zipfile in alphabetical order, with each directory before its
-    # files
-    for name in sorted(dirs_to_create.union(set(files_to_copy))):
-        if name in dirs_to_create:
-            mkzipdir(zf, name+"/")
-        if name in files_to_copy:
-            zf.write(files_to_copy[name], name)
-
-    # Add extra harness options
-    harness_options = harness_options.copy()
-    for key,value in extra_harness_options.items():
-        if key in harness_options:
-            msg = "Can't use --harness-option for existing key '%s'" % key
-            raise HarnessOptionAlreadyDefinedError(msg)
-        harness_options[key] = value
-
-    # Write harness-options.json
-    zf.writestr('harness-options.json', json.dumps(harness_options, indent=1,
-                                                   sort_keys=True))
-
-    zf.close()
+                arcpath = make_zipfile_path(template_root_dir, abspath)
+                files_to_copy[arcpath] = abspath
+
+        # `packages` attribute contains a dictionnary of dictionnary
+        # of all packages sections directories
+        sections = [] # (base_arcpath, abs_dirname) of the ones we include
+        for packageName in harness_options['packages']:
+          base_arcpath = ZIPSEP.join(['resources', packageName])
+          # Eventually strip sdk files. We need to do that in addition to
+          # the whilelist as the whitelist is only used for `cfx xpi`:
+          if not bundle_sdk and packageName == 'addon-sdk':
+              continue
+          # Always write the top directory, even if it contains no files,
+          # since the harness will try to access it.
+          dirs_to_create.add(base_arcpath)
+          for sectionName in harness_options['packages'][packageName]:
+            abs_dirname = harness_options['packages'][packageName][sectionName]
+            base_arcpath = ZIPSEP.join(['resources', packageName,
+                                        sectionName])
+            # Always write the top directory, even if it contains no files,
+            # since the harness will try to access it.
+            dirs_to_create.add(base_arcpath)
+            sections.append((base_arcpath, abs_dirname))
+        del harness_options['packages']
+
+        if limit_to is not None:
+            # strip unused files: rather than walking the sections for them,
+            # go straight from the used files to their place in the XPI
+            files_to_copy.update(map_used_files(sections, limit_to,
+                                                IGNORED_FILES))
+        else:
+            for (base_arcpath, abs_dirname) in sections:
+                # cp -r stuff from abs_dirname/ into
+                # ZIP/resources/RESOURCEBASE/
+                for dirpath, dirnames, filenames in os.walk(abs_dirname):
+                    goodfiles = list(filter_filenames(filenames,
+                                                      IGNORED_FILES))
+                    dirnames[:] = filter_dirnames(dirnames)
+                    for filename in goodfiles:
+                        abspath = os.path.join(dirpath, filename)
+                        arcpath = ZIPSEP.join(
+                            [base_arcpath,
+                             make_zipfile_path(abs_dirname, abspath)])
+                        files_to_copy[str(arcpath)] = str(abspath)
+
+        # now figure out which directories we need: all retained files
+        # parents
+        for arcpath in set(files_to_copy).union(extra_data):
+            bits = arcpath.split("/")
+            for i in range(1,len(bits)):
+                parentpath = ZIPSEP.join(bits[0:i])
+                dirs_to_create.add(parentpath)
+
+        self.add_data('install.rdf', str(manifest))
+
+        for (abspath, arcname) in icons:
+            self.items.append((arcname, "file", abspath))
+
+        locales_json_data = {"locales": []}
+        self.items.append(("locale/", "dir", None))
+        for language in sorted(harness_options['locale']):
+            locales_json_data["locales"].append(language)
+            locale = harness_options['locale'][language]
+            # Be carefull about strings, we need to always ensure working
+            # with UTF-8
+            jsonStr = json.dumps(locale, indent=1, sort_keys=True,
+                                 ensure_ascii=False)
+            self.add_data('locale/' + language + '.json',
+                          jsonStr.encode("utf-8"), 0644, zipfile.ZIP_STORED)
+        del harness_options['locale']
+
+        jsonStr = json.dumps(locales_json_data, ensure_ascii=True) +"\n"
+        self.add_data('locales.json', jsonStr.encode("utf-8"), 0644,
+                      zipfile.ZIP_STORED)
+
+        # Create zipfile in alphabetical order, with each directory before
+        # its files
+        for name in sorted(dirs_to_create.union(set(files_to_copy),
+                                                extra_data)):
+            if name in dirs_to_create:
+                self.items.append((name+"/", "dir", None))
+            if name in files_to_copy:
+                self.items.append((name, "file", files_to_copy[name]))
+            if name in extra_data:
+                self.add_data(name, extra_data[name], 0644)
+
+        # Add extra harness options
+        harness_options = harness_options.copy()
+        for key,value in extra_harness_options.items():
+            if key in harness_options:
+                msg = "Can't use --harness-option for existing key '%s'" % key
+                raise HarnessOptionAlreadyDefinedError(msg)
+            harness_options[key] = value
+
+        # Write harness-options.json
+        self.add_data('harness-options.json',
+                      json.dumps(harness_options, indent=1, sort_keys=True))
+
+    def add_data(self, arcname, data, mode=0600,
+                 compress_type=zipfile.ZIP_DEFLATED):
+        # the defaults are what ZipFile.writestr() does with a name
+        self.items.append((arcname, "data", (data, (mode & 0xFFFF) << 16L,
+                                             compress_type)))
+
+    def get_files(self):
+        # (abspath, arcname) of the files to copy, for EntryWriter
+        return [(value, arcname) for (arcname, kind, value) in self.items
+                if kind == "file"]
+
+    def get_digest(self, policy):
+        """
+        Returns the SHA-256 of everything which decides the XPI that
+        write() makes with the CompressionPolicy POLICY: the name and
+        order of the entries, the content and mode of the files, the
+        data, and how it all gets compressed.
+        """
+        h = hashlib.sha256()
+        h.update("%d %s\n" % (OUTPUT_FORMAT_VERSION, zlib.ZLIB_VERSION))
+        for (arcname, kind, value) in self.items:
+            if kind == "dir":
+                desc = []
+            elif kind == "file":
+                desc = [hashing.hash_file(value),
+                        os.stat(value).st_mode & 0xFFFF,
+                        policy.describe(arcname)]
+            else:
+                (data, external_attr, compress_type) = value
+                desc = [hashlib.sha256(data).hexdigest(), external_attr,
+                        compress_type]
+            h.update(json.dumps([arcname, kind] + desc) + "\n")
+        return h.hexdigest()
+
+    def write_dir(self, dirname):
+        """
+        Writes the entries to files under DIRNAME instead of an XPI. The
+        files are hard links to their sources where the filesystem allows,
+        else copies.
+        """
+        for (arcname, kind, value) in self.items:
+            path = os.path.join(dirname, *arcname.rstrip(ZIPSEP).split(ZIPSEP))
+            if kind == "dir":
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                continue
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if kind == "file":
+                link_or_copy(value, path)
+            else:
+                (data, external_attr, compress_type) = value
+                f = open(path, "wb")
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+                os.chmod(path, external_attr >> 16)
+
+    def write(self, zf, writer):
+        for (arcname, kind, value) in self.items:
+            if kind == "dir":
+                mkzipdir(zf, arcname)
+            elif kind == "file":
+                writer.write(value, arcname)
+            else:
+                (data, external_attr, compress_type) = value
+                info = zipfile.ZipInfo(arcname, ZIP_EPOCH)
+                info.external_attr = external_attr
+                info.compress_type = compress_type
+                zf.writestr(info, data)
+
+def build_unpacked(template_root_dir, manifest, addon_dir, harness_options,
+                   limit_to=None, bundle_sdk=True, pkgdir=""):
+    """
+    Lays out in ADDON_DIR what build_xpi() would put in an XPI made from
+    the same arguments, as installing that XPI unpacked would: for an
+    add-on that is only run locally, this saves compressing the XPI and
+    extracting it again. Whatever was in ADDON_DIR is removed.
+    """
+    contents = XPIContents(template_root_dir, manifest, addon_dir,
+                           harness_options, limit_to, {}, bundle_sdk, pkgdir)
+    if os.path.isdir(addon_dir):
+        shutil.rmtree(addon_dir)
+    os.makedirs(addon_dir)
+    contents.write_dir(addon_dir)
+
+def build_xpi(template_root_dir, manifest, xpi_path,
+              harness_options, limit_to=None, extra_harness_options={},
+              bundle_sdk=True, pkgdir="", entry_cache=None, jobs=1,
+              compression=DEFAULT_COMPRESSION, output_cache=None,
+              extra_data={}):
+    """
+    With ENTRY_CACHE (a cache.XPIEntryCache), the build is incremental: the
+    files which were already in the XPI at XPI_PATH, unchanged, are copied
+    from it rather than compressed again. With JOBS > 1, files are
+    compressed by that many threads; the XPI is the same. COMPRESSION is
+    the CompressionPolicy to use.
+
+    The same inputs always make the same XPI, byte for byte: entries are
+    dated ZIP_EPOCH and JSON is written with sorted keys. So with
+    OUTPUT_CACHE (a cache.XPIOutputCache), an XPI that was built before
+    from the same inputs is put at XPI_PATH as it is, and nothing is built.
+
+    EXTRA_DATA maps the names of more files to put in the XPI, like module
+    bundles, to their data.
+    """
+    contents = XPIContents(template_root_dir, manifest, xpi_path,
+                           harness_options, limit_to, extra_harness_options,
+                           bundle_sdk, pkgdir, extra_data)
+    if output_cache is not None:
+        digest = contents.get_digest(compression)
+        if output_cache.fetch(digest, xpi_path):
+            return
+
+    previous = None
+    sources = {} # what the entry cache will remember about this XPI
+    if entry_cache is not None:
+        previous = PreviousXPI(xpi_path, entry_cache.get_entries(xpi_path))
+    # we write next to XPI_PATH and rename when done: the old XPI is read
+    # meanwhile, and may be a link into the output cache, which must not
+    # be overwritten
+    zip_path = xpi_path + ".tmp"
+
+    zf = zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED)
+    written = False
+    try:
+        writer = EntryWriter(zf, contents.get_files(), previous, entry_cache,
+                             sources, jobs, compression)
+        try:
+            contents.write(zf, writer)
+        finally:
+            writer.close()
+        written = True
+    finally:
+        zf.close()
+        if previous is not None:
+            previous.close()
+        if not written:
+            os.remove(zip_path)
+    if os.name == "nt" and os.path.exists(xpi_path):
+        # rename() does not replace existing files on windows
+        os.remove(xpi_path)
+    os.rename(zip_path, xpi_path)
+    if entry_cache is not None:
+        entry_cache.set_entries(xpi_path, sources)
+        entry_cache.save()
+    if output_cache is not None:
+        output_cache.store(digest, xpi_path)
@@ -524,4 +524,29 @@ exports['test lazy globals'] = function (assert) {
   assert.ok(gotFoo, "foo has been accessed only when we first try to use it");
 };
 
+exports['test modules from bundles'] = function (assert) {
+  // none of the modules has a file of its own in the fixture directory
+  let uri = root + '/fixtures/loader/bundle/';
+  let bundle = uri + 'bundle.json';
+  let loader = Loader({
+    paths: { '': uri },
+    bundles: { 'main': bundle, 'other': bundle }
+  });
+  let program = main(loader, 'main');
+  assert.equal(program.answer, 42, 'modules are evaluated from the bundle');
+  assert.equal(program.uri, uri + 'main.js', 'modules keep their own URI');
+};
+
+exports['test empty module from a bundle'] = function (assert) {
+  // there is no empty.js to fall back on
+  let uri = root + '/fixtures/loader/bundle/';
+  let loader = Loader({
+    paths: { '': uri },
+    bundles: { 'empty': uri + 'bundle.json' }
+  });
+  let program = main(loader, 'empty');
+  assert.deepEqual(Object.keys(program), [],
+                   'an empty module is evaluated from the bundle');
+};
+
 require('sdk/test').run(exports);